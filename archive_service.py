@@ -0,0 +1,323 @@
+"""
+Archivo de facturas por retención.
+
+Las facturas creadas hace más de ``storage_retention_days`` días (configuración
+por organización; 0 o vacío lo desactiva) salen de la tabla ``invoices``:
+
+1. Se escriben completas en un segmento ``ARCHIVE_DIR/org_<id>/<fecha>-<id>.jsonl.gz``
+   (una factura por línea). Los segmentos no se modifican nunca: cada
+   ejecución crea los suyos.
+2. Su archivo se copia a ``ARCHIVE_DIR/org_<id>/files/``.
+3. En una transacción se registran en el índice ``archived_invoices`` (campos
+   de búsqueda + segmento) y se borran con ``delete_invoices``; el archivo
+   original de ``uploads/`` se purga después de confirmar.
+
+El índice es la fuente de verdad: un segmento escrito por una ejecución que
+falló antes de confirmar queda huérfano y esas facturas se vuelven a archivar
+en la siguiente. Al restaurar, la factura se inserta de nuevo por el ORM (con
+su id original), lo que recalcula líneas, alertas y agregados del dashboard.
+Queda marcada con ``restored_at`` y su retención se cuenta desde esa fecha:
+la siguiente ejecución no la vuelve a archivar.
+
+Los agregados del dashboard solo cuentan facturas activas: archivar una
+factura la resta de las estadísticas.
+"""
+import asyncio
+import gzip
+import json
+import logging
+import os
+import shutil
+import uuid
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import DateTime, or_, select
+from sqlalchemy.orm import Session
+
+from deletion_service import delete_invoices, file_purger
+from notification_service import reset_unread_count
+from models import ArchivedInvoice, Invoice, Organization, SessionLocal
+from pagination import paginate_keyset
+from redis_client import get_redis_client, release_lock
+from settings_service import get_setting
+from writer_service import run_write
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+# Facturas por segmento/transacción
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "1000"))
+# Segundos entre ejecuciones automáticas
+ARCHIVE_INTERVAL_SECONDS = int(os.getenv("ARCHIVE_INTERVAL_SECONDS", "21600"))
+# Espera tras el arranque antes de la primera ejecución
+ARCHIVE_INITIAL_DELAY = 60
+UPLOADS_DIR = "uploads"
+
+# Lock entre procesos: una sola ejecución a la vez
+ARCHIVE_LOCK_KEY = "lock:archive"
+ARCHIVE_LOCK_TTL = 3600
+
+_INVOICE_COLUMNS = list(Invoice.__table__.columns)
+_DATETIME_COLUMNS = {column.key for column in _INVOICE_COLUMNS if isinstance(column.type, DateTime)}
+
+
+def _encode(value: Any) -> Any:
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def _decode_record(record: Dict[str, Any]) -> Dict[str, Any]:
+    """Registro del segmento -> kwargs de Invoice"""
+    data = {}
+    for column in _INVOICE_COLUMNS:
+        value = record.get(column.key)
+        if column.key in _DATETIME_COLUMNS and isinstance(value, str):
+            value = datetime.fromisoformat(value)
+        data[column.key] = value
+    return data
+
+
+def _org_dir(org_id: int) -> str:
+    return os.path.join(ARCHIVE_DIR, f"org_{org_id}")
+
+
+def write_segment(org_id: int, records: Sequence[Dict[str, Any]]) -> str:
+    """
+    Escribe un segmento nuevo (gzip, una factura JSON por línea) de forma
+    atómica. Retorna su ruta relativa a ARCHIVE_DIR.
+    """
+    name = f"{datetime.utcnow():%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}.jsonl.gz"
+    relative = os.path.join(f"org_{org_id}", name)
+    path = os.path.join(ARCHIVE_DIR, relative)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb") as gz:
+            for record in records:
+                line = json.dumps({k: _encode(v) for k, v in record.items()}, ensure_ascii=False, default=str)
+                gz.write(line.encode("utf-8") + b"\n")
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp_path, path)
+    return relative
+
+
+def read_segment_record(segment: str, invoice_id: int) -> Optional[Dict[str, Any]]:
+    """Busca una factura dentro de un segmento"""
+    path = os.path.join(ARCHIVE_DIR, segment)
+    with gzip.open(path, "rt", encoding="utf-8") as gz:
+        for line in gz:
+            record = json.loads(line)
+            if record.get("id") == invoice_id:
+                return record
+    return None
+
+
+def _copy_file(org_id: int, invoice_id: int, file_path: Optional[str]) -> Optional[str]:
+    """Copia el archivo de la factura al directorio del archivo"""
+    if not file_path or not os.path.exists(file_path):
+        return None
+    files_dir = os.path.join(_org_dir(org_id), "files")
+    os.makedirs(files_dir, exist_ok=True)
+    target = os.path.join(files_dir, f"{invoice_id}_{os.path.basename(file_path)}")
+    shutil.copy2(file_path, target)
+    return target
+
+
+def _prepare_batch(org_id: int, cutoff: datetime, batch_size: int) -> Optional[dict]:
+    """Lee un lote vencido, lo escribe en un segmento y copia sus archivos"""
+    db = SessionLocal()
+    try:
+        records = [dict(row) for row in db.execute(
+            select(*_INVOICE_COLUMNS)
+            .where(
+                Invoice.organization_id == org_id,
+                Invoice.created_at < cutoff,
+                or_(Invoice.restored_at.is_(None), Invoice.restored_at < cutoff)
+            )
+            .order_by(Invoice.id)
+            .limit(batch_size)
+        ).mappings()]
+    finally:
+        db.close()
+    if not records:
+        return None
+
+    segment = write_segment(org_id, records)
+    files = {record["id"]: _copy_file(org_id, record["id"], record["file_path"]) for record in records}
+    return {"records": records, "segment": segment, "files": files}
+
+
+def _commit_batch(db: Session, org_id: int, batch: dict) -> Tuple[int, List[str]]:
+    """
+    Indexa y borra las facturas del lote que siguen tal como se escribieron
+    en el segmento. Las borradas mientras tanto se omiten; las editadas
+    (otro updated_at) también, y una pasada posterior las archiva con sus
+    datos nuevos en lugar de perder la edición.
+    """
+    written = {record["id"]: record["updated_at"] for record in batch["records"]}
+    # FOR UPDATE (Postgres): nadie las edita entre esta lectura y el DELETE
+    current = db.query(Invoice.id, Invoice.updated_at).filter(
+        Invoice.id.in_(list(written))
+    ).with_for_update().all()
+    existing = {invoice_id for invoice_id, updated_at in current if updated_at == written[invoice_id]}
+    changed = len(current) - len(existing)
+    if changed:
+        logger.info(f"📦 {changed} facturas editadas durante el archivo, se archivarán en otra pasada")
+    archived_at = datetime.utcnow()
+    db.add_all([
+        ArchivedInvoice(
+            id=record["id"],
+            organization_id=org_id,
+            filename=record["filename"],
+            vendor_name=record["vendor_name"],
+            vendor_tax_id=record["vendor_tax_id"],
+            invoice_number=record["invoice_number"],
+            invoice_date=record["invoice_date"],
+            total_amount=record["total_amount"],
+            currency=record["currency"],
+            search_text=record["search_text"],
+            created_at=record["created_at"],
+            segment=batch["segment"],
+            archived_file_path=batch["files"].get(record["id"]),
+            archived_at=archived_at
+        )
+        for record in batch["records"] if record["id"] in existing
+    ])
+    db.flush()
+    return delete_invoices(db, org_id, list(existing))
+
+
+async def archive_organization(org_id: int, retention_days: int, batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    """Archiva las facturas de la organización fuera de la ventana de retención"""
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    archived = 0
+    while True:
+        batch = await run_in_threadpool(_prepare_batch, org_id, cutoff, batch_size)
+        if batch is None:
+            break
+        count, file_paths = await run_write(lambda db: _commit_batch(db, org_id, batch))
+        file_purger.enqueue(file_paths)
+        reset_unread_count(org_id)
+        archived += count
+        # Sin avance (todo el lote se editó mientras tanto): reintentar en la próxima pasada
+        if len(batch["records"]) < batch_size or not count:
+            break
+    if archived:
+        logger.info(f"📦 {archived} facturas archivadas (org {org_id}, retención {retention_days} días)")
+    return archived
+
+
+def _acquire_archive_lock() -> Optional[str]:
+    """Token del lock, "" sin Redis (un solo proceso) o None si otro proceso archiva"""
+    r = get_redis_client()
+    if not r:
+        return ""
+    token = uuid.uuid4().hex
+    try:
+        return token if r.set(ARCHIVE_LOCK_KEY, token, nx=True, ex=ARCHIVE_LOCK_TTL) else None
+    except Exception as e:
+        logger.error(f"Error adquiriendo lock de archivo: {e}")
+        return None
+
+
+def _release_archive_lock(token: str):
+    # Comparar y borrar atómico: no liberar el lock si ya expiró y lo tomó otro proceso
+    release_lock(ARCHIVE_LOCK_KEY, token)
+
+
+async def run_archival() -> Dict[int, int]:
+    """Una pasada de archivo sobre todas las organizaciones. Retorna {org_id: archivadas}"""
+    token = _acquire_archive_lock()
+    if token is None:
+        logger.info("📦 Archivo en curso en otro proceso, se omite")
+        return {}
+    try:
+        db = SessionLocal()
+        try:
+            org_ids = [row[0] for row in db.query(Organization.id).order_by(Organization.id)]
+        finally:
+            db.close()
+
+        results = {}
+        for org_id in org_ids:
+            retention_days = get_setting("storage_retention_days", 0, org_id=org_id)
+            if not isinstance(retention_days, int) or retention_days <= 0:
+                continue
+            try:
+                results[org_id] = await archive_organization(org_id, retention_days)
+            except Exception as e:
+                logger.error(f"❌ Error archivando facturas de la org {org_id}: {e}")
+        return results
+    finally:
+        _release_archive_lock(token)
+
+
+async def start_archival_task():
+    """Tarea en background que aplica la retención periódicamente"""
+    await asyncio.sleep(ARCHIVE_INITIAL_DELAY)
+    while True:
+        try:
+            await run_archival()
+        except Exception as e:
+            logger.error(f"❌ Error en la tarea de archivo: {e}")
+        await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
+
+
+# ===========================================
+# CONSULTA Y RESTAURACIÓN
+# ===========================================
+
+def search_archived(db: Session, org_id: int, search: Optional[str], cursor: Optional[str], limit: int) -> Dict[str, Any]:
+    """
+    Página de facturas archivadas (más recientes primero), filtrando por
+    proveedor, NCF, RNC o descripción. Lanza ValueError si el cursor es inválido.
+    """
+    query = db.query(ArchivedInvoice).filter(ArchivedInvoice.organization_id == org_id)
+    if search:
+        query = query.filter(ArchivedInvoice.search_text.ilike(f"%{search.strip()}%"))
+    page = paginate_keyset(query, ArchivedInvoice.created_at, ArchivedInvoice.id, cursor, limit)
+    page["items"] = [item.to_dict() for item in page["items"]]
+    return page
+
+
+def _restore_path(record: Dict[str, Any]) -> str:
+    original = record.get("file_path")
+    if original and not os.path.exists(original):
+        return original
+    return os.path.join(UPLOADS_DIR, f"restored_{record['id']}_{os.path.basename(original or 'factura')}")
+
+
+def restore_invoice(db: Session, org_id: int, invoice_id: int) -> Tuple[Optional[Invoice], Optional[str]]:
+    """
+    Devuelve una factura archivada a ``invoices`` (con su archivo) y la quita
+    del índice. No confirma la transacción.
+    Retorna (factura, copia archivada a purgar tras confirmar); (None, None)
+    si no está archivada.
+    """
+    entry = db.query(ArchivedInvoice).filter(
+        ArchivedInvoice.id == invoice_id,
+        ArchivedInvoice.organization_id == org_id
+    ).first()
+    if not entry:
+        return None, None
+    record = read_segment_record(entry.segment, invoice_id)
+    if record is None:
+        raise ValueError(f"La factura {invoice_id} no está en el segmento {entry.segment}")
+
+    data = _decode_record(record)
+    if entry.archived_file_path and os.path.exists(entry.archived_file_path):
+        data["file_path"] = _restore_path(record)
+        os.makedirs(os.path.dirname(data["file_path"]) or ".", exist_ok=True)
+        shutil.copy2(entry.archived_file_path, data["file_path"])
+
+    data["restored_at"] = datetime.utcnow()
+    invoice = Invoice(**data)
+    db.add(invoice)
+    db.delete(entry)
+    db.flush()
+    return invoice, entry.archived_file_path
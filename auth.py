@@ -1,11 +1,14 @@
+from dataclasses import dataclass, asdict, field
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Any, Dict, Optional, Set, Tuple
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib.context import CryptContext
+from sqlalchemy import inspect as sa_inspect
 from sqlalchemy.orm import Session
-from models import User, get_db
+from models import User, Organization, get_db
+from redis_client import tiered_get, tiered_set, tag_keys, invalidate_tag, cache_delete, invalidate_on_commit
 import os
 from dotenv import load_dotenv
 
@@ -69,3 +72,115 @@ async def get_current_active_user(current_user: User = Depends(get_current_user)
     if not current_user.is_active:
         raise HTTPException(status_code=400, detail="Usuario inactivo")
     return current_user
+
+
+# ===========================================
+# PRINCIPAL AUTENTICADO (CACHEADO)
+# ===========================================
+# Lo que las rutas necesitan del usuario autenticado, resuelto una vez y
+# cacheado (memoria + Redis) por subject del token. Evita consultar User y
+# Organization en cada petición. Se invalida al modificar el usuario o su
+# organización (ver _invalidate_principals).
+
+PRINCIPAL_CACHE_TTL = 60
+
+
+@dataclass
+class Principal:
+    """Usuario autenticado con su contexto de empresa"""
+    id: int
+    email: str
+    full_name: Optional[str]
+    is_active: bool
+    is_superuser: bool
+    organization_id: Optional[int]
+    company: Dict[str, str] = field(default_factory=dict)
+
+
+def _principal_key(email: str) -> str:
+    return f"principal:{email}"
+
+
+def load_principal(db: Session, email: str) -> Optional[Principal]:
+    """Principal del email (desde caché o BD); None si el usuario no existe"""
+    key = _principal_key(email)
+    cached = tiered_get(key)
+    if isinstance(cached, dict):
+        return Principal(**cached)
+
+    user = db.query(User).filter(User.email == email).first()
+    if not user:
+        return None
+
+    org = None
+    if user.organization_id:
+        org = db.query(Organization).filter(Organization.id == user.organization_id).first()
+    if not org:
+        org = db.query(Organization).first()
+
+    principal = Principal(
+        id=user.id,
+        email=user.email,
+        full_name=user.full_name,
+        is_active=bool(user.is_active),
+        is_superuser=bool(user.is_superuser),
+        organization_id=user.organization_id,
+        company={
+            "company_name": (org.name if org else None) or "Mi Empresa S.A.",
+            "company_tax_id": (org.tax_id if org else None) or "",
+            "company_plan": (org.plan if org else None) or "Free Plan"
+        }
+    )
+    tiered_set(key, asdict(principal), ttl=PRINCIPAL_CACHE_TTL)
+    if org:
+        tag_keys(f"principals:org:{org.id}", key)
+    return principal
+
+
+def principal_from_token(token: Optional[str], db: Session) -> Optional[Principal]:
+    """Valida el JWT y retorna el principal activo, o None"""
+    if not token:
+        return None
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        email: str = payload.get("sub")
+        if email is None:
+            return None
+    except JWTError:
+        return None
+
+    principal = load_principal(db, email)
+    if not principal or not principal.is_active:
+        return None
+    return principal
+
+
+def invalidate_principal(email: str):
+    cache_delete(_principal_key(email))
+
+
+def invalidate_org_principals(org_id: int):
+    """Invalida los principals de una organización y su contexto de empresa"""
+    invalidate_tag(f"principals:org:{org_id}")
+    cache_delete(f"org:{org_id}:context")
+
+
+def _principal_changes(obj) -> Set[Tuple[str, Any]]:
+    if isinstance(obj, User):
+        # Con el email cambiado, el principal viejo quedó bajo la clave anterior
+        emails = [obj.email, *sa_inspect(obj).attrs.email.history.deleted]
+        return {("email", email) for email in emails if email}
+    if isinstance(obj, Organization):
+        return {("org", obj.id)}
+    return set()
+
+
+def _invalidate_principals(changes: Set[Tuple[str, Any]]):
+    for kind, value in changes:
+        if kind == "email":
+            invalidate_principal(value)
+        else:
+            invalidate_org_principals(value)
+
+
+invalidate_on_commit("_principal_changes", _principal_changes, _invalidate_principals)
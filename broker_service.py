@@ -0,0 +1,213 @@
+"""
+Difusión de mensajes WebSocket entre procesos.
+
+Cada proceso (worker de uvicorn / dyno) solo tiene sus propios sockets. El
+broker lleva los mensajes de ``websocket_manager.broadcast`` al resto de
+procesos, y cada uno los entrega a sus sockets locales:
+
+- ``RedisBroker``: pub/sub con un canal por organización
+  (``ws:org:<id>``) y ``ws:all`` para mensajes globales. Cada proceso se
+  suscribe solo a las organizaciones con sockets abiertos en él. El mensaje
+  se entrega primero localmente y se publica para los demás; cada proceso
+  ignora lo que él mismo publicó.
+- ``InMemoryBroker``: un solo proceso (sin Redis) y pruebas. Varias
+  instancias pueden compartir un grupo para simular varios procesos.
+
+Los mensajes viajan ya serializados: el sobre lleva el JSON del mensaje
+como texto y el receptor lo encola tal cual en sus conexiones.
+"""
+import asyncio
+import json
+import logging
+import os
+import uuid
+from typing import Callable, Optional, Set
+
+import redis.asyncio as aioredis
+
+from redis_client import REDIS_URL
+
+logger = logging.getLogger(__name__)
+
+WS_CHANNEL_PREFIX = "ws:org"
+WS_GLOBAL_CHANNEL = "ws:all"
+# "redis" o "memory"; por defecto redis si hay REDIS_URL
+WS_BROKER = os.getenv("WS_BROKER", "redis" if REDIS_URL else "memory")
+
+# (mensaje serializado, org_id, event_id) -> entrega a los sockets locales
+Deliver = Callable[[str, Optional[int], Optional[str]], None]
+
+
+def org_channel(org_id: Optional[int]) -> str:
+    return WS_GLOBAL_CHANNEL if org_id is None else f"{WS_CHANNEL_PREFIX}:{org_id}"
+
+
+class InMemoryBroker:
+    """Broker de un solo proceso (o de un grupo de instancias en memoria)"""
+
+    name = "memory"
+
+    def __init__(self, group: Optional[Set["InMemoryBroker"]] = None):
+        self._deliver: Optional[Deliver] = None
+        self._orgs: Set[int] = set()
+        self._group = group if group is not None else set()
+        self._group.add(self)
+
+    async def start(self, deliver: Deliver):
+        self._deliver = deliver
+
+    async def stop(self):
+        self._deliver = None
+
+    def subscribe(self, org_id: Optional[int]):
+        if org_id is not None:
+            self._orgs.add(org_id)
+
+    def unsubscribe(self, org_id: Optional[int]):
+        self._orgs.discard(org_id)
+
+    def is_subscribed(self, org_id: Optional[int]) -> bool:
+        return org_id in self._orgs
+
+    async def publish(self, message_str: str, org_id: Optional[int], event_id: Optional[str] = None):
+        for broker in list(self._group):
+            if broker._deliver is not None and (org_id is None or broker is self or org_id in broker._orgs):
+                broker._deliver(message_str, org_id, event_id)
+
+    def stats(self) -> dict:
+        return {"broker": self.name, "subscribed_orgs": len(self._orgs)}
+
+
+class RedisBroker:
+    """Broker entre procesos sobre Redis pub/sub (un canal por organización)"""
+
+    name = "redis"
+    # Segundos de espera por mensaje; acota también la demora en (des)suscribirse
+    POLL_TIMEOUT = 0.25
+    RETRY_DELAY = 2.0
+
+    def __init__(self, client: Optional[aioredis.Redis] = None):
+        self.process_id = uuid.uuid4().hex
+        self._client = client
+        self._deliver: Optional[Deliver] = None
+        self._task: Optional[asyncio.Task] = None
+        # Organizaciones con sockets locales / canales suscritos de hecho
+        self._wanted: Set[str] = {WS_GLOBAL_CHANNEL}
+        self._subscribed: Set[str] = set()
+        self.published = 0
+        self.received = 0
+        self.errors = 0
+
+    def _get_client(self) -> Optional[aioredis.Redis]:
+        if self._client is None and REDIS_URL:
+            options = {"decode_responses": True, "socket_connect_timeout": 5}
+            if REDIS_URL.startswith("rediss://"):
+                # Heroku Redis usa SSL con certificado propio (igual que redis_client.py)
+                options["ssl_cert_reqs"] = None
+            self._client = aioredis.from_url(REDIS_URL, **options)
+        return self._client
+
+    async def start(self, deliver: Deliver):
+        self._deliver = deliver
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._listen())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._deliver = None
+
+    def subscribe(self, org_id: Optional[int]):
+        """Primer socket local de la organización (la tarea de escucha se suscribe)"""
+        self._wanted.add(org_channel(org_id))
+
+    def unsubscribe(self, org_id: Optional[int]):
+        if org_id is not None:
+            self._wanted.discard(org_channel(org_id))
+
+    def is_subscribed(self, org_id: Optional[int]) -> bool:
+        """Suscripción ya activa en Redis (recibe todos los mensajes de la organización)"""
+        return org_channel(org_id) in self._subscribed and org_channel(org_id) in self._wanted
+
+    async def publish(self, message_str: str, org_id: Optional[int], event_id: Optional[str] = None):
+        # Los sockets de este proceso no esperan a Redis
+        if self._deliver is not None:
+            self._deliver(message_str, org_id, event_id)
+        client = self._get_client()
+        if client is None:
+            return
+        envelope = json.dumps({"origin": self.process_id, "org_id": org_id, "event_id": event_id, "payload": message_str})
+        try:
+            await client.publish(org_channel(org_id), envelope)
+            self.published += 1
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Error publicando mensaje WebSocket en Redis: {e}")
+
+    async def _sync_subscriptions(self, pubsub):
+        added = self._wanted - self._subscribed
+        removed = self._subscribed - self._wanted
+        if added:
+            await pubsub.subscribe(*added)
+            self._subscribed |= added
+        if removed:
+            await pubsub.unsubscribe(*removed)
+            self._subscribed -= removed
+
+    def _handle(self, raw: str):
+        try:
+            envelope = json.loads(raw)
+        except ValueError:
+            logger.error("Mensaje WebSocket inválido en Redis")
+            return
+        if envelope.get("origin") == self.process_id or self._deliver is None:
+            return
+        self.received += 1
+        self._deliver(envelope["payload"], envelope.get("org_id"), envelope.get("event_id"))
+
+    async def _listen(self):
+        while True:
+            client = self._get_client()
+            if client is None:
+                return
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            self._subscribed = set()
+            try:
+                logger.info("📡 Escuchando mensajes WebSocket de otros procesos")
+                while True:
+                    await self._sync_subscriptions(pubsub)
+                    message = await pubsub.get_message(timeout=self.POLL_TIMEOUT)
+                    if message and message.get("type") == "message":
+                        self._handle(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"❌ Suscripción WebSocket en Redis interrumpida: {e}")
+                await asyncio.sleep(self.RETRY_DELAY)
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+
+    def stats(self) -> dict:
+        return {
+            "broker": self.name,
+            "subscribed_channels": len(self._subscribed),
+            "published": self.published,
+            "received": self.received,
+            "errors": self.errors,
+        }
+
+
+def create_broker():
+    """Broker según WS_BROKER (en memoria si no hay Redis)"""
+    if WS_BROKER == "redis" and REDIS_URL:
+        return RedisBroker()
+    return InMemoryBroker()
@@ -0,0 +1,141 @@
+"""
+Caché con recálculo único (single-flight) y stale-while-revalidate.
+
+Sobre cache_get/cache_set de redis_client:
+
+- ``key`` guarda el valor fresco con TTL corto (soft TTL). Se puede seguir
+  invalidando como siempre (borrando la clave).
+- ``swr:{key}`` guarda el último valor bueno con TTL largo (hard TTL).
+
+Si el valor fresco no existe pero hay uno viejo, se responde con el viejo y se
+recalcula en segundo plano. Si no hay ninguno, solo una petición recalcula:
+dentro del proceso las demás esperan la misma tarea (asyncio), y entre
+procesos un lock en Redis (SET NX) hace que los otros dynos esperen el
+resultado en vez de repetir las consultas.
+"""
+import asyncio
+import logging
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from redis_client import cache_get, cache_set, get_redis_client, release_lock
+
+logger = logging.getLogger(__name__)
+
+STALE_PREFIX = "swr:"
+LOCK_PREFIX = "lock:"
+# Segundos máximos que un recálculo puede retener el lock
+LOCK_TTL = 30
+# Espera (segundos) por el resultado de otro proceso antes de calcular aquí
+LOCK_WAIT = 5.0
+LOCK_POLL_INTERVAL = 0.1
+
+# Recálculos en curso en este proceso: clave -> tarea
+_inflight: Dict[str, asyncio.Task] = {}
+
+
+def _acquire_lock(key: str) -> Optional[str]:
+    """Lock distribuido. Retorna el token, "" si Redis no está disponible o None si otro lo tiene"""
+    r = get_redis_client()
+    if not r:
+        return ""
+    token = uuid.uuid4().hex
+    try:
+        if r.set(f"{LOCK_PREFIX}{key}", token, nx=True, ex=LOCK_TTL):
+            return token
+        return None
+    except Exception as e:
+        logger.error(f"Error adquiriendo lock de caché ({key}): {e}")
+        return ""
+
+
+def _release_lock(key: str, token: str):
+    """Libera el lock solo si sigue siendo nuestro (comparar y borrar atómico)"""
+    release_lock(f"{LOCK_PREFIX}{key}", token)
+
+
+def _store(key: str, stale_key: str, value: Any, soft_ttl: int, hard_ttl: int):
+    cache_set(key, value, ttl=soft_ttl)
+    cache_set(stale_key, value, ttl=hard_ttl)
+
+
+async def _recompute(
+    key: str,
+    stale_key: str,
+    compute: Callable[[], Awaitable[Any]],
+    soft_ttl: int,
+    hard_ttl: int,
+    wait_for_peer: bool
+) -> Any:
+    token = _acquire_lock(key)
+    if token is None:
+        if not wait_for_peer:
+            # Otro proceso ya está recalculando (refresco en segundo plano)
+            return None
+        deadline = time.monotonic() + LOCK_WAIT
+        while time.monotonic() < deadline:
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+            value = cache_get(key)
+            if value is not None:
+                return value
+        logger.warning(f"⚠️ Tiempo de espera agotado para {key}, recalculando localmente")
+
+    try:
+        value = await compute()
+        _store(key, stale_key, value, soft_ttl, hard_ttl)
+        return value
+    finally:
+        if token:
+            _release_lock(key, token)
+
+
+def _start(key: str, coro) -> asyncio.Task:
+    task = asyncio.get_running_loop().create_task(coro)
+    _inflight[key] = task
+
+    def _done(t: asyncio.Task):
+        if _inflight.get(key) is t:
+            del _inflight[key]
+        if not t.cancelled() and t.exception() is not None:
+            logger.error(f"❌ Error recalculando {key}: {t.exception()}")
+
+    task.add_done_callback(_done)
+    return task
+
+
+async def get_or_compute(
+    key: str,
+    compute: Callable[[], Awaitable[Any]],
+    soft_ttl: int = 300,
+    hard_ttl: int = 3600,
+    stale_key: Optional[str] = None
+) -> Any:
+    """
+    Valor cacheado en `key`; si no está fresco lo recalcula con `compute`
+    (corrutina sin argumentos) evitando recálculos simultáneos.
+
+    `stale_key` (por defecto swr:{key}) debe ser estable entre generaciones
+    si `key` es versionada, para poder servir el valor anterior tras invalidar.
+    """
+    stale_key = stale_key or f"{STALE_PREFIX}{key}"
+    value = cache_get(key)
+    if value is not None:
+        return value
+
+    stale = cache_get(stale_key)
+    if stale is not None:
+        if key not in _inflight:
+            logger.info(f"♻️ Sirviendo {key} viejo, refrescando en segundo plano")
+            _start(key, _recompute(key, stale_key, compute, soft_ttl, hard_ttl, wait_for_peer=False))
+        return stale
+
+    task = _inflight.get(key)
+    if task is not None:
+        # shield: si esta petición se cancela, las demás siguen esperando la tarea
+        value = await asyncio.shield(task)
+        if value is not None:
+            return value
+
+    task = _inflight.get(key) or _start(key, _recompute(key, stale_key, compute, soft_ttl, hard_ttl, wait_for_peer=True))
+    return await asyncio.shield(task)
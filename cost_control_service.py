@@ -164,7 +164,8 @@ class CostControlService:
         db: Session
     ) -> OpenAICostInfo:
         """
-        Registra el uso de OpenAI y actualiza la factura
+        Registra el uso de OpenAI en la factura (sin confirmar: lo hace quien
+        guarda la factura procesada)
         """
         total_tokens = input_tokens + output_tokens
         cost = self.calculate_cost(model, input_tokens, output_tokens)
@@ -176,8 +177,6 @@ class CostControlService:
         invoice.openai_model_used = model
         invoice.openai_processing_time = processing_time
         
-        db.commit()
-        
         cost_info = OpenAICostInfo(
             tokens_used=total_tokens,
             cost_usd=cost,
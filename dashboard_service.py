@@ -0,0 +1,190 @@
+"""
+Feed incremental del dashboard.
+
+En vez de reenviar el blob completo de /statistics, cada cambio de facturas
+confirmado (alta, procesamiento, edición, borrado) se traduce en un mensaje
+``dashboard_delta`` pequeño por organización:
+
+- ``counters``: incrementos de los totales (facturas, procesadas, alertas,
+  confianza, costo, tokens).
+- ``daily_processed`` / ``alert_categories`` / ``models``: incrementos por
+  día, categoría de alerta y modelo.
+- ``rows``: filas de la tabla (mismos campos que /invoices) a insertar o
+  reemplazar, e ids eliminados.
+
+Los deltas salen de los mismos agregados que mantiene statistics_service.py
+(``ROLLUP_CHANGES_KEY``), así que no hay consultas extra. Los cambios se
+acumulan por organización durante ``DASHBOARD_FLUSH_INTERVAL`` segundos y se
+envían en un solo mensaje (un lote de 200 facturas es un mensaje, no 200).
+El frontend aplica los deltas sobre lo que ya tiene cargado.
+"""
+import asyncio
+import logging
+import threading
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import INVOICE_LIST_FIELDS, invoice_row_to_dict
+from statistics_service import ALERT_CATEGORY_COLUMNS, ROLLUP_CHANGES_KEY
+from websocket_service import websocket_manager
+
+logger = logging.getLogger(__name__)
+
+DASHBOARD_FLUSH_INTERVAL = 0.25
+
+_COUNTER_FIELDS = ("invoices", "processed", "alerts", "confidence_sum", "confidence_count", "cost_usd", "tokens")
+_MODEL_FIELDS = ("invoices", "cost_usd", "tokens")
+_CATEGORY_BY_COLUMN = {column: category for category, column in ALERT_CATEGORY_COLUMNS.items()}
+
+
+def _empty_delta() -> Dict[str, Any]:
+    return {
+        "counters": defaultdict(float),
+        "daily_processed": defaultdict(int),
+        "alert_categories": defaultdict(int),
+        "models": defaultdict(lambda: defaultdict(float)),
+        "upsert": {},
+        "delete": set(),
+    }
+
+
+def _merge_rollup(delta: Dict[str, Any], day, model: str, values: Dict[str, Any]):
+    for field in _COUNTER_FIELDS:
+        if values.get(field):
+            delta["counters"][field] += values[field]
+    if values.get("processed"):
+        delta["daily_processed"][day.isoformat()] += values["processed"]
+    for column, category in _CATEGORY_BY_COLUMN.items():
+        if values.get(column):
+            delta["alert_categories"][category] += values[column]
+    for field in _MODEL_FIELDS:
+        if values.get(field):
+            delta["models"][model][field] += values[field]
+
+
+def _serialize(delta: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Mensaje compacto (sin ceros); None si no cambió nada visible"""
+    def nonzero(values):
+        return {key: value for key, value in values.items() if value}
+
+    def with_ints(values):
+        # Solo costo y confianza son decimales
+        return {key: value if key in ("cost_usd", "confidence_sum") else int(value) for key, value in values.items()}
+
+    models = {model: with_ints(nonzero(values)) for model, values in delta["models"].items()}
+    data = {
+        "counters": with_ints(nonzero(delta["counters"])),
+        "daily_processed": nonzero(delta["daily_processed"]),
+        "alert_categories": nonzero(delta["alert_categories"]),
+        "models": {model: values for model, values in models.items() if values},
+        "rows": {
+            "upsert": list(delta["upsert"].values()),
+            "delete": sorted(delta["delete"]),
+        },
+    }
+    if not any((data["counters"], data["daily_processed"], data["alert_categories"], data["models"],
+                data["rows"]["upsert"], data["rows"]["delete"])):
+        return None
+    return data
+
+
+class DashboardFeed:
+    """Acumula los cambios confirmados por organización y los envía por lotes"""
+
+    def __init__(self, flush_interval: float = DASHBOARD_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._pending: Dict[int, Dict[str, Any]] = {}
+        # Los commits llegan desde el event loop, el threadpool o el escritor serializado
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self.sent = 0
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        if self._task is not None and not self._task.done() and self._loop is loop:
+            return
+        self._loop = loop
+        self._wakeup = asyncio.Event()
+        self._task = loop.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None or self._loop is not asyncio.get_running_loop():
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self.flush()
+
+    def record(self, changes: Dict[str, Any]):
+        """Agrega los cambios de una transacción confirmada (ver ROLLUP_CHANGES_KEY)"""
+        if self._loop is None:
+            # Sin feed iniciado (scripts, migraciones): nadie escucha
+            return
+        with self._lock:
+            for deltas in changes["deltas"]:
+                for (org_id, day, model), values in deltas.items():
+                    delta = self._pending.setdefault(org_id, _empty_delta())
+                    _merge_rollup(delta, day, model, values)
+            for invoice_id, row in changes["rows"].items():
+                delta = self._pending.setdefault(row.organization_id, _empty_delta())
+                delta["upsert"][invoice_id] = invoice_row_to_dict(row, INVOICE_LIST_FIELDS)
+                delta["delete"].discard(invoice_id)
+            for invoice_id, org_id in changes["deleted"].items():
+                delta = self._pending.setdefault(org_id, _empty_delta())
+                delta["upsert"].pop(invoice_id, None)
+                delta["delete"].add(invoice_id)
+        try:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+        except RuntimeError:
+            # Loop cerrado (apagado)
+            pass
+
+    async def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        for org_id, delta in pending.items():
+            data = _serialize(delta)
+            if org_id is None or data is None:
+                continue
+            await websocket_manager.broadcast({
+                "type": "dashboard_delta",
+                "data": data,
+                "day": datetime.utcnow().date().isoformat()
+            }, org_id=org_id)
+            self.sent += 1
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            # Junta los commits de la ventana en un solo mensaje por organización
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"❌ Error enviando deltas del dashboard: {e}")
+
+
+dashboard_feed = DashboardFeed()
+
+
+# ===========================================
+# EVENTOS DE SESIÓN
+# ===========================================
+
+@event.listens_for(Session, "after_commit")
+def _publish_dashboard_changes(session: Session):
+    changes = session.info.pop(ROLLUP_CHANGES_KEY, None)
+    if changes:
+        dashboard_feed.record(changes)
@@ -0,0 +1,141 @@
+"""
+Borrado masivo de facturas y purga de archivos en segundo plano.
+
+``delete_invoices`` borra por bloques con un ``DELETE ... RETURNING file_path``
+en vez de cargar y eliminar fila por fila. Al no pasar por el ORM, limpia a
+mano lo que los eventos harían: alertas (invoice_audit_flags), líneas
+(invoice_line_items), notificaciones de las facturas y los agregados diarios.
+
+Los archivos se eliminan después de confirmar, fuera de la petición: ``file_purger``
+los borra en un hilo y reintenta con espera creciente si el disco falla.
+"""
+import asyncio
+import logging
+import os
+from typing import Iterable, List, Optional, Sequence, Set, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+
+from models import Invoice, InvoiceAuditFlag, InvoiceLineItem, Notification
+from statistics_service import TRACKED_COLUMNS, remove_invoice_contributions
+
+logger = logging.getLogger(__name__)
+
+# Facturas por sentencia (acota el tamaño del IN)
+DELETE_CHUNK_SIZE = 500
+PURGE_MAX_ATTEMPTS = 5
+# Segundos antes del primer reintento (se duplica en cada intento)
+PURGE_RETRY_DELAY = 2.0
+
+
+def delete_invoices(db: Session, org_id: int, invoice_ids: Sequence[int]) -> Tuple[int, List[str]]:
+    """
+    Borra las facturas indicadas de la organización junto con sus datos
+    dependientes. No confirma la transacción.
+    Retorna (facturas borradas, rutas de archivo a purgar).
+    """
+    ids = sorted(set(invoice_ids))
+    conn = db.connection()
+    deleted_count = 0
+    file_paths: List[str] = []
+
+    for start in range(0, len(ids), DELETE_CHUNK_SIZE):
+        chunk = ids[start:start + DELETE_CHUNK_SIZE]
+        # Estado previo para restar su aporte a los agregados
+        rows = conn.execute(
+            select(*TRACKED_COLUMNS).where(Invoice.id.in_(chunk), Invoice.organization_id == org_id)
+        ).fetchall()
+        if not rows:
+            continue
+        owned_ids = [row.id for row in rows]
+
+        conn.execute(delete(InvoiceAuditFlag).where(InvoiceAuditFlag.invoice_id.in_(owned_ids)))
+        conn.execute(delete(InvoiceLineItem).where(InvoiceLineItem.invoice_id.in_(owned_ids)))
+        conn.execute(delete(Notification).where(
+            Notification.invoice_id.in_(owned_ids),
+            Notification.organization_id == org_id
+        ))
+
+        stmt = delete(Invoice).where(Invoice.id.in_(owned_ids), Invoice.organization_id == org_id)
+        if conn.dialect.delete_returning:
+            deleted = conn.execute(stmt.returning(Invoice.id, Invoice.file_path)).fetchall()
+        else:
+            deleted = conn.execute(
+                select(Invoice.id, Invoice.file_path).where(Invoice.id.in_(owned_ids))
+            ).fetchall()
+            conn.execute(stmt)
+
+        deleted_ids = {row.id for row in deleted}
+        remove_invoice_contributions(db, [row for row in rows if row.id in deleted_ids])
+        file_paths.extend(row.file_path for row in deleted if row.file_path)
+        deleted_count += len(deleted)
+
+    return deleted_count, file_paths
+
+
+class FilePurger:
+    """Cola de archivos a eliminar del disco, con reintentos"""
+
+    def __init__(self, max_attempts: int = PURGE_MAX_ATTEMPTS, retry_delay: float = PURGE_RETRY_DELAY):
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._retries: Set[asyncio.Task] = set()
+        self.purged = 0
+        self.failed = 0
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        if self._task is not None and not self._task.done() and self._loop is loop:
+            return
+        self._loop = loop
+        self._queue = asyncio.Queue()
+        self._task = loop.create_task(self._run())
+
+    def enqueue(self, paths: Iterable[str]):
+        """Programa el borrado de los archivos (llamar tras confirmar en BD)"""
+        self.start()
+        for path in paths:
+            self._queue.put_nowait((path, 1))
+
+    async def join(self):
+        """Espera a que la cola quede vacía (incluye reintentos pendientes)"""
+        if self._queue is None:
+            return
+        while True:
+            await self._queue.join()
+            if not self._retries:
+                return
+            await asyncio.gather(*self._retries)
+
+    async def _run(self):
+        while True:
+            path, attempt = await self._queue.get()
+            try:
+                await run_in_threadpool(os.remove, path)
+                self.purged += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                if attempt >= self.max_attempts:
+                    self.failed += 1
+                    logger.error(f"❌ No se pudo eliminar {path} tras {attempt} intentos: {e}")
+                else:
+                    delay = self.retry_delay * 2 ** (attempt - 1)
+                    logger.warning(f"⚠️ Error eliminando {path} (intento {attempt}), reintentando en {delay:.0f}s: {e}")
+                    retry = self._loop.create_task(self._retry_later(path, attempt + 1, delay))
+                    self._retries.add(retry)
+                    retry.add_done_callback(self._retries.discard)
+            finally:
+                self._queue.task_done()
+
+    async def _retry_later(self, path: str, attempt: int, delay: float):
+        await asyncio.sleep(delay)
+        self._queue.put_nowait((path, attempt))
+
+
+file_purger = FilePurger()
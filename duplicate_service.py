@@ -0,0 +1,280 @@
+"""
+Detección de facturas duplicadas.
+
+Dos chequeos, ambos por igualdad sobre columnas indexadas por organización:
+
+- Antes de extraer: ``content_hash`` (SHA-256 del archivo). Si la misma
+  imagen/PDF ya se procesó, se reutiliza su extracción y no se paga otra
+  llamada a OpenAI.
+- Después de extraer: ``duplicate_fingerprint`` (RNC o proveedor
+  normalizado + NCF + monto redondeado, ver
+  ``Invoice.build_duplicate_fingerprint``), que no depende de cómo se
+  escribió el nombre del proveedor.
+
+Con Redis, cada organización tiene además un filtro de Bloom
+(``dupbloom:<org>``) con las huellas y hashes de sus facturas procesadas: la
+gran mayoría de facturas no son duplicadas y se descartan sin consultar la
+BD; un positivo se confirma con la consulta indexada. El filtro se construye
+desde la BD la primera vez, en un hilo aparte (mientras tanto se consulta el
+índice), y se alimenta al confirmar cada factura procesada (evento de
+sesión), también durante la construcción para no perder las que el recorrido
+ya dejó atrás. Las facturas borradas quedan en el filtro: solo cuestan una
+consulta de más. Sin Redis se consulta directamente el índice.
+
+``find_duplicates`` resuelve un lote entero con una sola consulta e incluye
+los duplicados dentro del mismo lote.
+"""
+import hashlib
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import Invoice, SessionLocal
+from redis_client import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+BLOOM_KEY_PREFIX = "dupbloom"
+# 2^20 bits (128 KB por organización): ~1% de falsos positivos con ~100k claves
+BLOOM_BITS = 1 << 20
+BLOOM_HASHES = 7
+# Bit extra que marca el filtro como construido (se pierde junto con el filtro)
+BLOOM_READY_BIT = BLOOM_BITS
+BLOOM_BUILD_BATCH = 5000
+# Marca "en construcción" (expira si el proceso muere a mitad)
+BLOOM_BUILDING_TTL = 600
+
+# Un solo hilo: las construcciones son raras y no compiten por la BD
+_build_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dupbloom")
+
+DUPLICATE_PREFIX = "DUPLICADO"
+
+
+def file_content_hash(file_path: Optional[str]) -> Optional[str]:
+    """SHA-256 del archivo (None si no existe)"""
+    if not file_path:
+        return None
+    digest = hashlib.sha256()
+    try:
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def duplicate_warning(existing_id: int) -> str:
+    return f"{DUPLICATE_PREFIX}: Ya existe la factura #{existing_id}"
+
+
+def add_duplicate_warning(extracted_data: Dict[str, Any], existing_id: int):
+    """Antepone la alerta de duplicado a audit_warnings"""
+    warnings = extracted_data.get('audit_warnings', [])
+    if not isinstance(warnings, list):
+        warnings = []
+    warnings.insert(0, duplicate_warning(existing_id))
+    extracted_data['audit_warnings'] = warnings
+
+
+# ===========================================
+# FILTRO DE BLOOM POR ORGANIZACIÓN
+# ===========================================
+
+def _bloom_key(org_id: int) -> str:
+    return f"{BLOOM_KEY_PREFIX}:{org_id}"
+
+
+def _positions(value: str) -> List[int]:
+    digest = hashlib.sha256(value.encode("utf-8")).digest()
+    h1 = int.from_bytes(digest[:8], "big")
+    h2 = int.from_bytes(digest[8:16], "big") | 1
+    return [(h1 + i * h2) % BLOOM_BITS for i in range(BLOOM_HASHES)]
+
+
+def _bloom_add(r, org_id: int, values: Iterable[str]):
+    pipe = r.pipeline(transaction=False)
+    key = _bloom_key(org_id)
+    pending = 0
+    for value in values:
+        for position in _positions(value):
+            pipe.setbit(key, position, 1)
+            pending += 1
+        if pending >= 10000:
+            pipe.execute()
+            pending = 0
+    if pending:
+        pipe.execute()
+
+
+def _building_key(org_id: int) -> str:
+    return f"{_bloom_key(org_id)}:building"
+
+
+def _build_bloom(org_id: int):
+    """Carga en el filtro las huellas y hashes de las facturas procesadas"""
+    r = get_redis_client()
+    if not r:
+        return
+    db = SessionLocal()
+    try:
+        last_id = 0
+        while True:
+            rows = db.query(Invoice.id, Invoice.duplicate_fingerprint, Invoice.content_hash).filter(
+                Invoice.organization_id == org_id,
+                Invoice.processed == True,
+                Invoice.id > last_id
+            ).order_by(Invoice.id).limit(BLOOM_BUILD_BATCH).all()
+            if not rows:
+                break
+            _bloom_add(r, org_id, [value for row in rows for value in row[1:] if value])
+            last_id = rows[-1][0]
+        r.setbit(_bloom_key(org_id), BLOOM_READY_BIT, 1)
+        logger.info(f"🌸 Filtro de duplicados construido (org {org_id})")
+    except Exception as e:
+        logger.error(f"Error construyendo filtro de duplicados (org {org_id}): {e}")
+    finally:
+        db.close()
+        try:
+            r.delete(_building_key(org_id))
+        except Exception:
+            pass
+
+
+def _schedule_build(r, org_id: int):
+    """Lanza la construcción en segundo plano si nadie la está haciendo ya"""
+    # La marca va antes del recorrido: desde aquí remember_invoices alimenta
+    # el filtro y ninguna factura confirmada durante la construcción se pierde
+    if r.set(_building_key(org_id), 1, nx=True, ex=BLOOM_BUILDING_TTL):
+        _build_executor.submit(_build_bloom, org_id)
+
+
+def _bloom_filter(db: Session, org_id: int, values: List[str]) -> List[str]:
+    """Valores que podrían existir ya (todos si el filtro no está disponible)"""
+    r = get_redis_client()
+    if not r or not values:
+        return values
+    try:
+        key = _bloom_key(org_id)
+        if not r.getbit(key, BLOOM_READY_BIT):
+            # Sin filtro todavía: se consulta el índice en lugar de esperar
+            _schedule_build(r, org_id)
+            return values
+        pipe = r.pipeline(transaction=False)
+        for value in values:
+            for position in _positions(value):
+                pipe.getbit(key, position)
+        bits = pipe.execute()
+        return [
+            value for i, value in enumerate(values)
+            if all(bits[i * BLOOM_HASHES:(i + 1) * BLOOM_HASHES])
+        ]
+    except Exception as e:
+        logger.error(f"Error consultando filtro de duplicados: {e}")
+        return values
+
+
+def remember_invoices(entries: Iterable[Tuple[int, Optional[str], Optional[str]]]):
+    """Agrega (org_id, huella, hash) al filtro de su organización (construido o en construcción)"""
+    r = get_redis_client()
+    if not r:
+        return
+    by_org: Dict[int, List[str]] = {}
+    for org_id, fingerprint, content_hash in entries:
+        if org_id is not None:
+            by_org.setdefault(org_id, []).extend(v for v in (fingerprint, content_hash) if v)
+    try:
+        for org_id, values in by_org.items():
+            if not values:
+                continue
+            # Sin construir ni en construcción: se cargará completo desde la BD
+            if r.getbit(_bloom_key(org_id), BLOOM_READY_BIT) or r.exists(_building_key(org_id)):
+                _bloom_add(r, org_id, values)
+    except Exception as e:
+        logger.error(f"Error actualizando filtro de duplicados: {e}")
+
+
+# ===========================================
+# CHEQUEO POR LOTES
+# ===========================================
+
+def find_duplicates(db: Session, org_id: int, column, values: Dict[int, Optional[str]]) -> Dict[int, int]:
+    """
+    Para {invoice_id: valor de `column`} (Invoice.duplicate_fingerprint o
+    Invoice.content_hash) retorna {invoice_id: id de la factura original}.
+    Original es la factura procesada más antigua con el mismo valor o, dentro
+    del lote, la de menor id.
+    """
+    values = {invoice_id: value for invoice_id, value in values.items() if value}
+    if not values:
+        return {}
+
+    originals: Dict[str, int] = {}
+    candidates = _bloom_filter(db, org_id, sorted(set(values.values())))
+    if candidates:
+        rows = db.query(Invoice.id, column).filter(
+            Invoice.organization_id == org_id,
+            column.in_(candidates),
+            Invoice.processed == True,
+            Invoice.id.notin_(list(values))
+        ).order_by(Invoice.id).all()
+        for existing_id, value in rows:
+            originals.setdefault(value, existing_id)
+
+    duplicates = {}
+    for invoice_id in sorted(values):
+        value = values[invoice_id]
+        if value in originals:
+            duplicates[invoice_id] = originals[value]
+        else:
+            originals[value] = invoice_id
+    return duplicates
+
+
+def reusable_extraction(db: Session, original_id: int) -> Optional[Dict[str, Any]]:
+    """Datos extraídos de la factura original (sin sus alertas de duplicado)"""
+    raw = db.query(Invoice.raw_extracted_data).filter(Invoice.id == original_id).scalar()
+    try:
+        extracted_data = json.loads(raw) if raw else None
+    except ValueError:
+        return None
+    if not isinstance(extracted_data, dict) or "error" in extracted_data:
+        return None
+    warnings = extracted_data.get('audit_warnings')
+    if isinstance(warnings, list):
+        extracted_data['audit_warnings'] = [w for w in warnings if not str(w).startswith(DUPLICATE_PREFIX)]
+    return extracted_data
+
+
+# ===========================================
+# EVENTOS DE SESIÓN
+# ===========================================
+
+_PROCESSED_KEY = "_duplicate_bloom_entries"
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_processed_invoices(session: Session, flush_context):
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Invoice) and obj.processed and (obj.duplicate_fingerprint or obj.content_hash):
+            session.info.setdefault(_PROCESSED_KEY, []).append(
+                (obj.organization_id, obj.duplicate_fingerprint, obj.content_hash)
+            )
+
+
+@event.listens_for(Session, "after_commit")
+def _remember_processed_invoices(session: Session):
+    entries = session.info.pop(_PROCESSED_KEY, None)
+    if entries:
+        remember_invoices(entries)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_processed_invoices(session: Session, previous_transaction):
+    if previous_transaction.nested:
+        return
+    session.info.pop(_PROCESSED_KEY, None)
@@ -3,15 +3,25 @@ import io
 import json
 import os
 from datetime import datetime, timedelta
-from typing import List, Optional
+from typing import Dict, List, Optional
 from models import Invoice
 from openpyxl import Workbook
 import xlrd
 from xlutils.copy import copy as xl_copy
 
 class ExportService:
-    def export_dgii_606(self, invoices: List[Invoice], report_rnc: Optional[str] = None, period: Optional[str] = None) -> bytes:
-        """Exportación XLS usando la plantilla oficial DGII 606 (plantilla_excel/formulario.xls)."""
+    def export_dgii_606(
+        self,
+        invoices: List[Invoice],
+        report_rnc: Optional[str] = None,
+        period: Optional[str] = None,
+        line_item_totals: Optional[Dict[int, float]] = None
+    ) -> bytes:
+        """
+        Exportación XLS usando la plantilla oficial DGII 606 (plantilla_excel/formulario.xls).
+        `line_item_totals` (id de factura -> suma de subtotales, desde invoice_line_items)
+        evita recorrer el JSON de líneas de cada factura para calcular la base.
+        """
         template_path = os.path.join(os.path.dirname(__file__), "plantilla_excel", "formulario.xls")
         if not os.path.exists(template_path):
             raise FileNotFoundError("No se encontró la plantilla oficial para DGII 606.")
@@ -57,7 +67,10 @@ class ExportService:
             if total is not None and tax is not None:
                 base = total - tax
             if base is None or base < 0:
-                base = self._sum_line_items(raw.get("line_items"))
+                if line_item_totals is not None:
+                    base = line_item_totals.get(inv.id)
+                else:
+                    base = self._sum_line_items(raw.get("line_items"))
             if base is None:
                 base = 0.0
 
@@ -4,19 +4,40 @@ from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
+from sqlalchemy import inspect as sa_inspect
 from sqlalchemy import func, desc, or_
-from models import get_db, Invoice, Base, engine, init_database, Setting, UserSetting, Notification, User, WebhookEndpoint, Organization
+from models import get_db, Invoice, Base, engine, init_database, Setting, UserSetting, OrganizationSetting, Notification, User, WebhookEndpoint, Organization, WhatsAppSender
+from models import SessionLocal, get_async_db
+from models import current_user_id, get_read_session, get_async_read_session, replica_lag_monitor
+from models import parse_invoice_fields, invoice_list_columns, invoice_row_to_dict, InvoiceAuditFlag
 from openai_service import OpenAIInvoiceProcessor
 from websocket_service import websocket_manager, start_heartbeat_task
 from whatsapp_service import WhatsAppService
 from cost_control_service import CostControlService
 from webhook_sender import WebhookSender
 from export_service import ExportService
-from auth import verify_password, create_access_token, get_password_hash, get_current_active_user, SECRET_KEY, ALGORITHM
-from jose import jwt, JWTError
-from redis_client import cache_get, cache_set, invalidate_cache_pattern, get_cache_stats
+from auth import verify_password, create_access_token, get_password_hash, get_current_active_user
+from auth import Principal, principal_from_token
+from redis_client import cache_get, cache_set, get_cache_stats, versioned_key
+from redis_client import tiered_get, tiered_set, start_invalidation_listener
+from pagination import paginate_keyset, encode_cursor, encode_offset_cursor, decode_offset_cursor, estimate_count, count_cache_key
+from search_service import apply_search
+from cache_service import get_or_compute, STALE_PREFIX
+from settings_service import get_setting, grouped_settings, notify_settings_changed
+from writer_service import run_write, writer
+from deletion_service import delete_invoices, file_purger
+from notification_service import adjust_unread_count, get_unread_count, notification_writer, reset_unread_count
+from duplicate_service import add_duplicate_warning, file_content_hash, find_duplicates, reusable_extraction
+from archive_service import restore_invoice, run_archival, search_archived, start_archival_task
+from dashboard_service import dashboard_feed
+from whatsapp_routing_service import normalize_phone, resolve_sender
+from statistics_service import get_rollup_statistics, ALERT_CATEGORY_COLUMNS, recent_alert_invoice_ids, audit_flag_breakdown
+from statistics_service import item_spend_summary, line_item_subtotals
 import os
 import shutil
+import copy
 from datetime import datetime, timedelta
 import json
 from typing import List, Optional, Dict, Any, Union
@@ -45,40 +66,34 @@ webhook_sender = WebhookSender()
 export_service = ExportService()
 
 # --- AUTH HELPER FOR COOKIES ---
-async def get_current_user_from_cookie(request: Request, db: Session = Depends(get_db)):
+async def get_current_principal(request: Request, db: Session = Depends(get_db)) -> Optional[Principal]:
+    """Dependencia única de autenticación: principal cacheado a partir de la cookie"""
+    principal = principal_from_token(request.cookies.get("access_token"), db)
+    # Para read-your-writes: las escrituras confirmadas en esta petición se marcan a su nombre
+    current_user_id.set(principal.id if principal else None)
+    return principal
+
+async def get_current_principal_async(request: Request, db: AsyncSession = Depends(get_async_db)) -> Optional[Principal]:
+    """
+    get_current_principal para endpoints con AsyncSession: si el principal no
+    está en caché se consulta por la misma sesión asíncrona del request, sin
+    abrir una sesión síncrona ni bloquear el event loop.
+    """
     token = request.cookies.get("access_token")
-    if not token:
-        return None
-    
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            return None
-    except JWTError:
-        return None
-    
-    user = db.query(User).filter(User.email == email).first()
-    if not user or not user.is_active:
-        return None
-        
-    return user
+    principal = await db.run_sync(lambda sync_db: principal_from_token(token, sync_db))
+    current_user_id.set(principal.id if principal else None)
+    return principal
 
-async def get_current_user_from_websocket(websocket: WebSocket, db: Session):
-    token = websocket.cookies.get("access_token")
-    if not token:
-        return None
+def get_read_db(user: Optional[Principal] = Depends(get_current_principal)):
+    """Sesión para lecturas pesadas: réplica si está disponible (ver models.get_read_session)"""
+    db = get_read_session(user.id if user else None)
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            return None
-    except JWTError:
-        return None
-    user = db.query(User).filter(User.email == email).first()
-    if not user or not user.is_active:
-        return None
-    return user
+        yield db
+    finally:
+        db.close()
+
+async def get_current_user_from_websocket(websocket: WebSocket, db: Session) -> Optional[Principal]:
+    return principal_from_token(websocket.cookies.get("access_token"), db)
 
 # Exception Handlers
 @app.exception_handler(404)
@@ -131,13 +146,42 @@ async def startup_event():
     finally:
         db.close()
     
+    # Invalidaciones de la caché local publicadas por otros procesos
+    start_invalidation_listener()
+
+    # Escritor serializado (solo en modo SQLite, ver writer_service.py)
+    if writer is not None:
+        writer.start()
+
+    # Retraso de la réplica medido en segundo plano (ver models.get_read_session)
+    replica_lag_monitor.start()
+
+    # Broadcasts WebSocket de otros procesos (Redis pub/sub, ver broker_service.py)
+    await websocket_manager.start_broker()
+    # Deltas del dashboard tras cada cambio de facturas
+    dashboard_feed.start()
+
     # Iniciar tarea de heartbeat para WebSocket
     import asyncio
     asyncio.create_task(start_heartbeat_task())
+
+    # Retención: archivar facturas fuera de storage_retention_days
+    asyncio.create_task(start_archival_task())
     
     logger.info("✅ Aplicación iniciada correctamente")
     logger.info("📡 WebSocket habilitado para notificaciones en tiempo real")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Confirmar las escrituras encoladas antes de salir
+    await notification_writer.stop()
+    if writer is not None:
+        await writer.stop()
+    await file_purger.join()
+    await dashboard_feed.stop()
+    await websocket_manager.stop_broker()
+    await replica_lag_monitor.stop()
+
 
 
 # Crear directorios necesarios si no existen
@@ -159,20 +203,43 @@ def get_default_org(db: Session) -> Organization:
         db.refresh(org)
     return org
 
-def get_org_id(user: Optional[User], db: Session) -> int:
+# Las organizaciones casi no cambian: se leen de la caché en memoria/Redis
+ORG_CACHE_TTL = 600
+
+def get_org_id(user: Optional[Principal], db: Session) -> int:
     if user and user.organization_id:
         return user.organization_id
-    return get_default_org(db).id
+    org_id = tiered_get("org:default:id")
+    if org_id is None:
+        org_id = get_default_org(db).id
+        tiered_set("org:default:id", org_id, ttl=ORG_CACHE_TTL)
+    return org_id
+
+async def get_org_id_async(user: Optional[Principal], db: AsyncSession) -> int:
+    if user and user.organization_id:
+        return user.organization_id
+    return await db.run_sync(lambda sync_db: get_org_id(user, sync_db))
+
+def get_company_context(db: Session, user: Optional[Principal]) -> dict:
+    if user and user.company:
+        # Resuelto junto con el principal
+        return user.company
+    org_id = get_org_id(user, db)
+    cache_key = f"org:{org_id}:context"
+    context = tiered_get(cache_key)
+    if context is not None:
+        return context
 
-def get_company_context(db: Session, user: Optional[User]) -> dict:
-    org = db.query(Organization).filter(Organization.id == get_org_id(user, db)).first()
+    org = db.query(Organization).filter(Organization.id == org_id).first()
     if not org:
         org = get_default_org(db)
-    return {
+    context = {
         "company_name": org.name or "Mi Empresa S.A.",
         "company_tax_id": org.tax_id or "",
         "company_plan": org.plan or "Free Plan"
     }
+    tiered_set(cache_key, context, ttl=ORG_CACHE_TTL)
+    return context
 
 # Inicializar servicios
 openai_processor = OpenAIInvoiceProcessor()
@@ -223,8 +290,30 @@ async def logout():
 class ChatRequest(BaseModel):
     query: str
 
+def get_finance_chat_context(db: Session, org_id: int) -> list:
+    """Contexto ligero para el chat financiero: últimas 50 facturas procesadas"""
+    # Optimizamos seleccionando solo campos relevantes para ahorrar tokens
+    invoices = db.query(Invoice).filter(
+        Invoice.processed == True,
+        Invoice.organization_id == org_id
+    ).order_by(desc(Invoice.invoice_date)).limit(50).all()
+
+    context_data = []
+    for inv in invoices:
+        context_data.append({
+            "fecha": inv.invoice_date.strftime("%Y-%m-%d") if inv.invoice_date else "N/A",
+            "proveedor": inv.vendor_name,
+            "total": inv.total_amount,
+            "moneda": inv.currency,
+            "tipo": inv.transaction_type, # expense/income
+            "categoria": inv.category
+        })
+    return context_data
+
+EMPTY_FINANCE_CHAT_ANSWER = "No veo ninguna factura registrada en el sistema aún. Sube algunas facturas para que pueda ayudarte con tus finanzas."
+
 @app.post("/api/chat/finance")
-async def chat_finance(request: ChatRequest, user: Optional[User] = Depends(get_current_user_from_cookie), db: Session = Depends(get_db)):
+async def chat_finance(request: ChatRequest, user: Optional[Principal] = Depends(get_current_principal), db: Session = Depends(get_read_db)):
     """
     Endpoint para chatear con los datos financieros (CFO Virtual)
     """
@@ -233,28 +322,11 @@ async def chat_finance(request: ChatRequest, user: Optional[User] = Depends(get_
     org_id = get_org_id(user, db)
 
     try:
-        # Obtener contexto: últimas 50 facturas procesadas
-        # Optimizamos seleccionando solo campos relevantes para ahorrar tokens
-        invoices = db.query(Invoice).filter(
-            Invoice.processed == True,
-            Invoice.organization_id == org_id
-        ).order_by(desc(Invoice.invoice_date)).limit(50).all()
-
-        # Construir contexto ligero
-        context_data = []
-        for inv in invoices:
-            context_data.append({
-                "fecha": inv.invoice_date.strftime("%Y-%m-%d") if inv.invoice_date else "N/A",
-                "proveedor": inv.vendor_name,
-                "total": inv.total_amount,
-                "moneda": inv.currency,
-                "tipo": inv.transaction_type, # expense/income
-                "categoria": inv.category
-            })
+        context_data = get_finance_chat_context(db, org_id)
         
         # Si no hay facturas, dar contexto vacío pero válido
         if not context_data:
-            return {"answer": "No veo ninguna factura registrada en el sistema aún. Sube algunas facturas para que pueda ayudarte con tus finanzas."}
+            return {"answer": EMPTY_FINANCE_CHAT_ANSWER}
 
         # Llamar al servicio de OpenAI
         answer = openai_processor.process_finance_chat(request.query, context_data, org_id=org_id, user_id=user.id)
@@ -265,27 +337,71 @@ async def chat_finance(request: ChatRequest, user: Optional[User] = Depends(get_
         logger.error(f"Error en chat finance: {e}")
         raise HTTPException(status_code=500, detail="Error procesando tu consulta financiera.")
 
+def _sse_event(payload: dict) -> str:
+    """Formatea un evento Server-Sent Events"""
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+@app.post("/api/chat/finance/stream")
+async def chat_finance_stream(request: ChatRequest, user: Optional[Principal] = Depends(get_current_principal), db: Session = Depends(get_read_db)):
+    """
+    Variante en streaming (SSE) del chat financiero.
+    Emite eventos {"type": "delta", "content": ...} a medida que OpenAI genera
+    tokens y termina con {"type": "done"}.
+    """
+    if not user:
+        raise HTTPException(status_code=401, detail="No autorizado")
+    org_id = get_org_id(user, db)
+    user_id = user.id
+
+    try:
+        context_data = get_finance_chat_context(db, org_id)
+    except Exception as e:
+        logger.error(f"Error en chat finance (streaming): {e}")
+        raise HTTPException(status_code=500, detail="Error procesando tu consulta financiera.")
+
+    async def event_stream():
+        if not context_data:
+            yield _sse_event({"type": "delta", "content": EMPTY_FINANCE_CHAT_ANSWER})
+        else:
+            async for delta in openai_processor.stream_finance_chat(request.query, context_data, org_id=org_id, user_id=user_id):
+                yield _sse_event({"type": "delta", "content": delta})
+        yield _sse_event({"type": "done"})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # ===========================================
 # GESTIÓN DE NOTIFICACIONES
 # ===========================================
 
 @app.get("/api/notifications")
-async def get_notifications(limit: int = 20, unread_only: bool = False, user: Optional[User] = Depends(get_current_user_from_cookie), db: Session = Depends(get_db)):
-    """Obtener notificaciones"""
+async def get_notifications(limit: int = 20, unread_only: bool = False, with_count: bool = False, user: Optional[Principal] = Depends(get_current_principal_async), db: AsyncSession = Depends(get_async_db)):
+    """
+    Obtener notificaciones recientes. Con with_count=true responde
+    {"unread_count", "items"} (contador en Redis, ver notification_service.py).
+    """
     if not user:
         raise HTTPException(status_code=401, detail="No autorizado")
-    org_id = get_org_id(user, db)
-    query = db.query(Notification).filter(Notification.organization_id == org_id)
+    org_id = await get_org_id_async(user, db)
+    limit = max(1, min(limit, 100))
+    query = select(Notification).filter(Notification.organization_id == org_id)
     
     if unread_only:
         query = query.filter(Notification.read == False)
         
-    notifications = query.order_by(desc(Notification.created_at)).limit(limit).all()
+    notifications = (await db.scalars(query.order_by(desc(Notification.created_at)).limit(limit))).all()
+    items = [n.to_dict() for n in notifications]
     
-    return [n.to_dict() for n in notifications]
+    if with_count:
+        unread_count = await db.run_sync(lambda session: get_unread_count(session, org_id))
+        return {"unread_count": unread_count, "items": items}
+    return items
 
 @app.post("/api/notifications/{notification_id}/read")
-async def mark_notification_read(notification_id: int, user: Optional[User] = Depends(get_current_user_from_cookie), db: Session = Depends(get_db)):
+async def mark_notification_read(notification_id: int, user: Optional[Principal] = Depends(get_current_principal), db: Session = Depends(get_db)):
     """Marcar notificación como leída"""
     if not user:
         raise HTTPException(status_code=401, detail="No autorizado")
@@ -294,18 +410,23 @@ async def mark_notification_read(notification_id: int, user: Optional[User] = De
     if not notification:
         raise HTTPException(status_code=404, detail="Notificación no encontrada")
     
+    was_unread = not notification.read
     notification.read = True
     db.commit()
+    if was_unread:
+        adjust_unread_count(org_id, -1)
     return {"status": "success"}
 
 @app.post("/api/notifications/read-all")
-async def mark_all_notifications_read(user: Optional[User] = Depends(get_current_user_from_cookie), db: Session = Depends(get_db)):
+async def mark_all_notifications_read(user: Optional[Principal] = Depends(get_current_principal), db: Session = Depends(get_db)):
     """Marcar todas las notificaciones como leídas"""
     if not user:
         raise HTTPException(status_code=401, detail="No autorizado")
     org_id = get_org_id(user, db)
     db.query(Notification).filter(Notification.read == False, Notification.organization_id == org_id).update({"read": True})
     db.commit()
+    # Se recalcula en la próxima lectura (pueden haber llegado nuevas)
+    reset_unread_count(org_id)
     return {"status": "success"}
 
 # ===========================================
@@ -317,9 +438,10 @@ class SettingUpdate(BaseModel):
     value: Union[str, int, float, bool]
     category: Optional[str] = "general"
     type: Optional[str] = "string"
+    scope: Optional[str] = "user"  # "user" o "organization" (solo administradores)
 
 @app.get("/settings", response_class=HTMLResponse)
-async def settings_page(request: Request, user: Optional[User] = Depends(get_current_user_from_cookie), db: Session = Depends(get_db)):
+async def settings_page(request: Request, user: Optional[Principal] = Depends(get_current_principal), db: Session = Depends(get_db)):
     """Página de configuración del sistema"""
     if not user:
         return RedirectResponse(url="/login")
@@ -330,7 +452,7 @@ async def settings_page(request: Request, user: Optional[User] = Depends(get_cur
     })
 
 @app.get("/reports", response_class=HTMLResponse)
-async def reports_page(request: Request, user: Optional[User] = Depends(get_current_user_from_cookie), db: Session = Depends(get_db)):
+async def reports_page(request: Request, user: Optional[Principal] = Depends(get_current_principal), db: Session = Depends(get_db)):
     """Página de reportes financieros"""
     if not user:
         return RedirectResponse(url="/login")
@@ -341,79 +463,19 @@ async def reports_page(request: Request, user: Optional[User] = Depends(get_curr
     })
 
 @app.get("/api/settings")
-async def get_settings(user: Optional[User] = Depends(get_current_user_from_cookie), db: Session = Depends(get_db)):
+async def get_settings(user: Optional[Principal] = Depends(get_current_principal), db: Session = Depends(get_db)):
     """Obtener todas las configuraciones"""
     if not user:
         raise HTTPException(status_code=401, detail="No autorizado")
-    settings = db.query(Setting).all()
-    user_settings = db.query(UserSetting).filter(UserSetting.user_id == user.id).all()
-    user_settings_map = {s.key: s for s in user_settings}
-    result = {}
-    
-    # Agrupar por categoría
-    for setting in settings:
-        if setting.category not in result:
-            result[setting.category] = []
-        
-        # Convertir valor según el tipo
-        resolved = user_settings_map.get(setting.key) or setting
-        value = resolved.value
-        if resolved.type == 'boolean':
-            value = str(resolved.value).lower() == 'true'
-        elif resolved.type == 'int':
-            try:
-                value = int(resolved.value)
-            except:
-                value = 0
-        elif resolved.type == 'float':
-            try:
-                value = float(resolved.value)
-            except:
-                value = 0.0
-                
-        result[setting.category].append({
-            "key": setting.key,
-            "value": value,
-            "type": resolved.type or setting.type,
-            "description": resolved.description or setting.description,
-            "category": resolved.category or setting.category,
-            "source": "user" if setting.key in user_settings_map else "default"
-        })
-
-    # Incluir settings personalizados del usuario que no existen en defaults
-    for setting in user_settings:
-        if setting.key not in {s.key for s in settings}:
-            if setting.category not in result:
-                result[setting.category] = []
-            value = setting.value
-            if setting.type == 'boolean':
-                value = str(setting.value).lower() == 'true'
-            elif setting.type == 'int':
-                try:
-                    value = int(setting.value)
-                except:
-                    value = 0
-            elif setting.type == 'float':
-                try:
-                    value = float(setting.value)
-                except:
-                    value = 0.0
-            result[setting.category].append({
-                "key": setting.key,
-                "value": value,
-                "type": setting.type,
-                "description": setting.description or "Configuración personalizada",
-                "category": setting.category,
-                "source": "user"
-            })
-        
-    return result
+    return grouped_settings(get_org_id(user, db), user.id, db)
 
 @app.post("/api/settings")
-async def update_settings(updates: List[SettingUpdate], user: Optional[User] = Depends(get_current_user_from_cookie), db: Session = Depends(get_db)):
+async def update_settings(updates: List[SettingUpdate], user: Optional[Principal] = Depends(get_current_principal), db: Session = Depends(get_db)):
     """Actualizar múltiples configuraciones"""
     if not user:
         raise HTTPException(status_code=401, detail="No autorizado")
+    if any(update.scope == "organization" for update in updates) and not user.is_superuser:
+        raise HTTPException(status_code=403, detail="Solo administradores")
     try:
         org_id = get_org_id(user, db)
         updated_count = 0
@@ -422,6 +484,19 @@ async def update_settings(updates: List[SettingUpdate], user: Optional[User] = D
             str_value = str(update.value)
             if isinstance(update.value, bool) or update.type == 'boolean':
                 str_value = str(update.value).lower()
+
+            if update.scope == "organization":
+                # Valor propio de la organización (p. ej. su Evolution API)
+                org_setting = db.query(OrganizationSetting).filter(
+                    OrganizationSetting.organization_id == org_id,
+                    OrganizationSetting.key == update.key
+                ).first()
+                if org_setting:
+                    org_setting.value = str_value
+                else:
+                    db.add(OrganizationSetting(organization_id=org_id, key=update.key, value=str_value))
+                updated_count += 1
+                continue
             
             default_setting = db.query(Setting).filter(Setting.key == update.key).first()
             setting = db.query(UserSetting).filter(
@@ -449,9 +524,8 @@ async def update_settings(updates: List[SettingUpdate], user: Optional[User] = D
         
         db.commit()
 
-        # Invalidar caché de settings
-        invalidate_cache_pattern("settings:*")
-        logger.info("🗑️ Caché de settings invalidado")
+        # Evento de cambio: invalida el registro de settings en todos los procesos
+        notify_settings_changed(org_id, user.id)
 
         return {"status": "success", "updated": updated_count}
     except Exception as e:
@@ -496,7 +570,7 @@ def optimize_image(image_path: str, max_width: int = 800, quality: int = 85) ->
         return None
 
 @app.get("/", response_class=HTMLResponse)
-async def read_root(request: Request, user: Optional[User] = Depends(get_current_user_from_cookie), db: Session = Depends(get_db)):
+async def read_root(request: Request, user: Optional[Principal] = Depends(get_current_principal), db: Session = Depends(get_db)):
     """Página principal"""
     if not user:
         return templates.TemplateResponse("landing.html", {"request": request})
@@ -507,9 +581,10 @@ async def read_root(request: Request, user: Optional[User] = Depends(get_current
     })
 
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
+async def websocket_endpoint(websocket: WebSocket, last_event_id: Optional[str] = None):
     """
-    Endpoint WebSocket para notificaciones en tiempo real
+    Endpoint WebSocket para notificaciones en tiempo real.
+    Al reconectar con `last_event_id` se reenvían los eventos perdidos (replay_service.py)
     """
     db = next(get_db())
     try:
@@ -518,7 +593,7 @@ async def websocket_endpoint(websocket: WebSocket):
             await websocket.close(code=1008)
             return
         org_id = get_org_id(user, db)
-        await websocket_manager.connect(websocket, org_id)
+        await websocket_manager.connect(websocket, org_id, last_event_id=last_event_id)
     finally:
         db.close()
     try:
@@ -531,7 +606,10 @@ async def websocket_endpoint(websocket: WebSocket):
                     {"type": "pong", "message": "Conexión activa"}, 
                     websocket
                 )
-    except WebSocketDisconnect:
+    except (WebSocketDisconnect, RuntimeError):
+        # RuntimeError: el servidor ya cerró el socket (cliente lento)
+        pass
+    finally:
         websocket_manager.disconnect(websocket)
 
 @app.get("/test-invoice/{invoice_id}")
@@ -540,38 +618,38 @@ async def test_invoice(invoice_id: int):
     return {"test": "working", "invoice_id": invoice_id}
 
 @app.get("/invoice/{invoice_id}")
-async def invoice_detail_json(invoice_id: int, user: Optional[User] = Depends(get_current_user_from_cookie), db: Session = Depends(get_db)):
+async def invoice_detail_json(invoice_id: int, user: Optional[Principal] = Depends(get_current_principal_async), db: AsyncSession = Depends(get_async_db)):
     """API JSON para detalle de factura"""
     if not user:
         raise HTTPException(status_code=401, detail="No autorizado")
-    org_id = get_org_id(user, db)
-    invoice = db.query(Invoice).filter(Invoice.id == invoice_id, Invoice.organization_id == org_id).first()
+    org_id = await get_org_id_async(user, db)
+    invoice = await db.scalar(select(Invoice).filter(Invoice.id == invoice_id, Invoice.organization_id == org_id))
     if not invoice:
         raise HTTPException(status_code=404, detail="Factura no encontrada")
     return {"invoice": invoice.to_dict(), "status": "success"}
 
 @app.get("/invoice/{invoice_id}/view", response_class=HTMLResponse)
-async def invoice_detail_view(request: Request, invoice_id: int, user: Optional[User] = Depends(get_current_user_from_cookie), db: Session = Depends(get_db)):
+async def invoice_detail_view(request: Request, invoice_id: int, user: Optional[Principal] = Depends(get_current_principal_async), db: AsyncSession = Depends(get_async_db)):
     """Página de detalle de factura"""
     try:
         if not user:
             return RedirectResponse(url="/login")
-        org_id = get_org_id(user, db)
-        invoice = db.query(Invoice).filter(Invoice.id == invoice_id, Invoice.organization_id == org_id).first()
+        org_id = await get_org_id_async(user, db)
+        invoice = await db.scalar(select(Invoice).filter(Invoice.id == invoice_id, Invoice.organization_id == org_id))
         if not invoice:
             raise HTTPException(status_code=404, detail="Factura no encontrada")
         
         return templates.TemplateResponse("invoice_detail.html", {
             "request": request,
             "invoice": invoice,
-            **get_company_context(db, user)
+            **(await db.run_sync(get_company_context, user))
         })
     except Exception as e:
         print(f"Error in invoice_detail: {e}")
         raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
 
 @app.post("/upload")
-async def upload_files(files: List[UploadFile] = File(...), user: Optional[User] = Depends(get_current_user_from_cookie), db: Session = Depends(get_db)):
+async def upload_files(files: List[UploadFile] = File(...), user: Optional[Principal] = Depends(get_current_principal), db: Session = Depends(get_db)):
     """Subir múltiples archivos de facturas"""
     if not user:
         raise HTTPException(status_code=401, detail="No autorizado")
@@ -602,17 +680,20 @@ async def upload_files(files: List[UploadFile] = File(...), user: Optional[User]
             # Determinar tipo de archivo
             file_type = get_file_type(file.filename)
             
-            # Crear registro en base de datos
-            invoice = Invoice(
-                filename=file.filename,
-                file_path=file_path,
-                file_type=file_type,
-                processed=False,
-                organization_id=org_id
-            )
-            db.add(invoice)
-            db.commit()
-            db.refresh(invoice)
+            # Crear registro en base de datos (escritor serializado en SQLite)
+            def create_invoice(write_db: Session) -> Invoice:
+                invoice = Invoice(
+                    filename=file.filename,
+                    file_path=file_path,
+                    file_type=file_type,
+                    processed=False,
+                    organization_id=org_id
+                )
+                write_db.add(invoice)
+                write_db.flush()
+                return invoice
+
+            invoice = await run_write(create_invoice)
             
             results.append({
                 "filename": file.filename,
@@ -633,15 +714,41 @@ async def upload_files(files: List[UploadFile] = File(...), user: Optional[User]
     
     return {"results": results}
 
+def invoice_changes(invoice: Invoice) -> Dict[str, Any]:
+    """Columnas modificadas en memoria de una factura (sin confirmar)"""
+    return {attr.key: attr.value for attr in sa_inspect(invoice).attrs if attr.history.has_changes()}
+
+
+def save_processed_invoices(org_id: int, changes: Dict[int, Dict[str, Any]]):
+    """
+    Trabajo para run_write: aplica los cambios de procesamiento de cada factura
+    (ver invoice_changes). Se omiten las que otra petición ya procesó mientras
+    se llamaba a OpenAI (doble clic) y las borradas. Retorna {id: factura}.
+    """
+    def save(session: Session) -> Dict[int, Invoice]:
+        saved = {}
+        if not changes:
+            return saved
+        for invoice in session.query(Invoice).filter(Invoice.id.in_(list(changes)), Invoice.organization_id == org_id):
+            if invoice.processed:
+                continue
+            for key, value in changes[invoice.id].items():
+                setattr(invoice, key, value)
+            saved[invoice.id] = invoice
+        session.flush()
+        return saved
+    return save
+
+
 @app.post("/process/{invoice_id}")
-async def process_invoice(invoice_id: int, user: Optional[User] = Depends(get_current_user_from_cookie), db: Session = Depends(get_db)):
+async def process_invoice(invoice_id: int, user: Optional[Principal] = Depends(get_current_principal), db: Session = Depends(get_db)):
     """Procesar una factura con OpenAI"""
     if not user:
         raise HTTPException(status_code=401, detail="No autorizado")
-    # Bloquear la fila para evitar condiciones de carrera (doble clic)
-    # En SQLite esto puede bloquear la tabla, en Postgres bloquea la fila
+    # La sesión solo lee: el resultado se confirma con run_write (escritor
+    # serializado en SQLite), que además descarta un doble procesamiento
     org_id = get_org_id(user, db)
-    invoice = db.query(Invoice).filter(Invoice.id == invoice_id, Invoice.organization_id == org_id).with_for_update().first()
+    invoice = db.query(Invoice).filter(Invoice.id == invoice_id, Invoice.organization_id == org_id).first()
     
     if not invoice:
         raise HTTPException(status_code=404, detail="Factura no encontrada")
@@ -653,14 +760,22 @@ async def process_invoice(invoice_id: int, user: Optional[User] = Depends(get_cu
         # Procesar con OpenAI en un thread separado para no bloquear el Event Loop
         from fastapi.concurrency import run_in_threadpool
         
-        extracted_data = await run_in_threadpool(
-            openai_processor.process_invoice,
-            invoice.file_path,
-            invoice.file_type,
-            invoice,
-            db,
-            user.id
-        )
+        # Mismo archivo ya procesado: reutilizar su extracción (sin costo de OpenAI)
+        invoice.content_hash = await run_in_threadpool(file_content_hash, invoice.file_path)
+        extracted_data = None
+        original_id = find_duplicates(db, org_id, Invoice.content_hash, {invoice.id: invoice.content_hash}).get(invoice.id)
+        if original_id:
+            extracted_data = reusable_extraction(db, original_id)
+        
+        if extracted_data is None:
+            extracted_data = await run_in_threadpool(
+                openai_processor.process_invoice,
+                invoice.file_path,
+                invoice.file_type,
+                invoice,
+                db,
+                user.id
+            )
         
         if extracted_data and "error" not in extracted_data:
             # Actualizar invoice con datos extraídos
@@ -696,21 +811,13 @@ async def process_invoice(invoice_id: int, user: Optional[User] = Depends(get_cu
             else:
                 invoice.line_items_data = "[]"
 
-            # Detectar Duplicados
-            if extracted_data.get('invoice_number') and extracted_data.get('vendor_name'):
-                existing = db.query(Invoice).filter(
-                    Invoice.invoice_number == extracted_data['invoice_number'],
-                    Invoice.vendor_name == extracted_data['vendor_name'],
-                    Invoice.id != invoice_id,
-                    Invoice.processed == True,
-                    Invoice.organization_id == org_id
-                ).first()
-                
-                if existing:
-                    warnings = extracted_data.get('audit_warnings', [])
-                    if not isinstance(warnings, list): warnings = []
-                    warnings.insert(0, f"DUPLICADO: Ya existe la factura #{existing.id}")
-                    extracted_data['audit_warnings'] = warnings
+            # Detectar Duplicados (huella indexada, ver duplicate_service.py)
+            fingerprint = Invoice.build_duplicate_fingerprint(
+                invoice.vendor_tax_id, invoice.vendor_name, invoice.invoice_number, invoice.total_amount
+            )
+            existing_id = find_duplicates(db, org_id, Invoice.duplicate_fingerprint, {invoice.id: fingerprint}).get(invoice.id)
+            if existing_id:
+                add_duplicate_warning(extracted_data, existing_id)
 
             # Guardar alertas de auditoría
             if extracted_data.get('audit_warnings'):
@@ -721,11 +828,17 @@ async def process_invoice(invoice_id: int, user: Optional[User] = Depends(get_cu
             invoice.raw_extracted_data = json.dumps(extracted_data)
             invoice.processed = True
             
-            db.commit()
-            db.refresh(invoice)
-
-            # Invalidar caché de estadísticas (ya que cambió data)
-            invalidate_cache_pattern("stats:*")
+            saved = (await run_write(save_processed_invoices(org_id, {invoice.id: invoice_changes(invoice)}))).get(invoice.id)
+            if saved is None:
+                db.expire_all()
+                current = db.query(Invoice).filter(Invoice.id == invoice_id, Invoice.organization_id == org_id).first()
+                if not current:
+                    raise HTTPException(status_code=404, detail="Factura no encontrada")
+                return {"message": "Factura ya procesada", "invoice": current.to_dict()}
+            invoice = saved
+
+            # El caché de estadísticas de la organización se invalida al
+            # confirmar la transacción (statistics_service.py)
 
             # Disparar Webhook: invoice.processed
             try:
@@ -747,27 +860,77 @@ async def process_invoice(invoice_id: int, user: Optional[User] = Depends(get_cu
                 "extracted_data": extracted_data
             }
         else:
+            # Se guardan igual el hash y el costo de OpenAI de la llamada fallida
+            await run_write(save_processed_invoices(org_id, {invoice.id: invoice_changes(invoice)}))
             error_msg = extracted_data.get('error', 'No se pudieron extraer datos') if extracted_data else 'Error desconocido'
             return {"message": "Error al procesar la factura", "error": error_msg}
     
+    except HTTPException:
+        raise
     except Exception as e:
         return {"message": "Error al procesar la factura", "error": str(e)}
 
+MAX_PAGE_SIZE = 500
+
 @app.get("/invoices")
 async def get_invoices(
     skip: int = 0,
     limit: int = 100,
+    cursor: Optional[str] = None,
+    count: str = "approx",
     transaction_type: Optional[str] = None,
     category: Optional[str] = None,
     search: Optional[str] = None,
-    user: Optional[User] = Depends(get_current_user_from_cookie),
-    db: Session = Depends(get_db)
+    alert_category: Optional[str] = None,
+    fields: Optional[str] = None,
+    user: Optional[Principal] = Depends(get_current_principal_async),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """Obtener lista de facturas con filtros opcionales"""
+    """
+    Obtener lista de facturas con filtros opcionales.
+
+    Devuelve una proyección ligera (INVOICE_LIST_FIELDS, ver models.py) sin
+    columnas pesadas. `fields` permite pedir campos concretos separados por
+    comas, ej: `fields=id,vendor_name,total_amount,line_items`.
+
+    Paginación por cursor: pasar el `next_cursor` de la respuesta anterior en
+    `cursor`. `skip` se mantiene por compatibilidad pero no escala en páginas
+    profundas. `count` controla el total: "approx" (cacheado/estimado),
+    "exact" o "none".
+
+    Con `search` los resultados se ordenan por relevancia (índice de texto
+    completo, ver search_service.py) y el cursor avanza por posición.
+    """
     if not user:
         raise HTTPException(status_code=401, detail="No autorizado")
+    return await db.run_sync(
+        list_invoices_page, user,
+        skip=skip, limit=limit, cursor=cursor, count=count,
+        transaction_type=transaction_type, category=category, search=search,
+        alert_category=alert_category, fields=fields
+    )
+
+def list_invoices_page(
+    db: Session,
+    user: Principal,
+    skip: int,
+    limit: int,
+    cursor: Optional[str],
+    count: str,
+    transaction_type: Optional[str],
+    category: Optional[str],
+    search: Optional[str],
+    alert_category: Optional[str],
+    fields: Optional[str]
+) -> Dict[str, Any]:
+    """Página de GET /invoices (síncrona: se ejecuta con AsyncSession.run_sync)"""
     org_id = get_org_id(user, db)
-    query = db.query(Invoice).filter(Invoice.organization_id == org_id)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    try:
+        selected_fields = parse_invoice_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    query = db.query(*invoice_list_columns(selected_fields)).filter(Invoice.organization_id == org_id)
     
     if transaction_type:
         query = query.filter(Invoice.transaction_type == transaction_type)
@@ -775,35 +938,73 @@ async def get_invoices(
     if category:
         query = query.filter(Invoice.category == category)
 
-    if search:
-        pattern = f"%{search}%"
-        query = query.filter(or_(
-            Invoice.vendor_name.ilike(pattern),
-            Invoice.invoice_number.ilike(pattern),
-            Invoice.description.ilike(pattern)
+    if alert_category:
+        # Facturas con alertas de auditoría de esa categoría (invoice_audit_flags)
+        query = query.filter(Invoice.id.in_(
+            db.query(InvoiceAuditFlag.invoice_id).filter(
+                InvoiceAuditFlag.organization_id == org_id,
+                InvoiceAuditFlag.category == alert_category
+            )
         ))
-    
-    invoices = query.order_by(desc(Invoice.created_at)).offset(skip).limit(limit).all()
+
+    if search:
+        # Búsqueda indexada con ranking: se pagina por offset sobre el ranking
+        query = apply_search(query, db, search)
+        try:
+            offset = decode_offset_cursor(cursor) if cursor else skip
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        invoices = query.offset(offset).limit(limit + 1).all()
+        has_more = len(invoices) > limit
+        invoices = invoices[:limit]
+        next_cursor = encode_offset_cursor(offset + limit) if has_more else None
+    elif cursor or not skip:
+        try:
+            page = paginate_keyset(query, Invoice.created_at, Invoice.id, cursor, limit)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        invoices = page["items"]
+        next_cursor = page["next_cursor"]
+        has_more = page["has_more"]
+    else:
+        # Compatibilidad: paginación por offset
+        invoices = query.order_by(desc(Invoice.created_at), desc(Invoice.id)).offset(skip).limit(limit + 1).all()
+        has_more = len(invoices) > limit
+        invoices = invoices[:limit]
+        next_cursor = encode_cursor(invoices[-1].created_at, invoices[-1].id) if has_more and invoices[-1].created_at else None
+
+    total = None
+    total_estimated = False
+    if count == "exact":
+        total = query.count()
+    elif count != "none":
+        filters = {"transaction_type": transaction_type, "category": category, "search": search, "alert_category": alert_category}
+        counted = estimate_count(query, count_cache_key("invoices", org_id, filters))
+        total = counted["total"]
+        total_estimated = counted["estimated"]
     
     return {
-        "invoices": [invoice.to_dict() for invoice in invoices],
-        "total": query.count()
+        "invoices": [invoice_row_to_dict(row, selected_fields) for row in invoices],
+        "total": total,
+        "total_estimated": total_estimated,
+        "next_cursor": next_cursor,
+        "has_more": has_more
     }
 
 @app.get("/invoices/{invoice_id}")
-async def get_invoice(invoice_id: int, user: Optional[User] = Depends(get_current_user_from_cookie), db: Session = Depends(get_db)):
+async def get_invoice(invoice_id: int, user: Optional[Principal] = Depends(get_current_principal_async), db: AsyncSession = Depends(get_async_db)):
     """Obtener detalles de una factura específica"""
     if not user:
         raise HTTPException(status_code=401, detail="No autorizado")
-    org_id = get_org_id(user, db)
-    invoice = db.query(Invoice).filter(Invoice.id == invoice_id, Invoice.organization_id == org_id).first()
+    org_id = await get_org_id_async(user, db)
+    invoice = await db.scalar(select(Invoice).filter(Invoice.id == invoice_id, Invoice.organization_id == org_id))
     if not invoice:
         raise HTTPException(status_code=404, detail="Factura no encontrada")
     
     return invoice.to_dict()
 
 @app.get("/invoice/{invoice_id}/optimized-image")
-async def get_optimized_image(invoice_id: int, user: Optional[User] = Depends(get_current_user_from_cookie), db: Session = Depends(get_db)):
+async def get_optimized_image(invoice_id: int, user: Optional[Principal] = Depends(get_current_principal), db: Session = Depends(get_db)):
     """Obtener imagen optimizada de una factura"""
     if not user:
         raise HTTPException(status_code=401, detail="No autorizado")
@@ -825,56 +1026,57 @@ async def get_optimized_image(invoice_id: int, user: Optional[User] = Depends(ge
     return {"optimized_image": optimized_data}
 
 @app.put("/invoices/{invoice_id}")
-async def update_invoice(invoice_id: int, invoice_data: dict, user: Optional[User] = Depends(get_current_user_from_cookie), db: Session = Depends(get_db)):
+async def update_invoice(invoice_id: int, invoice_data: dict, user: Optional[Principal] = Depends(get_current_principal), db: Session = Depends(get_db)):
     """Actualizar datos de una factura"""
     if not user:
         raise HTTPException(status_code=401, detail="No autorizado")
     org_id = get_org_id(user, db)
-    invoice = db.query(Invoice).filter(Invoice.id == invoice_id, Invoice.organization_id == org_id).first()
-    if not invoice:
-        raise HTTPException(status_code=404, detail="Factura no encontrada")
     
-    # Actualizar campos permitidos
+    # Campos permitidos
     updateable_fields = [
         'vendor_name', 'invoice_number', 'total_amount', 'tax_amount',
         'currency', 'transaction_type', 'category', 'description',
         'vendor_country', 'vendor_tax_id', 'vendor_fiscal_address',
         'goods_services_type'
     ]
-    
-    for field in updateable_fields:
-        if field in invoice_data:
-            setattr(invoice, field, invoice_data[field])
-    
-    # Actualizar fecha si se proporciona
-    if 'invoice_date' in invoice_data:
-        try:
-            invoice.invoice_date = datetime.strptime(invoice_data['invoice_date'], '%Y-%m-%d')
-        except:
-            pass
-    
-    invoice.updated_at = datetime.utcnow()
-    db.commit()
-    db.refresh(invoice)
-    
-    return invoice.to_dict()
+
+    def update(session: Session) -> Optional[Dict[str, Any]]:
+        invoice = session.query(Invoice).filter(Invoice.id == invoice_id, Invoice.organization_id == org_id).first()
+        if not invoice:
+            return None
+        for field in updateable_fields:
+            if field in invoice_data:
+                setattr(invoice, field, invoice_data[field])
+        
+        # Actualizar fecha si se proporciona
+        if 'invoice_date' in invoice_data:
+            try:
+                invoice.invoice_date = datetime.strptime(invoice_data['invoice_date'], '%Y-%m-%d')
+            except:
+                pass
+        
+        invoice.updated_at = datetime.utcnow()
+        session.flush()
+        return invoice.to_dict()
+
+    updated = await run_write(update)
+    if updated is None:
+        raise HTTPException(status_code=404, detail="Factura no encontrada")
+    return updated
 
 @app.delete("/invoices/{invoice_id}")
-async def delete_invoice(invoice_id: int, user: Optional[User] = Depends(get_current_user_from_cookie), db: Session = Depends(get_db)):
+async def delete_invoice(invoice_id: int, user: Optional[Principal] = Depends(get_current_principal), db: Session = Depends(get_db)):
     """Eliminar una factura"""
     if not user:
         raise HTTPException(status_code=401, detail="No autorizado")
     org_id = get_org_id(user, db)
-    invoice = db.query(Invoice).filter(Invoice.id == invoice_id, Invoice.organization_id == org_id).first()
-    if not invoice:
+    count, file_paths = await run_write(lambda session: delete_invoices(session, org_id, [invoice_id]))
+    if not count:
         raise HTTPException(status_code=404, detail="Factura no encontrada")
     
-    # Eliminar archivo físico
-    if os.path.exists(invoice.file_path):
-        os.remove(invoice.file_path)
-    
-    db.delete(invoice)
-    db.commit()
+    # El archivo físico se elimina en segundo plano
+    file_purger.enqueue(file_paths)
+    reset_unread_count(org_id)
     
     return {"message": "Factura eliminada exitosamente"}
 
@@ -882,7 +1084,7 @@ class BulkActionRequest(BaseModel):
     invoice_ids: List[int]
 
 @app.post("/api/invoices/bulk-delete")
-async def bulk_delete_invoices(action: BulkActionRequest, user: Optional[User] = Depends(get_current_user_from_cookie), db: Session = Depends(get_db)):
+async def bulk_delete_invoices(action: BulkActionRequest, user: Optional[Principal] = Depends(get_current_principal), db: Session = Depends(get_db)):
     """Eliminar múltiples facturas"""
     if not user:
         raise HTTPException(status_code=401, detail="No autorizado")
@@ -890,27 +1092,63 @@ async def bulk_delete_invoices(action: BulkActionRequest, user: Optional[User] =
     if not action.invoice_ids:
         return {"message": "No se seleccionaron facturas", "count": 0}
         
-    invoices = db.query(Invoice).filter(
-        Invoice.id.in_(action.invoice_ids),
-        Invoice.organization_id == org_id
-    ).all()
-    count = 0
-    
-    for invoice in invoices:
-        try:
-            # Eliminar archivo físico
-            if invoice.file_path and os.path.exists(invoice.file_path):
-                os.remove(invoice.file_path)
-            db.delete(invoice)
-            count += 1
-        except Exception as e:
-            print(f"Error eliminando factura {invoice.id}: {e}")
-            
-    db.commit()
+    # Un DELETE por bloque; los archivos se purgan después de confirmar
+    count, file_paths = await run_write(lambda session: delete_invoices(session, org_id, action.invoice_ids))
+    file_purger.enqueue(file_paths)
+    reset_unread_count(org_id)
     return {"message": "Facturas eliminadas exitosamente", "count": count}
 
+@app.get("/api/archive/invoices")
+async def list_archived_invoices(
+    search: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = 50,
+    user: Optional[Principal] = Depends(get_current_principal),
+    db: Session = Depends(get_db)
+):
+    """Buscar facturas archivadas por retención"""
+    if not user:
+        raise HTTPException(status_code=401, detail="No autorizado")
+    org_id = get_org_id(user, db)
+    try:
+        return search_archived(db, org_id, search, cursor, max(1, min(limit, MAX_PAGE_SIZE)))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/api/archive/invoices/{invoice_id}/restore")
+async def restore_archived_invoice(invoice_id: int, user: Optional[Principal] = Depends(get_current_principal), db: Session = Depends(get_db)):
+    """Restaurar una factura archivada"""
+    if not user:
+        raise HTTPException(status_code=401, detail="No autorizado")
+    org_id = get_org_id(user, db)
+
+    def restore(session: Session):
+        invoice, archived_copy = restore_invoice(session, org_id, invoice_id)
+        return (invoice.to_dict() if invoice else None), archived_copy
+
+    try:
+        invoice, archived_copy = await run_write(restore)
+    except (OSError, ValueError) as e:
+        logger.error(f"❌ Error restaurando factura archivada {invoice_id}: {e}")
+        raise HTTPException(status_code=500, detail="No se pudo restaurar la factura del archivo")
+    if invoice is None:
+        raise HTTPException(status_code=404, detail="Factura archivada no encontrada")
+    if archived_copy:
+        file_purger.enqueue([archived_copy])
+    return {"message": "Factura restaurada exitosamente", "invoice": invoice}
+
+@app.post("/api/archive/run")
+async def run_archive_now(user: Optional[Principal] = Depends(get_current_principal)):
+    """Aplicar la retención ahora (solo administradores)"""
+    if not user:
+        raise HTTPException(status_code=401, detail="No autorizado")
+    if not user.is_superuser:
+        raise HTTPException(status_code=403, detail="Solo administradores")
+    results = await run_archival()
+    return {"message": "Archivo completado", "archived": sum(results.values())}
+
 @app.post("/api/invoices/bulk-process")
-async def bulk_process_invoices(action: BulkActionRequest, user: Optional[User] = Depends(get_current_user_from_cookie), db: Session = Depends(get_db)):
+async def bulk_process_invoices(action: BulkActionRequest, user: Optional[Principal] = Depends(get_current_principal), db: Session = Depends(get_db)):
     """Procesar múltiples facturas pendientes"""
     if not user:
         raise HTTPException(status_code=401, detail="No autorizado")
@@ -922,7 +1160,7 @@ async def bulk_process_invoices(action: BulkActionRequest, user: Optional[User]
         Invoice.id.in_(action.invoice_ids),
         Invoice.processed == False,
         Invoice.organization_id == org_id
-    ).all()
+    ).order_by(Invoice.id).all()
     
     success_count = 0
     errors = []
@@ -931,17 +1169,31 @@ async def bulk_process_invoices(action: BulkActionRequest, user: Optional[User]
     # Nota: Para volúmenes grandes, usar Celery/RQ. Aquí usamos threadpool simple.
     from fastapi.concurrency import run_in_threadpool
     
+    # Archivos ya procesados: una sola consulta para todo el lote
+    for invoice in invoices:
+        invoice.content_hash = await run_in_threadpool(file_content_hash, invoice.file_path)
+    same_file = find_duplicates(db, org_id, Invoice.content_hash, {inv.id: inv.content_hash for inv in invoices})
+    
+    extracted = {}
     for invoice in invoices:
         try:
-            # Reutilizar lógica de process_invoice
-            extracted_data = await run_in_threadpool(
-                openai_processor.process_invoice,
-                invoice.file_path,
-                invoice.file_type,
-                invoice,
-                db,
-                user.id
-            )
+            extracted_data = None
+            original_id = same_file.get(invoice.id)
+            if original_id in extracted:
+                # Mismo archivo que otra factura de este lote
+                extracted_data = copy.deepcopy(extracted[original_id][1])
+            elif original_id:
+                extracted_data = reusable_extraction(db, original_id)
+            if extracted_data is None:
+                # Reutilizar lógica de process_invoice
+                extracted_data = await run_in_threadpool(
+                    openai_processor.process_invoice,
+                    invoice.file_path,
+                    invoice.file_type,
+                    invoice,
+                    db,
+                    user.id
+                )
             
             if extracted_data and "error" not in extracted_data:
                 invoice.vendor_name = extracted_data.get('vendor_name')
@@ -961,42 +1213,51 @@ async def bulk_process_invoices(action: BulkActionRequest, user: Optional[User]
                 invoice.description = extracted_data.get('description')
                 invoice.confidence_score = extracted_data.get('confidence')
                 invoice.goods_services_type = extracted_data.get('goods_services_type')
-                
-                # Detectar Duplicados
-                if extracted_data.get('invoice_number') and extracted_data.get('vendor_name'):
-                    existing = db.query(Invoice).filter(
-                        Invoice.invoice_number == extracted_data['invoice_number'],
-                        Invoice.vendor_name == extracted_data['vendor_name'],
-                        Invoice.id != invoice.id,
-                        Invoice.processed == True,
-                        Invoice.organization_id == org_id
-                    ).first()
-                    
-                    if existing:
-                        warnings = extracted_data.get('audit_warnings', [])
-                        if not isinstance(warnings, list): warnings = []
-                        warnings.insert(0, f"DUPLICADO: Ya existe la factura #{existing.id}")
-                        extracted_data['audit_warnings'] = warnings
-                
-                # Guardar alertas de auditoría
-                if extracted_data.get('audit_warnings'):
-                    invoice.audit_flags = json.dumps(extracted_data['audit_warnings'], ensure_ascii=False)
-                else:
-                    invoice.audit_flags = "[]"
-                    
-                invoice.raw_extracted_data = json.dumps(extracted_data)
-                invoice.processed = True
-                success_count += 1
-                
-                # Disparar Webhook
-                webhook_sender.trigger_event(db, "invoice.processed", invoice.to_dict(), org_id=org_id)
+                invoice.vendor_tax_id = extracted_data.get('vendor_tax_id')
+                extracted[invoice.id] = (invoice, extracted_data)
             else:
                 errors.append(f"ID {invoice.id}: {extracted_data.get('error')}")
                 
         except Exception as e:
             errors.append(f"ID {invoice.id}: {str(e)}")
+    
+    # Detectar Duplicados: una consulta para todo el lote (incluye duplicados entre sí)
+    duplicates = find_duplicates(db, org_id, Invoice.duplicate_fingerprint, {
+        invoice_id: Invoice.build_duplicate_fingerprint(
+            invoice.vendor_tax_id, invoice.vendor_name, invoice.invoice_number, invoice.total_amount
+        )
+        for invoice_id, (invoice, _) in extracted.items()
+    })
+    
+    for invoice_id, (invoice, extracted_data) in extracted.items():
+        try:
+            if invoice_id in duplicates:
+                add_duplicate_warning(extracted_data, duplicates[invoice_id])
             
-    db.commit()
+            # Guardar alertas de auditoría
+            if extracted_data.get('audit_warnings'):
+                invoice.audit_flags = json.dumps(extracted_data['audit_warnings'], ensure_ascii=False)
+            else:
+                invoice.audit_flags = "[]"
+                
+            invoice.raw_extracted_data = json.dumps(extracted_data)
+            invoice.processed = True
+        except Exception as e:
+            errors.append(f"ID {invoice_id}: {str(e)}")
+
+    # Un solo trabajo de escritura para todo el lote (también hashes y costos de las fallidas)
+    changes = {invoice.id: invoice_changes(invoice) for invoice in invoices}
+    saved = await run_write(save_processed_invoices(org_id, {k: v for k, v in changes.items() if v}))
+
+    for invoice_id, invoice in saved.items():
+        if not invoice.processed:
+            continue
+        success_count += 1
+        # Disparar Webhook
+        try:
+            webhook_sender.trigger_event(db, "invoice.processed", invoice.to_dict(), org_id=org_id)
+        except Exception as e:
+            errors.append(f"ID {invoice_id}: {str(e)}")
     
     return {
         "message": f"Procesamiento completado. {success_count} exitosos.",
@@ -1013,7 +1274,7 @@ class WebhookPushRequest(BaseModel):
     event: Optional[str] = "invoices.exported"
 
 @app.post("/api/invoices/export")
-async def export_invoices(action: ExportRequest, user: Optional[User] = Depends(get_current_user_from_cookie), db: Session = Depends(get_db)):
+async def export_invoices(action: ExportRequest, user: Optional[Principal] = Depends(get_current_principal), db: Session = Depends(get_read_db)):
     """Exportar facturas seleccionadas a diferentes formatos"""
     if not user:
         raise HTTPException(status_code=401, detail="No autorizado")
@@ -1057,7 +1318,11 @@ async def export_invoices(action: ExportRequest, user: Optional[User] = Depends(
         elif action.format == "dgii_606":
             org = db.query(Organization).filter(Organization.id == org_id).first()
             report_rnc = org.tax_id if org else None
-            output = export_service.export_dgii_606(invoices, report_rnc=report_rnc)
+            output = export_service.export_dgii_606(
+                invoices,
+                report_rnc=report_rnc,
+                line_item_totals=line_item_subtotals(db, [inv.id for inv in invoices])
+            )
             media_type = "application/vnd.ms-excel"
             filename += ".xls"
         elif action.format == "excel":
@@ -1086,7 +1351,7 @@ async def export_invoices(action: ExportRequest, user: Optional[User] = Depends(
         raise HTTPException(status_code=500, detail=f"Error generando exportación: {str(e)}")
 
 @app.post("/api/invoices/push-webhook")
-async def push_invoices_webhook(payload: WebhookPushRequest, user: Optional[User] = Depends(get_current_user_from_cookie), db: Session = Depends(get_db)):
+async def push_invoices_webhook(payload: WebhookPushRequest, user: Optional[Principal] = Depends(get_current_principal), db: Session = Depends(get_db)):
     """Enviar JSON estructurado a webhooks configurados"""
     if not user:
         raise HTTPException(status_code=401, detail="No autorizado")
@@ -1109,100 +1374,58 @@ async def push_invoices_webhook(payload: WebhookPushRequest, user: Optional[User
     result = webhook_sender.trigger_event(db, payload.event, data, org_id=org_id)
     return {"status": "sent", "result": result}
 
+# TTL del valor fresco / del último valor servible mientras se recalcula
+STATS_SOFT_TTL = 300
+STATS_HARD_TTL = 3600
+
 @app.get("/statistics")
-async def get_statistics(user: Optional[User] = Depends(get_current_user_from_cookie), db: Session = Depends(get_db)):
+async def get_statistics(user: Optional[Principal] = Depends(get_current_principal_async), db: AsyncSession = Depends(get_async_db)):
     """Obtener estadísticas enfocadas en el procesamiento IA y eficiencia operativa"""
     if not user:
         raise HTTPException(status_code=401, detail="No autorizado")
-    org_id = get_org_id(user, db)
-
-    # Intentar obtener del caché primero
-    cache_key = f"stats:dashboard:{org_id}"
-    cached_stats = cache_get(cache_key)
-    if cached_stats:
-        logger.info("⚡ Estadísticas servidas desde caché Redis")
-        return cached_stats
+    org_id = await get_org_id_async(user, db)
+
+    async def compute():
+        # Sesión propia (réplica si está al día): el recálculo puede seguir en segundo plano tras responder
+        async with get_async_read_session(user.id) as stats_db:
+            # Los clientes conectados se actualizan con deltas (dashboard_service.py)
+            return await stats_db.run_sync(compute_dashboard_statistics, org_id)
+
+    # Un solo recálculo a la vez; mientras tanto se sirve el último valor (cache_service.py)
+    return await get_or_compute(
+        versioned_key("stats", org_id, "dashboard"),
+        compute,
+        soft_ttl=STATS_SOFT_TTL,
+        hard_ttl=STATS_HARD_TTL,
+        stale_key=f"{STALE_PREFIX}stats:{org_id}:dashboard"
+    )
 
-    logger.info("📊 Calculando estadísticas operativas desde PostgreSQL...")
-    from models import IS_HEROKU
+def compute_dashboard_statistics(db: Session, org_id: int) -> Dict[str, Any]:
+    """Estadísticas operativas del dashboard para una organización"""
+    logger.info("📊 Calculando estadísticas operativas desde agregados diarios...")
+    # Agregados por día mantenidos en cada cambio de factura (statistics_service.py)
+    rollup = get_rollup_statistics(db, org_id)
+    totals = rollup["totals"]
 
     # --- 1. Estado de la Cola ---
-    base_query = db.query(Invoice).filter(Invoice.organization_id == org_id)
-    total_invoices = base_query.count()
-    processed_invoices = base_query.filter(Invoice.processed == True).count()
+    total_invoices = int(totals["invoices"])
+    processed_invoices = int(totals["processed"])
     pending_invoices = total_invoices - processed_invoices
     
     # --- 2. Rendimiento Diario (Procesadas Hoy) ---
     today = datetime.utcnow().date()
-    today_start = datetime.combine(today, datetime.min.time())
-    
-    daily_processed_count = base_query.filter(
-        Invoice.processed == True,
-        Invoice.updated_at >= today_start
-    ).count()
+    daily_processed_count = sum(int(d["processed"] or 0) for d in rollup["history"] if d["day"] == today)
 
     # --- 3. Calidad de IA (Confianza Promedio) ---
-    avg_confidence = db.query(func.avg(Invoice.confidence_score)).filter(
-        Invoice.processed == True,
-        Invoice.confidence_score.isnot(None),
-        Invoice.organization_id == org_id
-    ).scalar() or 0.0
+    avg_confidence = (totals["confidence_sum"] / totals["confidence_count"]) if totals["confidence_count"] else 0.0
 
     # --- 4. Auditoría y Alertas ---
-    if IS_HEROKU:
-        # Postgres
-        audit_alert_count = base_query.filter(
-            Invoice.processed == True,
-            Invoice.audit_flags != '[]',
-            Invoice.audit_flags.isnot(None)
-        ).count()
-        
-        # Get raw audit flags for breakdown
-        alert_invoices = base_query.with_entities(Invoice.audit_flags).filter(
-            Invoice.processed == True,
-            Invoice.audit_flags != '[]',
-            Invoice.audit_flags.isnot(None)
-        ).all()
-    else:
-        # SQLite
-        audit_alert_count = base_query.filter(
-            Invoice.processed == True,
-            Invoice.audit_flags != '[]',
-            Invoice.audit_flags.isnot(None)
-        ).count()
-        
-        # Get raw audit flags for breakdown
-        alert_invoices = base_query.with_entities(Invoice.audit_flags).filter(
-            Invoice.processed == True,
-            Invoice.audit_flags != '[]',
-            Invoice.audit_flags.isnot(None)
-        ).all()
-
-    # Calculate Alert Breakdown
-    alert_breakdown = {}
-    for (flags_json,) in alert_invoices:
-        try:
-            if flags_json:
-                flags = json.loads(flags_json)
-                if isinstance(flags, list):
-                    for flag in flags:
-                        # Categorize flags
-                        category = "Otros"
-                        flag_lower = flag.lower()
-                        if "fiscal" in flag_lower or "tax" in flag_lower:
-                            category = "Datos Fiscales"
-                        elif "duplicado" in flag_lower:
-                            category = "Duplicados"
-                        elif "antigua" in flag_lower or "fecha" in flag_lower:
-                            category = "Antigüedad"
-                        elif "legible" in flag_lower:
-                            category = "Legibilidad"
-                        elif "impuestos" in flag_lower:
-                            category = "Impuestos"
-                        
-                        alert_breakdown[category] = alert_breakdown.get(category, 0) + 1
-        except:
-            continue
+    audit_alert_count = int(totals["alerts"])
+    alert_breakdown = {
+        category: int(totals[column])
+        for category, column in ALERT_CATEGORY_COLUMNS.items()
+        if totals[column]
+    }
             
     # Format breakdown for Chart.js
     audit_distribution = {
@@ -1211,37 +1434,27 @@ async def get_statistics(user: Optional[User] = Depends(get_current_user_from_co
     }
 
     # --- 5. Historial de Volumen de Procesamiento (Últimos 7 días) ---
-    if IS_HEROKU:
-        daily_volume_data = db.query(
-            func.to_char(Invoice.updated_at, 'YYYY-MM-DD').label('day'),
-            func.count(Invoice.id).label('count')
-        ).filter(
-            Invoice.processed == True,
-            Invoice.updated_at >= datetime.now() - timedelta(days=7),
-            Invoice.organization_id == org_id
-        ).group_by(
-            func.to_char(Invoice.updated_at, 'YYYY-MM-DD')
-        ).order_by(
-            func.to_char(Invoice.updated_at, 'YYYY-MM-DD')
-        ).all()
-    else:
-        daily_volume_data = db.query(
-            func.strftime('%Y-%m-%d', Invoice.updated_at).label('day'),
-            func.count(Invoice.id).label('count')
-        ).filter(
-            Invoice.processed == True,
-            Invoice.updated_at >= datetime.now() - timedelta(days=7),
-            Invoice.organization_id == org_id
-        ).group_by(
-            func.strftime('%Y-%m-%d', Invoice.updated_at)
-        ).order_by(
-            func.strftime('%Y-%m-%d', Invoice.updated_at)
-        ).all()
-    
-    processing_history = [{'date': d, 'count': c} for d, c in daily_volume_data]
+    processing_history = [
+        {'date': d["day"].isoformat(), 'count': int(d["processed"])}
+        for d in rollup["history"] if d["processed"]
+    ]
 
-    # --- 6. Costos OpenAI (Reutilizamos servicio existente) ---
-    cost_stats = cost_control.get_cost_statistics(db, org_id=org_id)
+    # --- 6. Costos OpenAI ---
+    model_breakdown = [
+        {
+            "model": m["model"],
+            "requests": int(m["invoices"]),
+            "total_cost": float(m["cost_usd"] or 0),
+            "total_tokens": int(m["tokens"] or 0),
+            "avg_cost_per_request": float(m["cost_usd"] or 0) / m["invoices"] if m["invoices"] else 0
+        }
+        for m in rollup["models"]
+    ]
+    cost_stats = {
+        'total_cost': float(totals["cost_usd"]),
+        'total_tokens': int(totals["tokens"]),
+        'model_breakdown': model_breakdown
+    }
     
     # Calcular promedio costo por documento
     avg_cost_per_doc = 0.0
@@ -1249,13 +1462,15 @@ async def get_statistics(user: Optional[User] = Depends(get_current_user_from_co
          avg_cost_per_doc = cost_stats.get('total_cost', 0) / processed_invoices
 
     # --- 7. Invoices Recientes con Alertas (para la tabla de Insights) ---
-    recent_alerts_query = base_query.filter(
-        Invoice.processed == True,
-        Invoice.audit_flags != '[]',
-        Invoice.audit_flags.isnot(None)
-    ).order_by(Invoice.updated_at.desc()).limit(10).all()
-    
-    recent_alerts = [inv.to_dict() for inv in recent_alerts_query]
+    alert_ids = recent_alert_invoice_ids(db, org_id, limit=10)
+    alert_invoices = {
+        inv.id: inv for inv in db.query(Invoice).filter(
+            Invoice.id.in_(alert_ids),
+            Invoice.processed == True
+        ).all()
+    } if alert_ids else {}
+
+    recent_alerts = [alert_invoices[i].to_dict() for i in alert_ids if i in alert_invoices]
 
     # Estructurar respuesta para el Dashboard Operativo
     stats_data = {
@@ -1267,6 +1482,9 @@ async def get_statistics(user: Optional[User] = Depends(get_current_user_from_co
         'performance': {
             'daily_processed': daily_processed_count,
             'avg_confidence': float(avg_confidence),
+            # Sumas para recalcular el promedio al aplicar deltas
+            'confidence_sum': float(totals["confidence_sum"] or 0),
+            'confidence_count': int(totals["confidence_count"] or 0),
             'avg_processing_time': 0, 
             'success_rate': (processed_invoices / total_invoices * 100) if total_invoices > 0 else 0
         },
@@ -1290,26 +1508,78 @@ async def get_statistics(user: Optional[User] = Depends(get_current_user_from_co
         }
     }
     
-    # Guardar en caché por 5 minutos
-    cache_set(cache_key, stats_data, ttl=300)
-    logger.info("💾 Estadísticas operativas guardadas en caché Redis")
+    return stats_data
+
+@app.get("/api/audit/summary")
+async def get_audit_summary(
+    days: Optional[int] = None,
+    user: Optional[Principal] = Depends(get_current_principal),
+    db: Session = Depends(get_db)
+):
+    """Alertas de auditoría por categoría, opcionalmente de los últimos `days` días"""
+    if not user:
+        raise HTTPException(status_code=401, detail="No autorizado")
+    org_id = get_org_id(user, db)
 
-    # Notificar actualización via WebSocket
-    await websocket_manager.notify_statistics_update(stats_data, org_id)
+    since = datetime.utcnow() - timedelta(days=days) if days else None
+    breakdown = audit_flag_breakdown(db, org_id, since=since)
+    return {
+        "total": sum(breakdown.values()),
+        "distribution": {
+            "labels": list(breakdown.keys()),
+            "data": list(breakdown.values())
+        }
+    }
+
+@app.get("/api/analytics/items")
+async def get_item_analytics(
+    search: Optional[str] = None,
+    transaction_type: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    limit: int = 50,
+    user: Optional[Principal] = Depends(get_current_principal),
+    db: Session = Depends(get_db)
+):
+    """
+    Gasto por producto a partir de las líneas de factura.
+    `search` filtra por prefijo de la descripción; fechas en formato YYYY-MM-DD
+    sobre la fecha de la factura.
+    """
+    if not user:
+        raise HTTPException(status_code=401, detail="No autorizado")
+    org_id = get_org_id(user, db)
+
+    try:
+        start = datetime.fromisoformat(start_date) if start_date else None
+        end = datetime.fromisoformat(end_date) if end_date else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Formato de fecha inválido (use YYYY-MM-DD)")
+    if end and len(end_date) == 10:
+        end = end + timedelta(days=1) - timedelta(microseconds=1)
+
+    items = item_spend_summary(
+        db, org_id,
+        search=search,
+        transaction_type=transaction_type,
+        start_date=start,
+        end_date=end,
+        limit=max(1, min(limit, MAX_PAGE_SIZE))
+    )
+    return {"items": items, "total": sum(i["total"] for i in items)}
 
-    return stats_data
 @app.get("/categories")
-async def get_categories(user: Optional[User] = Depends(get_current_user_from_cookie), db: Session = Depends(get_db)):
+async def get_categories(user: Optional[Principal] = Depends(get_current_principal_async), db: AsyncSession = Depends(get_async_db)):
     """Obtener lista de categorías únicas"""
     if not user:
         raise HTTPException(status_code=401, detail="No autorizado")
-    org_id = get_org_id(user, db)
-    categories = db.query(Invoice.category).filter(
+    org_id = await get_org_id_async(user, db)
+    categories = await db.scalars(select(Invoice.category).filter(
         Invoice.category.isnot(None),
         Invoice.organization_id == org_id
-    ).distinct().all()
+    ).distinct())
     
-    return [cat[0] for cat in categories if cat[0]]
+    return [cat for cat in categories if cat]
 
 @app.get("/export/csv")
 async def export_invoices_csv(
@@ -1317,8 +1587,8 @@ async def export_invoices_csv(
     category: Optional[str] = None,
     format: Optional[str] = None,
     invoice_ids: Optional[str] = None,
-    user: Optional[User] = Depends(get_current_user_from_cookie),
-    db: Session = Depends(get_db)
+    user: Optional[Principal] = Depends(get_current_principal),
+    db: Session = Depends(get_read_db)
 ):
     """Exportar facturas a CSV con filtros opcionales"""
     try:
@@ -1352,7 +1622,11 @@ async def export_invoices_csv(
         if format == "dgii_606":
             org = db.query(Organization).filter(Organization.id == org_id).first()
             report_rnc = org.tax_id if org else None
-            output = export_service.export_dgii_606(invoices, report_rnc=report_rnc)
+            output = export_service.export_dgii_606(
+                invoices,
+                report_rnc=report_rnc,
+                line_item_totals=line_item_subtotals(db, [inv.id for inv in invoices])
+            )
             filename = f"dgii_606_{timestamp}.xls"
             return StreamingResponse(
                 io.BytesIO(output),
@@ -1468,7 +1742,7 @@ class WebhookCreate(BaseModel):
     events: List[str]
 
 @app.get("/api/webhooks")
-async def get_webhooks(user: Optional[User] = Depends(get_current_user_from_cookie), db: Session = Depends(get_db)):
+async def get_webhooks(user: Optional[Principal] = Depends(get_current_principal), db: Session = Depends(get_db)):
     """Listar webhooks configurados"""
     if not user:
         raise HTTPException(status_code=401, detail="No autorizado")
@@ -1477,7 +1751,7 @@ async def get_webhooks(user: Optional[User] = Depends(get_current_user_from_cook
     return [wh.to_dict() for wh in webhooks]
 
 @app.post("/api/webhooks")
-async def create_webhook(webhook: WebhookCreate, user: Optional[User] = Depends(get_current_user_from_cookie), db: Session = Depends(get_db)):
+async def create_webhook(webhook: WebhookCreate, user: Optional[Principal] = Depends(get_current_principal), db: Session = Depends(get_db)):
     """Crear nuevo webhook"""
     if not user:
         raise HTTPException(status_code=401, detail="No autorizado")
@@ -1495,7 +1769,7 @@ async def create_webhook(webhook: WebhookCreate, user: Optional[User] = Depends(
     return new_webhook.to_dict()
 
 @app.delete("/api/webhooks/{webhook_id}")
-async def delete_webhook(webhook_id: int, user: Optional[User] = Depends(get_current_user_from_cookie), db: Session = Depends(get_db)):
+async def delete_webhook(webhook_id: int, user: Optional[Principal] = Depends(get_current_principal), db: Session = Depends(get_db)):
     """Eliminar webhook"""
     if not user:
         raise HTTPException(status_code=401, detail="No autorizado")
@@ -1509,7 +1783,7 @@ async def delete_webhook(webhook_id: int, user: Optional[User] = Depends(get_cur
     return {"message": "Webhook eliminado"}
 
 @app.post("/api/webhooks/{webhook_id}/test")
-async def test_webhook(webhook_id: int, user: Optional[User] = Depends(get_current_user_from_cookie), db: Session = Depends(get_db)):
+async def test_webhook(webhook_id: int, user: Optional[Principal] = Depends(get_current_principal), db: Session = Depends(get_db)):
     """Probar envío de webhook (dispara evento ping)"""
     if not user:
         raise HTTPException(status_code=401, detail="No autorizado")
@@ -1530,6 +1804,60 @@ async def test_webhook(webhook_id: int, user: Optional[User] = Depends(get_curre
     
     return {"status": "success", "delivery_result": result}
 
+# ===========================================
+# NÚMEROS DE WHATSAPP AUTORIZADOS
+# ===========================================
+
+class WhatsAppSenderCreate(BaseModel):
+    phone: str
+    name: Optional[str] = None
+
+@app.get("/api/whatsapp/senders")
+async def get_whatsapp_senders(user: Optional[Principal] = Depends(get_current_principal), db: Session = Depends(get_db)):
+    """Listar números autorizados de la organización"""
+    if not user:
+        raise HTTPException(status_code=401, detail="No autorizado")
+    org_id = get_org_id(user, db)
+    senders = db.query(WhatsAppSender).filter(WhatsAppSender.organization_id == org_id).order_by(WhatsAppSender.id).all()
+    return [sender.to_dict() for sender in senders]
+
+@app.post("/api/whatsapp/senders")
+async def create_whatsapp_sender(sender: WhatsAppSenderCreate, user: Optional[Principal] = Depends(get_current_principal), db: Session = Depends(get_db)):
+    """Autorizar un número para enviar facturas a la organización"""
+    if not user:
+        raise HTTPException(status_code=401, detail="No autorizado")
+    phone = normalize_phone(sender.phone)
+    if len(phone) < 8:
+        raise HTTPException(status_code=400, detail="Número de teléfono inválido")
+    if db.query(WhatsAppSender.id).filter(WhatsAppSender.phone == phone).first():
+        # Un número solo puede enrutar a una organización
+        raise HTTPException(status_code=409, detail="El número ya está registrado")
+
+    new_sender = WhatsAppSender(
+        phone=phone,
+        name=sender.name,
+        is_active=True,
+        organization_id=get_org_id(user, db)
+    )
+    db.add(new_sender)
+    db.commit()
+    db.refresh(new_sender)
+    return new_sender.to_dict()
+
+@app.delete("/api/whatsapp/senders/{sender_id}")
+async def delete_whatsapp_sender(sender_id: int, user: Optional[Principal] = Depends(get_current_principal), db: Session = Depends(get_db)):
+    """Revocar un número autorizado"""
+    if not user:
+        raise HTTPException(status_code=401, detail="No autorizado")
+    org_id = get_org_id(user, db)
+    sender = db.query(WhatsAppSender).filter(WhatsAppSender.id == sender_id, WhatsAppSender.organization_id == org_id).first()
+    if not sender:
+        raise HTTPException(status_code=404, detail="Número no encontrado")
+
+    db.delete(sender)
+    db.commit()
+    return {"message": "Número eliminado"}
+
 # ===========================================
 # MODELOS PARA EVOLUTION API / WHATSAPP
 # ===========================================
@@ -1588,10 +1916,8 @@ async def evolution_webhook(request: Request, db: Session = Depends(get_db)):
             if invoice_result.get("status") == "success":
                 # Notificar nueva imagen recibida
                 invoice_id = invoice_result.get("invoice_id")
-                org_id = None
-                if invoice_id:
-                    inv = db.query(Invoice).filter(Invoice.id == invoice_id).first()
-                    org_id = inv.organization_id if inv else None
+                # Organización resuelta por el número del remitente
+                org_id = invoice_result.get("organization_id")
 
                 await websocket_manager.notify_new_whatsapp_image(
                     sender_info=invoice_result.get("sender_info", {}),
@@ -1728,17 +2054,19 @@ async def get_evolution_instance_status(
         }
 
 @app.get("/evolution/security-config")
-async def get_security_config():
+async def get_security_config(db: Session = Depends(get_db)):
     """
     Verificar configuración de seguridad del sistema
     """
     authorized_number = os.getenv("AUTHORIZED_WHATSAPP_NUMBER", "15555550100")
+    registered = db.query(func.count(WhatsAppSender.id)).filter(WhatsAppSender.is_active == True).scalar()
     
     return {
         "status": "success",
         "security_enabled": True,
         "authorized_number": authorized_number,
-        "description": "Solo el número autorizado puede enviar facturas al sistema",
+        "registered_senders": registered,
+        "description": "Solo los números registrados (/api/whatsapp/senders) pueden enviar facturas al sistema",
         "note": "Los mensajes de otros números serán automáticamente rechazados"
     }
 
@@ -1761,22 +2089,17 @@ async def get_redis_stats():
     stats = get_cache_stats()
     return {
         "redis": stats,
-        "description": "Estadísticas de rendimiento del sistema de caché Redis"
+        "description": "Estadísticas de rendimiento del sistema de caché (Redis y memoria local)"
     }
 
 # --- EVOLUTION API MANAGEMENT ---
 
-def get_setting_value(db, key):
-    """Helper para obtener valor de configuración"""
-    s = db.query(Setting).filter(Setting.key == key).first()
-    return s.value if s else None
-
 @app.get("/evolution/proxy/status")
 async def get_evolution_status(db: Session = Depends(get_db)):
     """Obtener estado de la instancia configurada"""
-    url = get_setting_value(db, "evolution_url") or os.getenv("EVOLUTION_API_URL")
-    apikey = get_setting_value(db, "evolution_apikey") or os.getenv("EVOLUTION_API_KEY")
-    instance = get_setting_value(db, "evolution_instance") or os.getenv("EVOLUTION_INSTANCE_NAME")
+    url = get_setting("evolution_url", db=db) or os.getenv("EVOLUTION_API_URL")
+    apikey = get_setting("evolution_apikey", db=db) or os.getenv("EVOLUTION_API_KEY")
+    instance = get_setting("evolution_instance", db=db) or os.getenv("EVOLUTION_INSTANCE_NAME")
     
     if not url or not apikey or not instance:
         return {"status": "not_configured"}
@@ -1797,9 +2120,9 @@ async def get_evolution_status(db: Session = Depends(get_db)):
 @app.get("/evolution/proxy/qr")
 async def get_evolution_qr(db: Session = Depends(get_db)):
     """Obtener QR code para escanear"""
-    url = get_setting_value(db, "evolution_url") or os.getenv("EVOLUTION_API_URL")
-    apikey = get_setting_value(db, "evolution_apikey") or os.getenv("EVOLUTION_API_KEY")
-    instance = get_setting_value(db, "evolution_instance") or os.getenv("EVOLUTION_INSTANCE_NAME")
+    url = get_setting("evolution_url", db=db) or os.getenv("EVOLUTION_API_URL")
+    apikey = get_setting("evolution_apikey", db=db) or os.getenv("EVOLUTION_API_KEY")
+    instance = get_setting("evolution_instance", db=db) or os.getenv("EVOLUTION_INSTANCE_NAME")
     
     if not url or not apikey: return {"error": "Configuración incompleta"}
     
@@ -1819,9 +2142,9 @@ async def get_evolution_qr(db: Session = Depends(get_db)):
 @app.post("/evolution/proxy/create")
 async def create_evolution_instance(db: Session = Depends(get_db)):
     """Crear instancia si no existe"""
-    url = get_setting_value(db, "evolution_url") or os.getenv("EVOLUTION_API_URL")
-    apikey = get_setting_value(db, "evolution_apikey") or os.getenv("EVOLUTION_API_KEY")
-    instance = get_setting_value(db, "evolution_instance") or os.getenv("EVOLUTION_INSTANCE_NAME")
+    url = get_setting("evolution_url", db=db) or os.getenv("EVOLUTION_API_URL")
+    apikey = get_setting("evolution_apikey", db=db) or os.getenv("EVOLUTION_API_KEY")
+    instance = get_setting("evolution_instance", db=db) or os.getenv("EVOLUTION_INSTANCE_NAME")
     
     instance_token = os.getenv("EVOLUTION_INSTANCE_TOKEN")
     if not instance_token:
@@ -1900,6 +2223,11 @@ async def test_evolution_get_base64(
 # FUNCIONES AUXILIARES PARA EVOLUTION API
 # ===========================================
 
+def whatsapp_org_id(phone: str, db: Session) -> int:
+    """Organización del remitente (índice de números) o la por defecto"""
+    route = resolve_sender(phone, db)
+    return route.organization_id if route else get_org_id(None, db)
+
 async def process_evolution_message(
     message: EvolutionMessage,
     sender_phone: str,
@@ -2050,7 +2378,7 @@ async def download_and_process_whatsapp_image(
             file_type="image",
             processed=False,
             description=f"Factura descargada de WhatsApp URL de {sender_name} ({phone})",
-            organization_id=get_default_org(db).id
+            organization_id=whatsapp_org_id(phone, db)
         )
         db.add(invoice)
         db.commit()
@@ -2236,7 +2564,7 @@ async def process_whatsapp_image_from_base64(
             file_type="image",
             processed=False,
             description=f"Factura recibida por WhatsApp de {sender_name} ({phone}) - {source_note}",
-            organization_id=get_default_org(db).id
+            organization_id=whatsapp_org_id(phone, db)
         )
         db.add(invoice)
         db.commit()
@@ -2352,7 +2680,7 @@ async def process_whatsapp_image_from_evolution(
             file_type="image",
             processed=False,
             description=f"Factura recibida por WhatsApp de {sender_name} ({phone})",
-            organization_id=get_default_org(db).id
+            organization_id=whatsapp_org_id(phone, db)
         )
         db.add(invoice)
         db.commit()
@@ -0,0 +1,369 @@
+"""
+Migraciones versionadas del esquema.
+
+Cada migración tiene un número de versión único y se registra en la tabla
+``schema_migrations`` al aplicarse, de modo que solo se ejecutan las
+pendientes. Los índices se crean con ``CREATE INDEX CONCURRENTLY`` en
+PostgreSQL para no bloquear escrituras sobre tablas grandes.
+
+Para agregar una migración: escribir una función ``upgrade(engine)`` y
+añadirla al final de ``MIGRATIONS`` con la siguiente versión.
+"""
+import json
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, List, Optional, Sequence
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
+
+from models import ArchivedInvoice, Invoice, InvoiceAuditFlag, InvoiceDailyStats, InvoiceLineItem, OrganizationSetting, SchemaMigration, WhatsAppSender, audit_flag_rows, line_item_rows, migrate_invoices_table, migrate_multitenant_tables
+from search_service import create_search_indexes
+from statistics_service import rebuild_rollups
+
+logger = logging.getLogger(__name__)
+
+# Clave arbitraria para pg_advisory_lock: evita que dos dynos migren a la vez
+MIGRATION_LOCK_ID = 704_606
+
+
+class MigrationError(RuntimeError):
+    """Una migración falló: el esquema quedó a medio migrar"""
+
+
+@dataclass
+class Migration:
+    """Una migración del esquema"""
+    version: int
+    name: str
+    upgrade: Callable[[Engine], None]
+
+
+def create_index(engine: Engine, name: str, table: str, columns: Sequence[str], using: Optional[str] = None):
+    """
+    Crea un índice si no existe.
+    En PostgreSQL se usa CONCURRENTLY (requiere autocommit, fuera de transacción).
+    `columns` admite expresiones; `using` selecciona el método (ej: "gin", solo Postgres).
+    """
+    cols = ", ".join(columns)
+    method = f" USING {using}" if using else ""
+
+    if engine.dialect.name == "postgresql":
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            # Un CREATE INDEX CONCURRENTLY interrumpido deja un índice inválido
+            # que IF NOT EXISTS ignoraría; se elimina para reintentar.
+            invalid = conn.execute(text(
+                "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                "WHERE c.relname = :name AND NOT i.indisvalid"
+            ), {"name": name}).first()
+            if invalid:
+                logger.warning(f"⚠️ Índice inválido '{name}', recreando...")
+                conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+            conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table}{method} ({cols})"))
+    else:
+        with engine.begin() as conn:
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({cols})"))
+
+    logger.info(f"✅ Índice '{name}' verificado en '{table}'")
+
+
+def drop_index(engine: Engine, name: str):
+    """Elimina un índice si existe (CONCURRENTLY en PostgreSQL)"""
+    if engine.dialect.name == "postgresql":
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+    else:
+        with engine.begin() as conn:
+            conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+
+    logger.info(f"🗑️ Índice '{name}' eliminado")
+
+
+def add_column(engine: Engine, table: str, name: str, col_type: str):
+    """Agrega una columna si no existe"""
+    columns = [c["name"] for c in inspect(engine).get_columns(table)]
+    if name in columns:
+        return
+    with engine.begin() as conn:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {col_type}"))
+    logger.info(f"✅ Columna '{name}' agregada a '{table}'")
+
+
+# ===========================================
+# MIGRACIONES
+# ===========================================
+
+def _m001_invoices_columns(engine: Engine):
+    migrate_invoices_table(engine)
+
+
+def _m002_multitenant_columns(engine: Engine):
+    migrate_multitenant_tables(engine)
+
+
+def _m003_hot_query_indexes(engine: Engine):
+    # Listado (/invoices) y paginación por fecha de creación
+    create_index(engine, "ix_invoices_org_created", "invoices", ["organization_id", "created_at"])
+    # Contadores de cola, procesadas hoy e historial de 7 días (/statistics)
+    create_index(engine, "ix_invoices_org_processed_updated", "invoices", ["organization_id", "processed", "updated_at"])
+    # Filtro por categoría y /categories
+    create_index(engine, "ix_invoices_org_category_created", "invoices", ["organization_id", "category", "created_at"])
+    # Detección de duplicados
+    create_index(engine, "ix_invoices_org_number_vendor", "invoices", ["organization_id", "invoice_number", "vendor_name"])
+    # Campana de notificaciones (unread_only)
+    create_index(engine, "ix_notifications_org_read_created", "notifications", ["organization_id", "read", "created_at"])
+
+
+def _m004_keyset_indexes(engine: Engine):
+    # Paginación por cursor: (created_at, id) como desempate estable.
+    # Se crean los nuevos antes de eliminar los que quedan redundantes.
+    create_index(engine, "ix_invoices_org_created_id", "invoices", ["organization_id", "created_at", "id"])
+    create_index(engine, "ix_invoices_org_category_created_id", "invoices", ["organization_id", "category", "created_at", "id"])
+    drop_index(engine, "ix_invoices_org_created")
+    drop_index(engine, "ix_invoices_org_category_created")
+
+
+def _m005_invoice_search(engine: Engine):
+    add_column(engine, "invoices", "search_text", "TEXT")
+
+    # Backfill por lotes de las facturas existentes
+    batch_size = 1000
+    last_id = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(text(
+                "SELECT id, vendor_name, invoice_number, vendor_tax_id, description, line_items_data "
+                "FROM invoices WHERE id > :last_id AND search_text IS NULL ORDER BY id LIMIT :limit"
+            ), {"last_id": last_id, "limit": batch_size}).fetchall()
+            if not rows:
+                break
+            conn.execute(
+                text("UPDATE invoices SET search_text = :search_text WHERE id = :id"),
+                [{"id": row[0], "search_text": Invoice.build_search_text(*row[1:])} for row in rows]
+            )
+            last_id = rows[-1][0]
+
+    create_search_indexes(engine)
+
+
+def _m006_daily_stats_rollup(engine: Engine):
+    InvoiceDailyStats.__table__.create(bind=engine, checkfirst=True)
+    rebuild_rollups(engine)
+
+
+def _m007_invoice_audit_flags(engine: Engine):
+    InvoiceAuditFlag.__table__.create(bind=engine, checkfirst=True)
+    # Desglose/filtro por categoría y "alertas recientes"
+    create_index(engine, "ix_invoice_audit_flags_org_category_created", "invoice_audit_flags", ["organization_id", "category", "created_at"])
+    create_index(engine, "ix_invoice_audit_flags_org_created", "invoice_audit_flags", ["organization_id", "created_at"])
+
+    # Backfill desde el JSON de audit_flags; se conserva updated_at como fecha
+    batch_size = 1000
+    last_id = 0
+    table = InvoiceAuditFlag.__table__
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(text(
+                "SELECT id, organization_id, audit_flags, updated_at FROM invoices "
+                "WHERE id > :last_id AND audit_flags IS NOT NULL AND audit_flags != '[]' "
+                "ORDER BY id LIMIT :limit"
+            ), {"last_id": last_id, "limit": batch_size}).fetchall()
+            if not rows:
+                break
+            conn.execute(table.delete().where(table.c.invoice_id.in_([row[0] for row in rows])))
+            flags = []
+            for invoice_id, org_id, audit_flags, updated_at in rows:
+                if isinstance(updated_at, str):
+                    updated_at = datetime.fromisoformat(updated_at)
+                flags.extend(audit_flag_rows(invoice_id, org_id, audit_flags, updated_at))
+            if flags:
+                conn.execute(table.insert(), flags)
+            last_id = rows[-1][0]
+
+
+def _m008_invoice_line_items(engine: Engine):
+    InvoiceLineItem.__table__.create(bind=engine, checkfirst=True)
+    # Analítica por producto
+    create_index(engine, "ix_invoice_line_items_org_normalized", "invoice_line_items", ["organization_id", "normalized_description"])
+
+    # Backfill desde line_items_data
+    batch_size = 1000
+    last_id = 0
+    table = InvoiceLineItem.__table__
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(text(
+                "SELECT id, organization_id, line_items_data FROM invoices "
+                "WHERE id > :last_id AND line_items_data IS NOT NULL AND line_items_data != '[]' "
+                "ORDER BY id LIMIT :limit"
+            ), {"last_id": last_id, "limit": batch_size}).fetchall()
+            if not rows:
+                break
+            conn.execute(table.delete().where(table.c.invoice_id.in_([row[0] for row in rows])))
+            items = []
+            for invoice_id, org_id, line_items_data in rows:
+                items.extend(line_item_rows(invoice_id, org_id, line_items_data))
+            if items:
+                conn.execute(table.insert(), items)
+            last_id = rows[-1][0]
+
+
+def _m009_notifications_invoice_id(engine: Engine):
+    add_column(engine, "notifications", "invoice_id", "INTEGER")
+    # Borrado en cascada de las notificaciones de una factura
+    create_index(engine, "ix_notifications_invoice_id", "notifications", ["invoice_id"])
+
+    # Backfill desde el JSON de data
+    batch_size = 1000
+    last_id = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(text(
+                "SELECT id, data FROM notifications WHERE id > :last_id AND data IS NOT NULL "
+                "ORDER BY id LIMIT :limit"
+            ), {"last_id": last_id, "limit": batch_size}).fetchall()
+            if not rows:
+                break
+            updates = []
+            for notification_id, data in rows:
+                try:
+                    invoice_id = json.loads(data).get("invoice_id")
+                except (ValueError, AttributeError):
+                    continue
+                if isinstance(invoice_id, int):
+                    updates.append({"id": notification_id, "invoice_id": invoice_id})
+            if updates:
+                conn.execute(text("UPDATE notifications SET invoice_id = :invoice_id WHERE id = :id"), updates)
+            last_id = rows[-1][0]
+
+
+def _m010_archived_invoices(engine: Engine):
+    ArchivedInvoice.__table__.create(bind=engine, checkfirst=True)
+    # Búsqueda del archivo por organización, paginada por (created_at, id)
+    create_index(engine, "ix_archived_invoices_org_created_id", "archived_invoices", ["organization_id", "created_at", "id"])
+
+
+def _m011_notifications_recent_index(engine: Engine):
+    # Últimas notificaciones sin filtrar por leídas
+    create_index(engine, "ix_notifications_org_created", "notifications", ["organization_id", "created_at"])
+    # Poda por antigüedad
+    create_index(engine, "ix_notifications_created_at", "notifications", ["created_at"])
+
+
+def _m012_duplicate_fingerprint(engine: Engine):
+    add_column(engine, "invoices", "duplicate_fingerprint", "VARCHAR(40)")
+    add_column(engine, "invoices", "content_hash", "VARCHAR(64)")
+    # Chequeo de duplicados por igualdad (ver duplicate_service.py)
+    create_index(engine, "ix_invoices_org_fingerprint", "invoices", ["organization_id", "duplicate_fingerprint"])
+    create_index(engine, "ix_invoices_org_content_hash", "invoices", ["organization_id", "content_hash"])
+
+    # Backfill de la huella (el hash del archivo se calcula al procesar)
+    batch_size = 1000
+    last_id = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(text(
+                "SELECT id, vendor_tax_id, vendor_name, invoice_number, total_amount FROM invoices "
+                "WHERE id > :last_id AND invoice_number IS NOT NULL "
+                "ORDER BY id LIMIT :limit"
+            ), {"last_id": last_id, "limit": batch_size}).fetchall()
+            if not rows:
+                break
+            updates = []
+            for invoice_id, vendor_tax_id, vendor_name, invoice_number, total_amount in rows:
+                fingerprint = Invoice.build_duplicate_fingerprint(vendor_tax_id, vendor_name, invoice_number, total_amount)
+                if fingerprint:
+                    updates.append({"id": invoice_id, "fingerprint": fingerprint})
+            if updates:
+                conn.execute(text("UPDATE invoices SET duplicate_fingerprint = :fingerprint WHERE id = :id"), updates)
+            last_id = rows[-1][0]
+
+
+def _m013_whatsapp_senders(engine: Engine):
+    WhatsAppSender.__table__.create(bind=engine, checkfirst=True)
+
+
+def _m014_invoice_restored_at(engine: Engine):
+    add_column(engine, "invoices", "restored_at", "TIMESTAMP")
+
+
+def _m015_organization_settings(engine: Engine):
+    OrganizationSetting.__table__.create(bind=engine, checkfirst=True)
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "invoices_columns", _m001_invoices_columns),
+    Migration(2, "multitenant_columns", _m002_multitenant_columns),
+    Migration(3, "hot_query_indexes", _m003_hot_query_indexes),
+    Migration(4, "keyset_indexes", _m004_keyset_indexes),
+    Migration(5, "invoice_search", _m005_invoice_search),
+    Migration(6, "daily_stats_rollup", _m006_daily_stats_rollup),
+    Migration(7, "invoice_audit_flags", _m007_invoice_audit_flags),
+    Migration(8, "invoice_line_items", _m008_invoice_line_items),
+    Migration(9, "notifications_invoice_id", _m009_notifications_invoice_id),
+    Migration(10, "archived_invoices", _m010_archived_invoices),
+    Migration(11, "notifications_recent_index", _m011_notifications_recent_index),
+    Migration(12, "duplicate_fingerprint", _m012_duplicate_fingerprint),
+    Migration(13, "whatsapp_senders", _m013_whatsapp_senders),
+    Migration(14, "invoice_restored_at", _m014_invoice_restored_at),
+    Migration(15, "organization_settings", _m015_organization_settings),
+]
+
+
+# ===========================================
+# EJECUCIÓN
+# ===========================================
+
+def get_applied_versions(engine: Engine) -> set:
+    """Versiones ya aplicadas según schema_migrations"""
+    SchemaMigration.__table__.create(bind=engine, checkfirst=True)
+    with engine.connect() as conn:
+        rows = conn.execute(text("SELECT version FROM schema_migrations")).fetchall()
+    return {row[0] for row in rows}
+
+
+def run_migrations(engine: Engine) -> int:
+    """
+    Aplica en orden las migraciones pendientes.
+    Retorna el número de migraciones aplicadas; lanza MigrationError si
+    alguna falla (las ya aplicadas quedan registradas).
+    """
+    lock_conn = None
+    if engine.dialect.name == "postgresql":
+        lock_conn = engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+        lock_conn.execute(text("SELECT pg_advisory_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+
+    applied = 0
+    try:
+        done = get_applied_versions(engine)
+        for migration in sorted(MIGRATIONS, key=lambda m: m.version):
+            if migration.version in done:
+                continue
+
+            logger.info(f"🔄 Aplicando migración {migration.version:03d}_{migration.name}...")
+            try:
+                migration.upgrade(engine)
+            except Exception as e:
+                logger.error(f"❌ Error en migración {migration.version:03d}_{migration.name}: {e}")
+                # No continuar ni arrancar: las siguientes (y el código) dependen de esta
+                raise MigrationError(f"Migración {migration.version:03d}_{migration.name} fallida: {e}") from e
+
+            with engine.begin() as conn:
+                conn.execute(
+                    SchemaMigration.__table__.insert().values(
+                        version=migration.version,
+                        name=migration.name,
+                        applied_at=datetime.utcnow()
+                    )
+                )
+            applied += 1
+            logger.info(f"✅ Migración {migration.version:03d}_{migration.name} aplicada")
+    finally:
+        if lock_conn is not None:
+            lock_conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": MIGRATION_LOCK_ID})
+            lock_conn.close()
+
+    if applied:
+        logger.info(f"📦 {applied} migraciones aplicadas")
+    return applied
@@ -1,13 +1,24 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, Text, ForeignKey, UniqueConstraint
+from sqlalchemy import Column, Integer, String, Float, Date, DateTime, Boolean, Text, ForeignKey, UniqueConstraint, Index
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy import create_engine, event, text, inspect as sa_inspect
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from contextvars import ContextVar
 from datetime import datetime
+from typing import Optional
+import asyncio
 import os
+import time
+import hashlib
 import json
+import re
+import unicodedata
 from dotenv import load_dotenv
 import logging
 
+from redis_client import tiered_get, tiered_set
+
 # Configurar logging
 logger = logging.getLogger(__name__)
 
@@ -32,11 +43,45 @@ else:
     DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./invoices.db")
     logger.info("📄 Usando SQLite para desarrollo local")
 
+# ===========================================
+# MODO DE ALTA CONCURRENCIA EN SQLITE
+# ===========================================
+# WAL permite lectores concurrentes mientras un escritor confirma; los
+# pragmas se aplican a cada conexión nueva. Las escrituras frecuentes pasan
+# además por un único escritor que agrupa commits (ver writer_service.py).
+
+SQLITE_PERFORMANCE_MODE = os.getenv("SQLITE_PERFORMANCE_MODE", "true").lower() == "true"
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",  # seguro con WAL: solo los checkpoints hacen fsync completo
+    "busy_timeout": os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"),
+    "cache_size": "-64000",  # ~64 MB de caché de páginas
+    "mmap_size": "268435456",  # 256 MB leídos vía mmap
+    "temp_store": "MEMORY",
+}
+
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record=None):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
+
+
+def configure_sqlite_engine(sqlite_engine):
+    """Registra los pragmas de rendimiento en un engine SQLite (síncrono)"""
+    if SQLITE_PERFORMANCE_MODE:
+        event.listen(sqlite_engine, "connect", apply_sqlite_pragmas)
+
+
 # Configurar engine según el entorno
 try:
     if DATABASE_URL.startswith("sqlite"):
         logger.info("📄 Configurando SQLite")
         engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+        configure_sqlite_engine(engine)
     else:
         # PostgreSQL en Heroku
         logger.info("🐘 Configurando PostgreSQL para producción")
@@ -58,6 +103,87 @@ except Exception as e:
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# ===========================================
+# ACCESO ASÍNCRONO
+# ===========================================
+# Motor asíncrono (asyncpg en PostgreSQL, aiosqlite en SQLite) para los
+# endpoints de lectura más usados: esperan la BD sin bloquear el event loop.
+# El resto de la app sigue usando SessionLocal/get_db.
+
+def _async_engine_args(url: str):
+    """URL con driver asíncrono y connect_args equivalentes"""
+    async_url = make_url(url)
+    connect_args = {}
+    if async_url.drivername.startswith("sqlite"):
+        async_url = async_url.set(drivername="sqlite+aiosqlite")
+    else:
+        # asyncpg no entiende sslmode; se traduce a su parámetro ssl
+        query = dict(async_url.query)
+        sslmode = query.pop("sslmode", None)
+        if sslmode and sslmode != "disable":
+            connect_args["ssl"] = sslmode
+        async_url = async_url.set(drivername="postgresql+asyncpg", query=query)
+    return async_url, connect_args
+
+try:
+    ASYNC_DATABASE_URL, _async_connect_args = _async_engine_args(DATABASE_URL)
+    if ASYNC_DATABASE_URL.drivername.startswith("sqlite"):
+        async_engine = create_async_engine(ASYNC_DATABASE_URL)
+        configure_sqlite_engine(async_engine.sync_engine)
+    else:
+        async_engine = create_async_engine(
+            ASYNC_DATABASE_URL,
+            connect_args=_async_connect_args,
+            pool_pre_ping=True,
+            pool_recycle=300
+        )
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+except ImportError as e:
+    logger.error(f"❌ Driver asíncrono no instalado (asyncpg/aiosqlite): {e}")
+    async_engine = None
+    AsyncSessionLocal = None
+
+# ===========================================
+# RÉPLICA DE LECTURA
+# ===========================================
+# Con DATABASE_REPLICA_URL los endpoints de solo lectura pesados (dashboard,
+# reportes, exportaciones, contexto del chat) consultan la réplica en vez del
+# primario. Ver get_read_session: se vuelve al primario si la réplica va
+# atrasada o si el usuario acaba de escribir (read-your-writes).
+
+REPLICA_DATABASE_URL = os.getenv("DATABASE_REPLICA_URL")
+if REPLICA_DATABASE_URL and REPLICA_DATABASE_URL.startswith("postgres://"):
+    REPLICA_DATABASE_URL = REPLICA_DATABASE_URL.replace("postgres://", "postgresql://", 1)
+# Retraso máximo (segundos) aceptable en la réplica
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "5"))
+# Segundos que un usuario lee del primario tras confirmar sus propios cambios
+READ_YOUR_WRITES_SECONDS = int(os.getenv("READ_YOUR_WRITES_SECONDS", "30"))
+# Cada cuánto se vuelve a medir el retraso de la réplica (por proceso)
+REPLICA_LAG_CHECK_INTERVAL = 5.0
+
+replica_engine = None
+ReplicaSessionLocal = None
+AsyncReplicaSessionLocal = None
+if REPLICA_DATABASE_URL:
+    try:
+        if REPLICA_DATABASE_URL.startswith("sqlite"):
+            replica_engine = create_engine(REPLICA_DATABASE_URL, connect_args={"check_same_thread": False})
+            configure_sqlite_engine(replica_engine)
+        else:
+            replica_engine = create_engine(REPLICA_DATABASE_URL, pool_pre_ping=True, pool_recycle=300)
+        ReplicaSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=replica_engine)
+
+        _replica_async_url, _replica_connect_args = _async_engine_args(REPLICA_DATABASE_URL)
+        AsyncReplicaSessionLocal = async_sessionmaker(
+            create_async_engine(_replica_async_url, connect_args=_replica_connect_args),
+            autoflush=False,
+            expire_on_commit=False
+        )
+        logger.info("📖 Réplica de lectura configurada")
+    except Exception as e:
+        # Sin réplica todo se lee del primario
+        logger.error(f"❌ Error configurando réplica de lectura: {e}")
+
 Base = declarative_base()
 
 class Organization(Base):
@@ -72,6 +198,15 @@ class Organization(Base):
 
 class Invoice(Base):
     __tablename__ = "invoices"
+    # Índices compuestos para las consultas calientes (ver migrations.py)
+    __table_args__ = (
+        Index("ix_invoices_org_created_id", "organization_id", "created_at", "id"),
+        Index("ix_invoices_org_processed_updated", "organization_id", "processed", "updated_at"),
+        Index("ix_invoices_org_category_created_id", "organization_id", "category", "created_at", "id"),
+        Index("ix_invoices_org_number_vendor", "organization_id", "invoice_number", "vendor_name"),
+        Index("ix_invoices_org_fingerprint", "organization_id", "duplicate_fingerprint"),
+        Index("ix_invoices_org_content_hash", "organization_id", "content_hash"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     filename = Column(String, index=True)
@@ -111,11 +246,21 @@ class Invoice(Base):
     country_confidence = Column(Float)  # 0.0 - 1.0
     goods_services_type = Column(String)  # DGII 606: Tipo de Bienes y Servicios Comprados
 
+    # Texto indexado para búsqueda (proveedor, NCF, RNC, descripción, líneas)
+    search_text = Column(Text)
+
+    # Detección de duplicados (ver duplicate_service.py): huella de
+    # (RNC o proveedor normalizado, NCF, monto) y SHA-256 del archivo
+    duplicate_fingerprint = Column(String(40))
+    content_hash = Column(String(64))
+
     # Metadatos
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     processed = Column(Boolean, default=False)
     organization_id = Column(Integer, ForeignKey("organizations.id"), index=True)
+    # Restaurada desde el archivo: la retención se cuenta desde aquí (ver archive_service.py)
+    restored_at = Column(DateTime)
     
     def to_dict(self):
         return {
@@ -150,6 +295,339 @@ class Invoice(Base):
             "goods_services_type": self.goods_services_type
         }
 
+    @staticmethod
+    def build_search_text(vendor_name, invoice_number, vendor_tax_id, description, line_items_data) -> str:
+        """Documento de búsqueda: proveedor, NCF, RNC (con y sin guiones), descripción y líneas"""
+        parts = [vendor_name, invoice_number, vendor_tax_id, description]
+        if vendor_tax_id:
+            parts.append("".join(c for c in str(vendor_tax_id) if c.isdigit()))
+        if line_items_data:
+            try:
+                for item in json.loads(line_items_data):
+                    if isinstance(item, dict) and item.get("description"):
+                        parts.append(str(item["description"]))
+            except (ValueError, TypeError):
+                pass
+        return " ".join(str(p) for p in parts if p)
+
+    @staticmethod
+    def build_duplicate_fingerprint(vendor_tax_id, vendor_name, invoice_number, total_amount) -> Optional[str]:
+        """
+        Huella de duplicado: RNC (solo dígitos) o, sin él, el nombre del
+        proveedor normalizado; NCF sin separadores; monto redondeado a la unidad.
+        None si falta el NCF o el proveedor.
+        """
+        ncf = re.sub(r"[^0-9A-Z]", "", str(invoice_number or "").upper())
+        rnc = "".join(c for c in str(vendor_tax_id or "") if c.isdigit())
+        if len(rnc) >= 9:
+            party = f"rnc:{rnc}"
+        else:
+            name = normalize_vendor_name(vendor_name)
+            party = f"name:{name}" if name else ""
+        if not ncf or not party:
+            return None
+        try:
+            bucket = str(int(round(float(total_amount)))) if total_amount is not None else ""
+        except (TypeError, ValueError):
+            bucket = ""
+        return hashlib.sha1(f"{party}|{ncf}|{bucket}".encode("utf-8")).hexdigest()
+
+    def refresh_search_text(self):
+        self.search_text = Invoice.build_search_text(
+            self.vendor_name,
+            self.invoice_number,
+            self.vendor_tax_id,
+            self.description,
+            self.line_items_data
+        )
+
+@event.listens_for(Invoice, "before_insert")
+@event.listens_for(Invoice, "before_update")
+def _sync_invoice_search_text(mapper, connection, target):
+    """Mantener search_text y la huella de duplicado sincronizados en cada insert/update vía ORM"""
+    target.refresh_search_text()
+    target.duplicate_fingerprint = Invoice.build_duplicate_fingerprint(
+        target.vendor_tax_id,
+        target.vendor_name,
+        target.invoice_number,
+        target.total_amount
+    )
+
+
+# Formas societarias que no distinguen proveedores ("Ferretería X, S.R.L.")
+_VENDOR_SUFFIXES = {"srl", "sa", "sas", "eirl", "inc", "llc", "ltd", "corp", "cxa"}
+
+
+def normalize_vendor_name(vendor_name) -> str:
+    """Nombre del proveedor comparable: sin acentos, signos, espacios ni forma societaria"""
+    if not vendor_name:
+        return ""
+    text = unicodedata.normalize("NFKD", str(vendor_name))
+    text = "".join(c for c in text if not unicodedata.combining(c)).lower()
+    # "S.R.L." -> "srl" antes de separar palabras
+    text = re.sub(r"\b(\w)\.(?=\w\.)", r"\1", text).replace(".", "")
+    words = [w for w in re.split(r"[^a-z0-9]+", text) if w and w not in _VENDOR_SUFFIXES]
+    return "".join(words)
+
+# ===========================================
+# PROYECCIÓN LIGERA PARA LISTADOS
+# ===========================================
+
+# Campos que puede devolver el listado (mismos nombres que Invoice.to_dict)
+INVOICE_FIELDS = (
+    "id", "filename", "file_type", "vendor_name", "invoice_number", "invoice_date",
+    "total_amount", "tax_amount", "currency", "transaction_type", "category",
+    "description", "confidence_score", "audit_flags", "openai_tokens_used",
+    "openai_cost_usd", "openai_model_used", "openai_processing_time", "created_at",
+    "processed", "vendor_country", "vendor_tax_id", "vendor_fiscal_address",
+    "line_items", "country_detection_method", "country_confidence",
+    "organization_id", "goods_services_type",
+)
+
+# Lo que muestra la tabla del dashboard. Sin raw_extracted_data,
+# vendor_fiscal_address ni line_items_data (columnas pesadas + json.loads)
+INVOICE_LIST_FIELDS = (
+    "id", "filename", "file_type", "vendor_name", "invoice_number", "invoice_date",
+    "total_amount", "tax_amount", "currency", "transaction_type", "category",
+    "description", "confidence_score", "audit_flags", "created_at", "processed",
+)
+
+# Campos de to_dict cuyo nombre no coincide con la columna
+_INVOICE_FIELD_COLUMNS = {"line_items": "line_items_data"}
+
+
+def parse_invoice_fields(fields: str = None) -> tuple:
+    """
+    Interpreta el parámetro `fields` (separado por comas) de un listado.
+    Sin valor retorna INVOICE_LIST_FIELDS. `id` siempre se incluye.
+    Lanza ValueError si algún campo no existe.
+    """
+    if not fields:
+        return INVOICE_LIST_FIELDS
+    requested = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = [f for f in requested if f not in INVOICE_FIELDS]
+    if unknown:
+        raise ValueError(f"Campos desconocidos: {', '.join(unknown)}")
+    return tuple(dict.fromkeys(["id"] + requested))
+
+
+def invoice_list_columns(fields: tuple) -> list:
+    """
+    Columnas a seleccionar para los campos pedidos.
+    Siempre incluye created_at e id (necesarios para el cursor).
+    """
+    names = dict.fromkeys(_INVOICE_FIELD_COLUMNS.get(f, f) for f in ("id", "created_at") + tuple(fields))
+    return [getattr(Invoice, name) for name in names]
+
+
+def invoice_row_to_dict(row, fields: tuple) -> dict:
+    """Serializa una fila de invoice_list_columns igual que Invoice.to_dict, solo con `fields`"""
+    data = {}
+    for field in fields:
+        value = getattr(row, _INVOICE_FIELD_COLUMNS.get(field, field))
+        if field == "line_items":
+            value = json.loads(value) if value else []
+        elif isinstance(value, datetime):
+            value = value.isoformat()
+        data[field] = value
+    return data
+
+# ===========================================
+# ALERTAS DE AUDITORÍA NORMALIZADAS
+# ===========================================
+
+def categorize_audit_flag(flag: str) -> str:
+    """Categoría de dashboard de una alerta de auditoría"""
+    flag_lower = str(flag).lower()
+    if "fiscal" in flag_lower or "tax" in flag_lower:
+        return "Datos Fiscales"
+    elif "duplicado" in flag_lower:
+        return "Duplicados"
+    elif "antigua" in flag_lower or "fecha" in flag_lower:
+        return "Antigüedad"
+    elif "legible" in flag_lower:
+        return "Legibilidad"
+    elif "impuestos" in flag_lower:
+        return "Impuestos"
+    return "Otros"
+
+
+def parse_audit_flags(audit_flags) -> list:
+    """Lista de alertas de Invoice.audit_flags (JSON); [] si no es válido"""
+    if not audit_flags:
+        return []
+    try:
+        flags = json.loads(audit_flags)
+    except (ValueError, TypeError):
+        return []
+    return [str(f) for f in flags if f] if isinstance(flags, list) else []
+
+
+class InvoiceAuditFlag(Base):
+    """
+    Una alerta de auditoría de una factura, con su categoría calculada al
+    escribir. Se sincroniza desde Invoice.audit_flags (ver _sync_audit_flags).
+    """
+    __tablename__ = "invoice_audit_flags"
+    __table_args__ = (
+        Index("ix_invoice_audit_flags_org_category_created", "organization_id", "category", "created_at"),
+        Index("ix_invoice_audit_flags_org_created", "organization_id", "created_at"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    invoice_id = Column(Integer, ForeignKey("invoices.id", ondelete="CASCADE"), nullable=False, index=True)
+    organization_id = Column(Integer, ForeignKey("organizations.id"))
+    message = Column(Text, nullable=False)
+    category = Column(String, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "invoice_id": self.invoice_id,
+            "message": self.message,
+            "category": self.category,
+            "created_at": self.created_at.isoformat() if self.created_at else None
+        }
+
+
+def audit_flag_rows(invoice_id: int, organization_id, audit_flags, created_at: datetime = None) -> list:
+    """Filas de invoice_audit_flags para el JSON de alertas de una factura"""
+    created_at = created_at or datetime.utcnow()
+    return [
+        {
+            "invoice_id": invoice_id,
+            "organization_id": organization_id,
+            "message": flag,
+            "category": categorize_audit_flag(flag),
+            "created_at": created_at,
+        }
+        for flag in parse_audit_flags(audit_flags)
+    ]
+
+
+@event.listens_for(Invoice, "after_insert")
+@event.listens_for(Invoice, "after_update")
+def _sync_audit_flags(mapper, connection, target):
+    """Reescribe las alertas normalizadas cuando cambia audit_flags"""
+    state = sa_inspect(target)
+    changed = state.attrs.audit_flags.history.has_changes() or state.attrs.organization_id.history.has_changes()
+    if not changed:
+        return
+    table = InvoiceAuditFlag.__table__
+    connection.execute(table.delete().where(table.c.invoice_id == target.id))
+    rows = audit_flag_rows(target.id, target.organization_id, target.audit_flags)
+    if rows:
+        connection.execute(table.insert(), rows)
+
+
+@event.listens_for(Invoice, "after_delete")
+def _delete_audit_flags(mapper, connection, target):
+    """SQLite no aplica ON DELETE CASCADE sin PRAGMA foreign_keys"""
+    table = InvoiceAuditFlag.__table__
+    connection.execute(table.delete().where(table.c.invoice_id == target.id))
+
+# ===========================================
+# LÍNEAS DE PRODUCTOS RELACIONALES
+# ===========================================
+
+def normalize_item_description(description) -> str:
+    """Clave de agrupación de un producto: minúsculas, sin acentos ni signos"""
+    if not description:
+        return ""
+    text = unicodedata.normalize("NFKD", str(description))
+    text = "".join(c for c in text if not unicodedata.combining(c)).lower()
+    return re.sub(r"\s+", " ", re.sub(r"[^\w\s]", " ", text)).strip()[:255]
+
+
+def _item_number(value):
+    try:
+        return float(value) if value is not None and value != "" else None
+    except (TypeError, ValueError):
+        return None
+
+
+class InvoiceLineItem(Base):
+    """
+    Una línea de producto de una factura. Se sincroniza desde
+    Invoice.line_items_data (ver _sync_line_items).
+    """
+    __tablename__ = "invoice_line_items"
+    __table_args__ = (
+        Index("ix_invoice_line_items_org_normalized", "organization_id", "normalized_description"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    invoice_id = Column(Integer, ForeignKey("invoices.id", ondelete="CASCADE"), nullable=False, index=True)
+    organization_id = Column(Integer, ForeignKey("organizations.id"))
+    position = Column(Integer, nullable=False, default=0)
+    description = Column(Text)
+    normalized_description = Column(String(255), nullable=False, default="")
+    quantity = Column(Float)
+    unit_price = Column(Float)
+    subtotal = Column(Float)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "invoice_id": self.invoice_id,
+            "position": self.position,
+            "description": self.description,
+            "quantity": self.quantity,
+            "unit_price": self.unit_price,
+            "subtotal": self.subtotal
+        }
+
+
+def line_item_rows(invoice_id: int, organization_id, line_items_data) -> list:
+    """Filas de invoice_line_items para el JSON de líneas de una factura"""
+    if not line_items_data:
+        return []
+    try:
+        items = json.loads(line_items_data)
+    except (ValueError, TypeError):
+        return []
+    if not isinstance(items, list):
+        return []
+
+    rows = []
+    for position, item in enumerate(items):
+        if not isinstance(item, dict):
+            continue
+        description = item.get("description")
+        rows.append({
+            "invoice_id": invoice_id,
+            "organization_id": organization_id,
+            "position": position,
+            "description": str(description) if description else None,
+            "normalized_description": normalize_item_description(description),
+            "quantity": _item_number(item.get("quantity")),
+            "unit_price": _item_number(item.get("unit_price")),
+            "subtotal": _item_number(item.get("subtotal")),
+        })
+    return rows
+
+
+@event.listens_for(Invoice, "after_insert")
+@event.listens_for(Invoice, "after_update")
+def _sync_line_items(mapper, connection, target):
+    """Reescribe las líneas relacionales cuando cambia line_items_data"""
+    state = sa_inspect(target)
+    changed = state.attrs.line_items_data.history.has_changes() or state.attrs.organization_id.history.has_changes()
+    if not changed:
+        return
+    table = InvoiceLineItem.__table__
+    connection.execute(table.delete().where(table.c.invoice_id == target.id))
+    rows = line_item_rows(target.id, target.organization_id, target.line_items_data)
+    if rows:
+        connection.execute(table.insert(), rows)
+
+
+@event.listens_for(Invoice, "after_delete")
+def _delete_line_items(mapper, connection, target):
+    table = InvoiceLineItem.__table__
+    connection.execute(table.delete().where(table.c.invoice_id == target.id))
+
 class Setting(Base):
     __tablename__ = "settings"
     
@@ -174,14 +652,35 @@ class UserSetting(Base):
     description = Column(String)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+class OrganizationSetting(Base):
+    """
+    Valor de una configuración propio de una organización (por ejemplo su
+    Evolution API). Tipo, categoría y descripción vienen de ``settings``.
+    """
+    __tablename__ = "organization_settings"
+    __table_args__ = (UniqueConstraint("organization_id", "key", name="uq_organization_settings_org_key"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    organization_id = Column(Integer, ForeignKey("organizations.id"), index=True, nullable=False)
+    key = Column(String, nullable=False)
+    value = Column(String)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
 class Notification(Base):
     __tablename__ = "notifications"
+    __table_args__ = (
+        Index("ix_notifications_org_read_created", "organization_id", "read", "created_at"),
+        Index("ix_notifications_org_created", "organization_id", "created_at"),
+        Index("ix_notifications_created_at", "created_at"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     type = Column(String, index=True)  # 'info', 'success', 'warning', 'error'
     title = Column(String)
     message = Column(String)
     data = Column(Text, nullable=True) # JSON string with extra data (e.g. invoice_id)
+    # Factura relacionada (copia de data.invoice_id) para borrar en cascada
+    invoice_id = Column(Integer, index=True, nullable=True)
     read = Column(Boolean, default=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     organization_id = Column(Integer, ForeignKey("organizations.id"), index=True)
@@ -244,6 +743,116 @@ class WebhookEndpoint(Base):
             "created_at": self.created_at.isoformat() if self.created_at else None
         }
 
+class WhatsAppSender(Base):
+    """
+    Número de WhatsApp autorizado a enviar facturas a una organización.
+    Un número pertenece a una sola organización; una organización puede
+    tener varios (ver whatsapp_routing_service.py).
+    """
+    __tablename__ = "whatsapp_senders"
+
+    id = Column(Integer, primary_key=True, index=True)
+    phone = Column(String(32), nullable=False, unique=True)  # solo dígitos, con código de país
+    name = Column(String)
+    is_active = Column(Boolean, default=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    organization_id = Column(Integer, ForeignKey("organizations.id"), index=True, nullable=False)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "phone": self.phone,
+            "name": self.name,
+            "is_active": self.is_active,
+            "created_at": self.created_at.isoformat() if self.created_at else None
+        }
+
+class SchemaMigration(Base):
+    __tablename__ = "schema_migrations"
+
+    version = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False)
+    applied_at = Column(DateTime, default=datetime.utcnow)
+
+class InvoiceDailyStats(Base):
+    """
+    Agregados por organización, día y modelo de IA para el dashboard.
+    Se mantienen en la misma transacción que los cambios de facturas
+    (ver statistics_service.py).
+
+    Las columnas de conteo/costo se asignan al día de creación; las de
+    procesamiento (processed, confianza, alertas) al día de la última
+    actualización de la factura procesada.
+    """
+    __tablename__ = "invoice_daily_stats"
+    __table_args__ = (
+        UniqueConstraint("organization_id", "day", "model", name="uq_invoice_daily_stats_org_day_model"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    organization_id = Column(Integer, ForeignKey("organizations.id"), nullable=False)
+    day = Column(Date, nullable=False)
+    model = Column(String, nullable=False, default="")  # openai_model_used ('' si no hay)
+
+    # Por día de creación
+    invoices = Column(Integer, nullable=False, default=0)
+    cost_usd = Column(Float, nullable=False, default=0.0)
+    tokens = Column(Integer, nullable=False, default=0)
+    cost_requests = Column(Integer, nullable=False, default=0)  # procesadas con costo registrado
+
+    # Por día de procesamiento
+    processed = Column(Integer, nullable=False, default=0)
+    confidence_sum = Column(Float, nullable=False, default=0.0)
+    confidence_count = Column(Integer, nullable=False, default=0)
+    alerts = Column(Integer, nullable=False, default=0)  # facturas con al menos una alerta
+    alerts_fiscal = Column(Integer, nullable=False, default=0)
+    alerts_duplicate = Column(Integer, nullable=False, default=0)
+    alerts_age = Column(Integer, nullable=False, default=0)
+    alerts_legibility = Column(Integer, nullable=False, default=0)
+    alerts_tax = Column(Integer, nullable=False, default=0)
+    alerts_other = Column(Integer, nullable=False, default=0)
+
+class ArchivedInvoice(Base):
+    """
+    Índice de facturas archivadas por retención (ver archive_service.py).
+    El registro completo vive en un segmento JSONL comprimido; aquí quedan
+    los campos de búsqueda y la ubicación para restaurarla.
+    """
+    __tablename__ = "archived_invoices"
+    __table_args__ = (
+        Index("ix_archived_invoices_org_created_id", "organization_id", "created_at", "id"),
+    )
+
+    id = Column(Integer, primary_key=True)  # id original de la factura
+    organization_id = Column(Integer, ForeignKey("organizations.id"), index=True)
+    filename = Column(String)
+    vendor_name = Column(String)
+    vendor_tax_id = Column(String)
+    invoice_number = Column(String)
+    invoice_date = Column(DateTime)
+    total_amount = Column(Float)
+    currency = Column(String)
+    search_text = Column(Text)
+    created_at = Column(DateTime)
+    segment = Column(String, nullable=False)  # ruta relativa a ARCHIVE_DIR
+    archived_file_path = Column(String)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "filename": self.filename,
+            "vendor_name": self.vendor_name,
+            "vendor_tax_id": self.vendor_tax_id,
+            "invoice_number": self.invoice_number,
+            "invoice_date": self.invoice_date.isoformat() if self.invoice_date else None,
+            "total_amount": self.total_amount,
+            "currency": self.currency,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "archived_at": self.archived_at.isoformat() if self.archived_at else None,
+            "has_file": bool(self.archived_file_path)
+        }
+
 def init_default_settings(db_session, org_id: int):
     """Inicializar configuraciones por defecto si no existen"""
     defaults = [
@@ -398,13 +1007,13 @@ def migrate_multitenant_tables(engine):
 
 def init_database():
     """Inicializar la base de datos de forma segura"""
+    from migrations import MigrationError, run_migrations
     try:
         # Usar checkfirst=True para evitar errores si las tablas ya existen
         Base.metadata.create_all(bind=engine, checkfirst=True)
         
-        # Ejecutar migración manual si es necesario
-        migrate_invoices_table(engine)
-        migrate_multitenant_tables(engine)
+        # Ejecutar migraciones versionadas pendientes (ver migrations.py)
+        run_migrations(engine)
         
         logger.info("✅ Tablas de base de datos inicializadas correctamente")
         
@@ -421,16 +1030,23 @@ def init_database():
 
         # Asignar org por defecto a registros sin organización
         db.query(User).filter(User.organization_id.is_(None)).update({"organization_id": org.id})
-        db.query(Invoice).filter(Invoice.organization_id.is_(None)).update({"organization_id": org.id})
+        orphan_invoices = db.query(Invoice).filter(Invoice.organization_id.is_(None)).update({"organization_id": org.id})
         db.query(Notification).filter(Notification.organization_id.is_(None)).update({"organization_id": org.id})
         db.query(WebhookEndpoint).filter(WebhookEndpoint.organization_id.is_(None)).update({"organization_id": org.id})
         db.query(Setting).filter(Setting.organization_id.is_(None)).update({"organization_id": org.id})
         db.commit()
+        if orphan_invoices:
+            # El update masivo no pasa por los eventos del ORM
+            from statistics_service import rebuild_rollups
+            rebuild_rollups(engine, org.id)
 
         # Inicializar settings por organización
         init_default_settings(db, org.id)
         db.close()
         
+    except MigrationError:
+        # Un esquema a medio migrar falla después en cada request: no arrancar
+        raise
     except Exception as e:
         logger.error(f"❌ Error inicializando tablas: {e}")
         # No hacer raise aquí - las tablas pueden ya existir
@@ -441,4 +1057,162 @@ def get_db():
     try:
         yield db
     finally:
-        db.close() 
+        db.close()
+
+async def get_async_db():
+    """Sesión asíncrona (endpoints de lectura calientes)"""
+    if AsyncSessionLocal is None:
+        raise RuntimeError("Motor asíncrono no disponible: instala asyncpg/aiosqlite")
+    async with AsyncSessionLocal() as db:
+        yield db
+
+# ===========================================
+# ENRUTAMIENTO DE LECTURAS (RÉPLICA)
+# ===========================================
+
+# Usuario de la petición en curso (lo fija la dependencia de autenticación);
+# sirve para marcar sus escrituras al confirmar la sesión.
+current_user_id: ContextVar[Optional[int]] = ContextVar("current_user_id", default=None)
+
+_replica_lag = {"checked_at": 0.0, "lag": None}
+
+
+def _measure_replica_lag() -> Optional[float]:
+    """Retraso de la réplica en segundos (None si no responde). Bloqueante"""
+    try:
+        with replica_engine.connect() as conn:
+            if replica_engine.dialect.name != "postgresql":
+                # Réplicas locales de prueba (SQLite): sin replicación que medir
+                conn.execute(text("SELECT 1"))
+                return 0.0
+            lag = conn.execute(text(
+                "SELECT CASE WHEN NOT pg_is_in_recovery() "
+                "OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+            )).scalar()
+            return float(lag or 0)
+    except Exception as e:
+        logger.warning(f"⚠️ Réplica de lectura no disponible: {e}")
+        return None
+
+
+def refresh_replica_lag() -> Optional[float]:
+    """Mide el retraso y lo guarda para replica_lag_seconds (fuera del event loop)"""
+    lag = _measure_replica_lag()
+    _replica_lag["lag"] = lag
+    _replica_lag["checked_at"] = time.monotonic()
+    return lag
+
+
+def replica_lag_seconds() -> Optional[float]:
+    """
+    Último retraso medido por ReplicaLagMonitor; nunca consulta la réplica.
+    None (leer del primario) si no hay medición reciente: monitor detenido o
+    réplica colgada en el connect.
+    """
+    if replica_engine is None:
+        return None
+    if time.monotonic() - _replica_lag["checked_at"] > REPLICA_LAG_CHECK_INTERVAL * 3:
+        return None
+    return _replica_lag["lag"]
+
+
+def replica_is_usable() -> bool:
+    lag = replica_lag_seconds()
+    return lag is not None and lag <= REPLICA_MAX_LAG_SECONDS
+
+
+class ReplicaLagMonitor:
+    """Mide el retraso de la réplica cada REPLICA_LAG_CHECK_INTERVAL en un hilo"""
+
+    def __init__(self, interval: float = REPLICA_LAG_CHECK_INTERVAL):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def start(self):
+        if replica_engine is None:
+            return
+        loop = asyncio.get_running_loop()
+        if self._task is not None and not self._task.done() and self._loop is loop:
+            return
+        self._loop = loop
+        self._task = loop.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None or self._loop is not asyncio.get_running_loop():
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            # El connect puede tardar todo su timeout si la réplica cae
+            await asyncio.to_thread(refresh_replica_lag)
+            await asyncio.sleep(self.interval)
+
+
+replica_lag_monitor = ReplicaLagMonitor()
+
+
+def _recent_write_key(user_id: int) -> str:
+    return f"rw:user:{user_id}"
+
+
+def mark_user_write(user_id: int):
+    """El usuario acaba de escribir: sus lecturas van al primario por un tiempo"""
+    tiered_set(_recent_write_key(user_id), time.time(), ttl=READ_YOUR_WRITES_SECONDS)
+
+
+def has_recent_write(user_id: Optional[int]) -> bool:
+    if not user_id:
+        return False
+    written_at = tiered_get(_recent_write_key(user_id))
+    return written_at is not None and time.time() - written_at < READ_YOUR_WRITES_SECONDS
+
+
+def _use_replica(user_id: Optional[int]) -> bool:
+    if user_id is None:
+        user_id = current_user_id.get()
+    return not has_recent_write(user_id) and replica_is_usable()
+
+
+def get_read_session(user_id: Optional[int] = None):
+    """
+    Sesión para lecturas pesadas: réplica si está configurada, al día y el
+    usuario no escribió recientemente; si no, el primario.
+    """
+    if ReplicaSessionLocal is not None and _use_replica(user_id):
+        return ReplicaSessionLocal()
+    return SessionLocal()
+
+
+def get_async_read_session(user_id: Optional[int] = None):
+    """Variante asíncrona de get_read_session"""
+    if AsyncReplicaSessionLocal is not None and _use_replica(user_id):
+        return AsyncReplicaSessionLocal()
+    return AsyncSessionLocal()
+
+
+@event.listens_for(Session, "after_flush")
+def _flag_session_writes(session, flush_context):
+    session.info["_has_writes"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _mark_user_writes(session):
+    if session.info.pop("_has_writes", False) and ReplicaSessionLocal is not None:
+        user_id = current_user_id.get()
+        if user_id:
+            mark_user_write(user_id)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_session_writes(session, previous_transaction):
+    if previous_transaction.nested:
+        return
+    session.info.pop("_has_writes", None) 
@@ -0,0 +1,277 @@
+"""
+Persistencia de notificaciones por lotes y contador de no leídas.
+
+``websocket_manager.broadcast`` ya no escribe en la BD: encola la fila en
+``notification_writer`` y sigue. Una tarea de fondo inserta lo acumulado con
+un solo INSERT cada ``NOTIFICATION_FLUSH_INTERVAL`` segundos (o al llegar a
+``NOTIFICATION_BATCH_SIZE`` filas). La cola está acotada: si la BD no da
+abasto se descartan notificaciones nuevas en vez de crecer sin límite (el
+envío por WebSocket no se ve afectado).
+
+El número de no leídas por organización vive en Redis
+(``notifications:unread:<org>``): se incrementa al insertar, se ajusta al
+marcar como leídas y se recalcula con un COUNT indexado cuando falta o
+cuando se borran notificaciones en bloque. Sin Redis se usa siempre el COUNT.
+
+La misma tarea elimina periódicamente las notificaciones con más de
+``NOTIFICATION_RETENTION_DAYS`` días.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.orm import Session
+
+from models import Invoice, Notification
+from redis_client import get_redis_client
+from writer_service import run_write
+
+logger = logging.getLogger(__name__)
+
+NOTIFICATION_BATCH_SIZE = 200
+# Segundos máximos que una notificación espera en la cola
+NOTIFICATION_FLUSH_INTERVAL = 0.25
+# Notificaciones en espera como máximo
+NOTIFICATION_QUEUE_MAX = 10000
+NOTIFICATION_RETENTION_DAYS = int(os.getenv("NOTIFICATION_RETENTION_DAYS", "30"))
+# Segundos entre podas
+NOTIFICATION_PRUNE_INTERVAL = 3600
+NOTIFICATION_PRUNE_CHUNK = 5000
+
+UNREAD_KEY_PREFIX = "notifications:unread"
+# El contador se recalcula al menos con esta frecuencia (acota cualquier deriva)
+UNREAD_COUNT_TTL = 300
+
+# Títulos y tipos por tipo de mensaje del WebSocket
+_TITLES = {
+    "processing_complete": "Procesamiento Completado",
+    "whatsapp_image_received": "Nuevo Mensaje WhatsApp",
+    "invoice_uploaded": "Archivo Subido",
+    "cost_alert": "Alerta de Costos",
+}
+
+
+def notification_row(message: Dict[str, Any], org_id: Optional[int]) -> Dict[str, Any]:
+    """Fila de notifications para un mensaje de broadcast"""
+    message_type = message.get("type")
+    data = message.get("data") or {}
+    if message_type == "processing_complete":
+        notification_type = "success" if data.get("success") else "error"
+    elif message_type == "invoice_uploaded":
+        notification_type = "success"
+    elif message_type == "cost_alert":
+        notification_type = message.get("severity", "warning")
+    else:
+        notification_type = "info"
+
+    invoice_id = data.get("invoice_id")
+    return {
+        "type": notification_type,
+        "title": _TITLES.get(message_type, message_type or "Notificación"),
+        "message": message.get("message", ""),
+        "data": json.dumps(data),
+        "read": False,
+        "organization_id": org_id,
+        "invoice_id": invoice_id if isinstance(invoice_id, int) else None,
+        "created_at": datetime.utcnow(),
+    }
+
+
+# ===========================================
+# CONTADOR DE NO LEÍDAS
+# ===========================================
+
+def _unread_key(org_id: int) -> str:
+    return f"{UNREAD_KEY_PREFIX}:{org_id}"
+
+
+def _count_unread(db: Session, org_id: int) -> int:
+    return db.scalar(select(func.count(Notification.id)).where(
+        Notification.organization_id == org_id,
+        Notification.read == False
+    )) or 0
+
+
+def get_unread_count(db: Session, org_id: int) -> int:
+    """No leídas de la organización (Redis; COUNT indexado si no está)"""
+    r = get_redis_client()
+    if r:
+        try:
+            cached = r.get(_unread_key(org_id))
+            if cached is not None:
+                return max(0, int(cached))
+        except Exception as e:
+            logger.error(f"Error leyendo contador de notificaciones: {e}")
+    count = _count_unread(db, org_id)
+    if r:
+        try:
+            r.set(_unread_key(org_id), count, ex=UNREAD_COUNT_TTL, nx=True)
+        except Exception as e:
+            logger.error(f"Error guardando contador de notificaciones: {e}")
+    return count
+
+
+def adjust_unread_count(org_id: Optional[int], delta: int):
+    """Suma `delta` al contador (solo si existe; si no, se recalculará)"""
+    r = get_redis_client()
+    if not r or org_id is None or not delta:
+        return
+    try:
+        key = _unread_key(org_id)
+        if r.exists(key):
+            r.incrby(key, delta)
+    except Exception as e:
+        logger.error(f"Error actualizando contador de notificaciones: {e}")
+
+
+def reset_unread_count(org_id: Optional[int], value: Optional[int] = None):
+    """Fija el contador (p. ej. 0 tras marcar todas) o lo descarta para recalcularlo"""
+    r = get_redis_client()
+    if not r or org_id is None:
+        return
+    try:
+        if value is None:
+            r.delete(_unread_key(org_id))
+        else:
+            r.set(_unread_key(org_id), value, ex=UNREAD_COUNT_TTL)
+    except Exception as e:
+        logger.error(f"Error reiniciando contador de notificaciones: {e}")
+
+
+# ===========================================
+# ESCRITOR POR LOTES
+# ===========================================
+
+def _insert_notifications(db: Session, rows: List[Dict[str, Any]]) -> Counter:
+    """Inserta el lote; retorna las no leídas agregadas por organización"""
+    invoice_ids = {row["invoice_id"] for row in rows if row["invoice_id"]}
+    owners = {}
+    if invoice_ids:
+        owners = dict(db.execute(
+            select(Invoice.id, Invoice.organization_id).where(Invoice.id.in_(invoice_ids))
+        ).all())
+    for row in rows:
+        # La organización de la factura manda sobre la del mensaje
+        if row["invoice_id"] in owners:
+            row["organization_id"] = owners[row["invoice_id"]]
+    db.execute(insert(Notification), rows)
+    return Counter(row["organization_id"] for row in rows if row["organization_id"] is not None)
+
+
+def _prune_chunk(db: Session, older_than: datetime) -> Tuple[int, Set[int]]:
+    rows = db.execute(
+        select(Notification.id, Notification.organization_id)
+        .where(Notification.created_at < older_than)
+        .limit(NOTIFICATION_PRUNE_CHUNK)
+    ).all()
+    if rows:
+        db.execute(delete(Notification).where(Notification.id.in_([row.id for row in rows])))
+    return len(rows), {row.organization_id for row in rows if row.organization_id is not None}
+
+
+async def prune_notifications(older_than: datetime) -> int:
+    """Elimina por bloques (una transacción cada uno) las notificaciones anteriores a `older_than`"""
+    removed = 0
+    while True:
+        count, org_ids = await run_write(lambda db: _prune_chunk(db, older_than))
+        for org_id in org_ids:
+            reset_unread_count(org_id)
+        removed += count
+        if count < NOTIFICATION_PRUNE_CHUNK:
+            return removed
+
+
+class NotificationWriter:
+    """Cola acotada de notificaciones insertadas por lotes"""
+
+    def __init__(self, batch_size: int = NOTIFICATION_BATCH_SIZE, flush_interval: float = NOTIFICATION_FLUSH_INTERVAL, max_pending: int = NOTIFICATION_QUEUE_MAX):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._last_prune = 0.0
+        self.written = 0
+        self.dropped = 0
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        if self._task is not None and not self._task.done() and self._loop is loop:
+            return
+        self._loop = loop
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._task = loop.create_task(self._run())
+
+    def enqueue(self, message: Dict[str, Any], org_id: Optional[int]):
+        """Programa la persistencia de la notificación (no bloquea)"""
+        self.start()
+        try:
+            self._queue.put_nowait(notification_row(message, org_id))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if self.dropped % 100 == 1:
+                logger.warning(f"⚠️ Cola de notificaciones llena, {self.dropped} descartadas")
+
+    async def stop(self):
+        """Escribe lo pendiente y detiene la tarea"""
+        if self._task is None or self._loop is not asyncio.get_running_loop():
+            return
+        await self._queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                first = await asyncio.wait_for(self._queue.get(), timeout=NOTIFICATION_PRUNE_INTERVAL)
+            except asyncio.TimeoutError:
+                await self._maybe_prune()
+                continue
+
+            batch = [first]
+            try:
+                deadline = self._loop.time() + self.flush_interval
+                while len(batch) < self.batch_size:
+                    remaining = deadline - self._loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+                    except asyncio.TimeoutError:
+                        break
+
+                unread = await run_write(lambda db: _insert_notifications(db, batch))
+                for org_id, count in unread.items():
+                    adjust_unread_count(org_id, count)
+                self.written += len(batch)
+            except Exception as e:
+                logger.error(f"❌ Error guardando {len(batch)} notificaciones: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            await self._maybe_prune()
+
+    async def _maybe_prune(self):
+        if time.monotonic() - self._last_prune < NOTIFICATION_PRUNE_INTERVAL:
+            return
+        self._last_prune = time.monotonic()
+        try:
+            removed = await prune_notifications(datetime.utcnow() - timedelta(days=NOTIFICATION_RETENTION_DAYS))
+            if removed:
+                logger.info(f"🧹 {removed} notificaciones antiguas eliminadas")
+        except Exception as e:
+            logger.error(f"❌ Error podando notificaciones: {e}")
+
+
+notification_writer = NotificationWriter()
@@ -8,12 +8,13 @@ from PIL import Image
 import PyPDF2
 from io import BytesIO
 from dotenv import load_dotenv
-from typing import Optional, Dict, Any, Tuple
+from typing import Optional, Dict, Any, Tuple, AsyncIterator
 from cost_control_service import CostControlService, OpenAICostInfo
 
 load_dotenv()
 
-from models import Invoice, Setting, UserSetting, SessionLocal
+from models import Invoice
+from settings_service import get_setting
 
 class OpenAIInvoiceProcessor:
     def __init__(self):
@@ -35,28 +36,10 @@ class OpenAIInvoiceProcessor:
         self.cost_control = CostControlService()
     
     def _get_api_key(self, org_id: Optional[int] = None, user_id: Optional[int] = None):
-        """Obtiene la API Key actual desde BD o variables de entorno"""
-        api_key = None
-        try:
-            db = SessionLocal()
-            setting = None
-            if user_id:
-                setting = db.query(UserSetting).filter(
-                    UserSetting.key == "openai_api_key",
-                    UserSetting.user_id == user_id
-                ).first()
-            if not setting:
-                setting = db.query(Setting).filter(Setting.key == "openai_api_key").first()
-            db.close()
-            
-            if setting and setting.value and len(setting.value) > 10:
-                api_key = setting.value
-        except Exception as e:
-            print(f"⚠️ Error leyendo settings de BD: {e}")
-            
-        if not api_key:
+        """Obtiene la API Key actual desde el registro de settings o variables de entorno"""
+        api_key = get_setting("openai_api_key", org_id=org_id, user_id=user_id)
+        if not api_key or len(api_key) <= 10:
             api_key = os.getenv("OPENAI_API_KEY")
-            
         return api_key
 
     def _get_client(self, org_id: Optional[int] = None, user_id: Optional[int] = None):
@@ -798,28 +781,28 @@ class OpenAIInvoiceProcessor:
         else:
             raise ValueError(f"Tipo de archivo no soportado: {file_type}")
 
-    def process_finance_chat(self, query: str, context_data: list, org_id: Optional[int] = None, user_id: Optional[int] = None):
-        """
-        Procesa una pregunta en lenguaje natural sobre las finanzas.
-        Recibe:
-            - query: La pregunta del usuario (ej: "¿Cuánto gasté en Uber este mes?")
-            - context_data: Lista de diccionarios con datos de facturas (resumidos)
-        Retorna:
-            - Respuesta en texto del asistente
-        """
-        client = self._get_client(org_id=org_id, user_id=user_id)
-        if not client:
-            return "Lo siento, la API Key de OpenAI no está configurada."
+    def _get_async_client(self, org_id: Optional[int] = None, user_id: Optional[int] = None):
+        """Crea un cliente asíncrono de OpenAI (para respuestas en streaming)"""
+        api_key = self._get_api_key(org_id=org_id, user_id=user_id)
+
+        if not api_key or api_key.startswith("demo"):
+            return None
 
         try:
-            # Preparar el contexto de datos (limitar tamaño si es necesario)
-            # Convertir a JSON string para el prompt
-            data_context = json.dumps(context_data, ensure_ascii=False)
-            
-            # Si el contexto es muy grande, deberíamos truncarlo, pero por ahora asumimos < 50-100 facturas
-            # Un MVP seguro limita a las últimas 50 facturas relevantes
-            
-            system_prompt = """
+            return openai.AsyncOpenAI(api_key=api_key)
+        except:
+            return None
+
+    def _build_finance_chat_messages(self, query: str, context_data: list) -> list:
+        """Construye los mensajes (system + user) para el chat financiero"""
+        # Preparar el contexto de datos (limitar tamaño si es necesario)
+        # Convertir a JSON string para el prompt
+        data_context = json.dumps(context_data, ensure_ascii=False)
+
+        # Si el contexto es muy grande, deberíamos truncarlo, pero por ahora asumimos < 50-100 facturas
+        # Un MVP seguro limita a las últimas 50 facturas relevantes
+
+        system_prompt = """
             Eres el CFO (Chief Financial Officer) Inteligente de una empresa. 
             Tu trabajo es analizar los datos de facturas proporcionados y responder las preguntas del usuario de forma clara, concisa y profesional.
             
@@ -835,12 +818,28 @@ class OpenAIInvoiceProcessor:
             6. Si te preguntan por totales, suma los montos cuidadosamente.
             """.format(data=data_context)
 
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": query}
+        ]
+
+    def process_finance_chat(self, query: str, context_data: list, org_id: Optional[int] = None, user_id: Optional[int] = None):
+        """
+        Procesa una pregunta en lenguaje natural sobre las finanzas.
+        Recibe:
+            - query: La pregunta del usuario (ej: "¿Cuánto gasté en Uber este mes?")
+            - context_data: Lista de diccionarios con datos de facturas (resumidos)
+        Retorna:
+            - Respuesta en texto del asistente
+        """
+        client = self._get_client(org_id=org_id, user_id=user_id)
+        if not client:
+            return "Lo siento, la API Key de OpenAI no está configurada."
+
+        try:
             response = client.chat.completions.create(
                 model="gpt-4o", # Modelo rápido y capaz
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": query}
-                ],
+                messages=self._build_finance_chat_messages(query, context_data),
                 max_tokens=500,
                 temperature=0.3 
             )
@@ -849,4 +848,37 @@ class OpenAIInvoiceProcessor:
 
         except Exception as e:
             print(f"Error en chat financiero: {e}")
-            return "Lo siento, tuve un problema analizando tus datos. Intenta de nuevo más tarde." 
+            return "Lo siento, tuve un problema analizando tus datos. Intenta de nuevo más tarde."
+
+    async def stream_finance_chat(self, query: str, context_data: list, org_id: Optional[int] = None, user_id: Optional[int] = None) -> AsyncIterator[str]:
+        """
+        Variante en streaming de process_finance_chat.
+        Usa el cliente asíncrono de OpenAI, por lo que no ocupa un worker del
+        threadpool mientras se genera la respuesta.
+        Produce:
+            - Fragmentos de texto (tokens) a medida que OpenAI los genera
+        """
+        client = self._get_async_client(org_id=org_id, user_id=user_id)
+        if not client:
+            yield "Lo siento, la API Key de OpenAI no está configurada."
+            return
+
+        try:
+            stream = await client.chat.completions.create(
+                model="gpt-4o",
+                messages=self._build_finance_chat_messages(query, context_data),
+                max_tokens=500,
+                temperature=0.3,
+                stream=True
+            )
+
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+
+        except Exception as e:
+            print(f"Error en chat financiero (streaming): {e}")
+            yield "Lo siento, tuve un problema analizando tus datos. Intenta de nuevo más tarde."
@@ -0,0 +1,141 @@
+"""
+Paginación por cursor (keyset) y conteos baratos para listados grandes.
+
+El cursor es opaco para el cliente: codifica en base64 la última posición
+vista (created_at, id). La siguiente página se obtiene con
+``WHERE (created_at, id) < (:created_at, :id)`` sobre el índice
+(organization_id, created_at, id), por lo que la página 500 cuesta lo mismo
+que la página 1.
+"""
+import base64
+import hashlib
+import json
+import logging
+from datetime import datetime
+from typing import Optional, Tuple, Dict, Any
+
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import Query
+
+from redis_client import cache_get, cache_set, versioned_key
+
+logger = logging.getLogger(__name__)
+
+# Segundos que se reutiliza un total cacheado por filtro
+COUNT_CACHE_TTL = 60
+# Por encima de esta estimación del planner de Postgres no se hace COUNT(*) exacto
+EXACT_COUNT_THRESHOLD = 10000
+
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    """Genera un cursor opaco a partir de la última fila de la página"""
+    payload = json.dumps({"c": created_at.isoformat(), "i": row_id}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """
+    Decodifica un cursor generado por encode_cursor.
+    Lanza ValueError si el cursor es inválido.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return datetime.fromisoformat(payload["c"]), int(payload["i"])
+    except Exception:
+        raise ValueError("Cursor inválido")
+
+
+def encode_offset_cursor(offset: int) -> str:
+    """Cursor para resultados ordenados por relevancia (no admiten keyset)"""
+    payload = json.dumps({"o": offset}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_offset_cursor(cursor: str) -> int:
+    """Decodifica un cursor de encode_offset_cursor. Lanza ValueError si es inválido"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        return max(0, int(json.loads(base64.urlsafe_b64decode(padded.encode()))["o"]))
+    except Exception:
+        raise ValueError("Cursor inválido")
+
+
+def apply_keyset(query: Query, created_col, id_col, cursor: Optional[str]) -> Query:
+    """Ordena por (created_at DESC, id DESC) y avanza hasta después del cursor"""
+    if cursor:
+        created_at, row_id = decode_cursor(cursor)
+        query = query.filter(or_(
+            created_col < created_at,
+            and_(created_col == created_at, id_col < row_id)
+        ))
+    return query.order_by(created_col.desc(), id_col.desc())
+
+
+def paginate_keyset(query: Query, created_col, id_col, cursor: Optional[str], limit: int) -> Dict[str, Any]:
+    """
+    Ejecuta una página keyset.
+    Retorna {"items", "next_cursor", "has_more"}.
+    """
+    rows = apply_keyset(query, created_col, id_col, cursor).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    next_cursor = None
+    if has_more and rows:
+        last = rows[-1]
+        next_cursor = encode_cursor(getattr(last, created_col.key), getattr(last, id_col.key))
+
+    return {"items": rows, "next_cursor": next_cursor, "has_more": has_more}
+
+
+def count_cache_key(namespace: str, org_id: int, filters: Dict[str, Any]) -> str:
+    """Clave de caché para un conjunto de filtros (en la generación "stats" de la organización)"""
+    digest = hashlib.sha1(json.dumps(filters, sort_keys=True, default=str).encode()).hexdigest()[:16]
+    return versioned_key("stats", org_id, "count", namespace, digest)
+
+
+def _planner_estimate(query: Query) -> Optional[int]:
+    """Filas estimadas por el planner de Postgres para la consulta (sin ejecutarla)"""
+    session = query.session
+    bind = session.get_bind()
+    if bind.dialect.name != "postgresql":
+        return None
+
+    # Parámetros al driver tal cual: un término de búsqueda con ":palabra" o
+    # "%" no debe reinterpretarse como bind al pasar por text()
+    compiled = query.statement.compile(dialect=bind.dialect)
+    params = compiled.params
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+    try:
+        # SAVEPOINT: un error del servidor no debe abortar la transacción del request
+        with session.begin_nested():
+            plan = session.connection().exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled}", params).scalar()
+        return int(plan[0]["Plan"]["Plan Rows"])
+    except Exception as e:
+        logger.warning(f"⚠️ No se pudo estimar conteo: {e}")
+        return None
+
+
+def estimate_count(query: Query, cache_key: str) -> Dict[str, Any]:
+    """
+    Conteo aproximado y barato de una consulta filtrada.
+
+    1. Total cacheado en Redis para este filtro (TTL corto).
+    2. En Postgres, si el planner estima más de EXACT_COUNT_THRESHOLD filas,
+       se devuelve la estimación sin recorrer la tabla.
+    3. En otro caso, COUNT(*) exacto, que se cachea.
+    """
+    cached = cache_get(cache_key)
+    if isinstance(cached, dict) and "total" in cached:
+        return {"total": cached["total"], "estimated": True}
+
+    estimate = _planner_estimate(query)
+    if estimate is not None and estimate > EXACT_COUNT_THRESHOLD:
+        cache_set(cache_key, {"total": estimate}, ttl=COUNT_CACHE_TTL)
+        return {"total": estimate, "estimated": True}
+
+    total = query.order_by(None).count()
+    cache_set(cache_key, {"total": total}, ttl=COUNT_CACHE_TTL)
+    return {"total": total, "estimated": False}
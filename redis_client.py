@@ -1,9 +1,14 @@
 import os
 import redis
 import json
-from typing import Optional, Any
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Any, Callable, Dict, Hashable, Iterable, Set, Tuple
 from dotenv import load_dotenv
 import logging
+from sqlalchemy import event
+from sqlalchemy.orm import Session
 
 load_dotenv()
 
@@ -92,14 +97,16 @@ def cache_set(key: str, value: Any, ttl: int = 300) -> bool:
 
 def cache_delete(key: str) -> bool:
     """
-    Elimina valor del caché
+    Elimina valor del caché (sin Redis, al menos de la memoria local)
     """
     try:
         r = get_redis_client()
         if not r:
+            local_cache.delete(key)
             return False
 
         r.delete(key)
+        publish_invalidation(key)
         return True
 
     except Exception as e:
@@ -174,33 +181,315 @@ def is_duplicate_message(message_id: str, ttl: int = 86400) -> bool:
         return False  # En caso de error, asumir que es nuevo
 
 
-def invalidate_cache_pattern(pattern: str) -> int:
+# GET + DEL en un solo paso: entre un GET y un DELETE separados el lock
+# puede expirar y pasar a otro proceso, y se borraría el lock ajeno
+_RELEASE_LOCK_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+
+def release_lock(key: str, token: str) -> bool:
     """
-    Invalida todas las claves que coincidan con un patrón
+    Libera un lock tomado con SET NX solo si sigue guardando nuestro token.
+    Retorna True si se liberó.
+    """
+    try:
+        r = get_redis_client()
+        if not r or not token:
+            return False
+        return bool(r.eval(_RELEASE_LOCK_SCRIPT, 1, key, token))
+    except Exception as e:
+        logger.error(f"Error en release_lock({key}): {e}")
+        return False
 
-    Args:
-        pattern: Patrón de Redis (ej: "stats:*", "settings:*")
 
-    Returns:
-        Número de claves eliminadas
+# ===========================================
+# CACHÉ LOCAL EN MEMORIA (PRIMER NIVEL)
+# ===========================================
+# LRU con TTL por proceso delante de Redis para lecturas muy frecuentes.
+# La coherencia entre procesos se mantiene publicando en Redis las claves
+# invalidadas; cada proceso escucha el canal y las borra de su memoria.
+# El TTL local (corto) acota la desactualización si se pierde un mensaje.
+
+LOCAL_CACHE_MAX_ITEMS = int(os.getenv("LOCAL_CACHE_MAX_ITEMS", "2048"))
+LOCAL_CACHE_TTL = int(os.getenv("LOCAL_CACHE_TTL", "30"))
+INVALIDATION_CHANNEL = "cache:invalidate"
+
+
+class LocalCache:
+    """LRU acotado con expiración por entrada (thread-safe)"""
+
+    def __init__(self, max_items: int = LOCAL_CACHE_MAX_ITEMS, default_ttl: int = LOCAL_CACHE_TTL):
+        self.max_items = max_items
+        self.default_ttl = default_ttl
+        self._data: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        # Tags de este proceso (sin Redis son los únicos)
+        self._tags: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        """Retorna (encontrado, valor)"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return False, None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return True, value
+
+    def set(self, key: str, value: Any, ttl: Optional[int] = None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (ttl or self.default_ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_items:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, *keys: str):
+        with self._lock:
+            for key in keys:
+                if self._data.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def tag(self, tag: str, *keys: str):
+        with self._lock:
+            self._tags.setdefault(tag, set()).update(keys)
+
+    def pop_tag(self, tag: str) -> Set[str]:
+        """Claves del tag (el tag se olvida)"""
+        with self._lock:
+            return self._tags.pop(tag, set())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._tags.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "items": len(self._data),
+                "max_items": self.max_items,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "hit_rate": round(self.hits / max(total, 1) * 100, 2)
+            }
+
+
+local_cache = LocalCache()
+_invalidation_thread = None
+
+
+def publish_invalidation(*keys: str):
+    """Borra las claves de la memoria local y avisa al resto de procesos"""
+    if not keys:
+        return
+    local_cache.delete(*keys)
+    try:
+        r = get_redis_client()
+        if r:
+            r.publish(INVALIDATION_CHANNEL, json.dumps(list(keys)))
+    except Exception as e:
+        logger.error(f"Error publicando invalidación de caché: {e}")
+
+
+def invalidate_on_commit(info_key: str, collect: Callable[[Any], Iterable[Hashable]], invalidate: Callable[[Set[Hashable]], None]):
+    """
+    Invalida cachés al confirmar cambios en la BD (eventos de Session):
+    after_flush junta en ``session.info[info_key]`` lo que devuelve
+    ``collect(obj)`` para cada objeto escrito, after_commit llama a
+    ``invalidate(claves)`` y un rollback de la transacción externa lo
+    descarta. El rollback de un SAVEPOINT no descarta nada: la transacción
+    externa sigue en curso.
     """
+    @event.listens_for(Session, "after_flush")
+    def _collect_changes(session: Session, flush_context):
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            items = collect(obj)
+            if items:
+                session.info.setdefault(info_key, set()).update(items)
+
+    @event.listens_for(Session, "after_commit")
+    def _invalidate_changes(session: Session):
+        items = session.info.pop(info_key, None)
+        if items:
+            invalidate(items)
+
+    @event.listens_for(Session, "after_soft_rollback")
+    def _discard_changes(session: Session, previous_transaction):
+        if previous_transaction.nested:
+            return
+        session.info.pop(info_key, None)
+
+
+def _handle_invalidation(message):
+    try:
+        keys = json.loads(message["data"])
+        if isinstance(keys, list):
+            local_cache.delete(*keys)
+    except Exception as e:
+        logger.error(f"Mensaje de invalidación inválido: {e}")
+
+
+def start_invalidation_listener():
+    """Suscribe este proceso al canal de invalidación (idempotente)"""
+    global _invalidation_thread
+    if _invalidation_thread is not None:
+        return _invalidation_thread
+    r = get_redis_client()
+    if not r:
+        return None
+    try:
+        pubsub = r.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{INVALIDATION_CHANNEL: _handle_invalidation})
+        _invalidation_thread = pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+        logger.info("📡 Escuchando invalidaciones de caché local")
+    except Exception as e:
+        logger.error(f"❌ No se pudo suscribir a invalidaciones de caché: {e}")
+        # Sin suscripción, el TTL local acota la desactualización
+    return _invalidation_thread
+
+
+def tiered_get(key: str) -> Optional[Any]:
+    """Lee primero de memoria y, si no está, de Redis (y lo guarda en memoria)"""
+    found, value = local_cache.get(key)
+    if found:
+        return value
+    value = cache_get(key)
+    if value is not None:
+        local_cache.set(key, value)
+    return value
+
+
+def tiered_set(key: str, value: Any, ttl: int = 300, local_ttl: Optional[int] = None) -> bool:
+    """Guarda en Redis (TTL `ttl`) y en memoria (TTL local corto)"""
+    local_cache.set(key, value, ttl=min(local_ttl or LOCAL_CACHE_TTL, ttl))
+    return cache_set(key, value, ttl=ttl)
+
+
+# ===========================================
+# INVALIDACIÓN POR GENERACIÓN Y TAGS
+# ===========================================
+# Las claves de caché por organización incluyen un número de generación
+# (ej: "stats:7:v12:dashboard"). Invalidar es un INCR del contador: las
+# claves viejas dejan de leerse y expiran solas por TTL. Para claves que no
+# se pueden versionar se usan tags: un SET con las claves a borrar.
+
+GENERATION_PREFIX = "gen"
+TAG_PREFIX = "tag"
+TAG_TTL = 86400
+
+
+def get_generation(namespace: str, org_id: Optional[int]) -> int:
+    """Generación actual de un namespace para una organización (0 si no existe)"""
+    key = f"{GENERATION_PREFIX}:{namespace}:{org_id}"
+    found, value = local_cache.get(key)
+    if found:
+        return value
     try:
         r = get_redis_client()
         if not r:
             return 0
+        value = r.get(key)
+        generation = int(value) if value else 0
+        local_cache.set(key, generation)
+        return generation
+    except Exception as e:
+        logger.error(f"Error en get_generation({namespace}, {org_id}): {e}")
+        return 0
 
-        # Encontrar todas las claves que coincidan
-        keys = r.keys(pattern)
 
-        if keys:
-            deleted = r.delete(*keys)
-            logger.info(f"🗑️ Invalidadas {deleted} claves de caché ({pattern})")
-            return deleted
+def versioned_key(namespace: str, org_id: Optional[int], *parts: Any) -> str:
+    """Clave de caché con la generación actual: {namespace}:{org_id}:v{gen}:{parts}"""
+    generation = get_generation(namespace, org_id)
+    suffix = ":".join(str(p) for p in parts)
+    return f"{namespace}:{org_id}:v{generation}:{suffix}"
 
+
+def bump_generation(namespace: str, org_id: Optional[int]) -> int:
+    """
+    Invalida todas las claves de un namespace de una organización en O(1).
+    Retorna la nueva generación.
+    """
+    try:
+        r = get_redis_client()
+        if not r:
+            return 0
+        key = f"{GENERATION_PREFIX}:{namespace}:{org_id}"
+        generation = r.incr(key)
+        publish_invalidation(key)
+        logger.info(f"🗑️ Caché '{namespace}' de org {org_id} invalidado (v{generation})")
+        return generation
+    except Exception as e:
+        logger.error(f"Error en bump_generation({namespace}, {org_id}): {e}")
         return 0
 
+
+def tag_keys(tag: str, *keys: str) -> bool:
+    """Asocia claves de caché a un tag para poder purgarlas juntas"""
+    if not keys:
+        return False
+    local_cache.tag(tag, *keys)
+    try:
+        r = get_redis_client()
+        if not r:
+            return False
+        tag_key = f"{TAG_PREFIX}:{tag}"
+        pipe = r.pipeline()
+        pipe.sadd(tag_key, *keys)
+        pipe.expire(tag_key, TAG_TTL)
+        pipe.execute()
+        return True
     except Exception as e:
-        logger.error(f"Error en invalidate_cache_pattern({pattern}): {e}")
+        logger.error(f"Error en tag_keys({tag}): {e}")
+        return False
+
+
+def invalidate_tag(tag: str) -> int:
+    """
+    Borra las claves asociadas a un tag (solo los miembros del tag, sin
+    recorrer el keyspace). Retorna el número de claves eliminadas.
+    """
+    # Memoria local aunque Redis no esté disponible
+    local_keys = local_cache.pop_tag(tag)
+    local_cache.delete(*local_keys)
+    try:
+        r = get_redis_client()
+        if not r:
+            return len(local_keys)
+        tag_key = f"{TAG_PREFIX}:{tag}"
+        keys = r.smembers(tag_key)
+        pipe = r.pipeline()
+        if keys:
+            pipe.delete(*keys)
+        pipe.delete(tag_key)
+        deleted = pipe.execute()[0] if keys else 0
+        if keys:
+            publish_invalidation(*keys)
+        if deleted:
+            logger.info(f"🗑️ Invalidadas {deleted} claves de caché (tag {tag})")
+        return deleted
+    except Exception as e:
+        logger.error(f"Error en invalidate_tag({tag}): {e}")
         return 0
 
 
@@ -211,7 +500,7 @@ def get_cache_stats() -> dict:
     try:
         r = get_redis_client()
         if not r:
-            return {"status": "disabled"}
+            return {"status": "disabled", "local": local_cache.stats()}
 
         info = r.info("stats")
 
@@ -224,9 +513,10 @@ def get_cache_stats() -> dict:
                 info.get("keyspace_hits", 0) /
                 max(info.get("keyspace_hits", 0) + info.get("keyspace_misses", 0), 1) * 100,
                 2
-            )
+            ),
+            "local": local_cache.stats()
         }
 
     except Exception as e:
         logger.error(f"Error obteniendo stats de Redis: {e}")
-        return {"status": "error", "error": str(e)}
+        return {"status": "error", "error": str(e), "local": local_cache.stats()}
@@ -0,0 +1,188 @@
+"""
+Registro de eventos WebSocket para reconectar sin recargar.
+
+Cada broadcast de una organización recibe un ``event_id`` creciente y se
+guarda en un buffer circular por organización. Un cliente que se reconecta a
+``/ws?last_event_id=<id>`` recibe solo los eventos posteriores a ese id; si
+el id ya salió del buffer (o es de otro arranque) se le envía
+``resync_required`` y recarga todo, como antes.
+
+- Con Redis, la fuente de verdad es un stream por organización
+  (``ws:events:<org>``, acotado a ``WS_REPLAY_BUFFER`` entradas): los ids
+  los asigna XADD y son los mismos en todos los procesos. Cada proceso
+  guarda además en memoria los eventos de las organizaciones con sockets
+  abiertos en él, y solo va a Redis si su copia no alcanza.
+- Sin Redis, el buffer en memoria es la fuente de verdad; los ids llevan el
+  instante de arranque del proceso ("<ms>-<n>", mismo formato que Redis),
+  así que tras un reinicio los ids viejos fuerzan resincronización.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from redis_client import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+WS_REPLAY_BUFFER = int(os.getenv("WS_REPLAY_BUFFER", "500"))
+REPLAY_STREAM_PREFIX = "ws:events"
+# El stream de una organización sin actividad expira solo
+REPLAY_STREAM_TTL = 86400
+
+# Mensajes que no se numeran ni se guardan
+UNSEQUENCED_TYPES = ("heartbeat", "connection_established", "pong", "resync_required")
+
+
+def parse_event_id(event_id: Optional[str]) -> Optional[Tuple[int, int]]:
+    """"<ms>-<n>" -> (ms, n); None si no es válido"""
+    try:
+        ms, seq = str(event_id).split("-")
+        return int(ms), int(seq)
+    except (TypeError, ValueError):
+        return None
+
+
+class EventLog:
+    """Eventos recientes por organización (memoria + stream de Redis)"""
+
+    def __init__(self, size: int = WS_REPLAY_BUFFER):
+        self.size = size
+        self._rings: Dict[int, Deque[Tuple[str, str]]] = {}
+        self._boot_ms = int(time.time() * 1000)
+        self._counter = 0
+        self.replayed = 0
+        self.resyncs = 0
+
+    def _stream_key(self, org_id: int) -> str:
+        return f"{REPLAY_STREAM_PREFIX}:{org_id}"
+
+    def sequenced(self, message: Dict[str, Any], org_id: Optional[int]) -> bool:
+        return org_id is not None and message.get("type") not in UNSEQUENCED_TYPES
+
+    def _xadd(self, r, org_id: int, message: Dict[str, Any]) -> str:
+        key = self._stream_key(org_id)
+        pipe = r.pipeline()
+        pipe.xadd(key, {"m": json.dumps(message)}, maxlen=self.size, approximate=True)
+        pipe.expire(key, REPLAY_STREAM_TTL)
+        return pipe.execute()[0]
+
+    async def append(self, message: Dict[str, Any], org_id: int) -> Tuple[str, Optional[str]]:
+        """Asigna event_id al mensaje; retorna (mensaje serializado, event_id)"""
+        r = get_redis_client()
+        event_id = None
+        if r:
+            try:
+                # Cliente síncrono: el XADD va en un hilo para no frenar el loop
+                event_id = await asyncio.to_thread(self._xadd, r, org_id, message)
+            except Exception as e:
+                # Sin id el evento se entrega igual, solo no se podrá reenviar
+                logger.error(f"Error guardando evento WebSocket en Redis: {e}")
+        else:
+            self._counter += 1
+            event_id = f"{self._boot_ms}-{self._counter}"
+        if event_id is not None:
+            message["event_id"] = event_id
+        return json.dumps(message), event_id
+
+    def record(self, org_id: Optional[int], event_id: str, message_str: str, subscribed: bool = True):
+        """Guarda en memoria un evento entregado en este proceso"""
+        if org_id is None:
+            return
+        if not subscribed and get_redis_client():
+            # Proceso no suscrito a la organización: su copia tendría huecos
+            return
+        ring = self._rings.get(org_id)
+        if ring is None:
+            ring = self._rings[org_id] = deque(maxlen=self.size)
+        key = parse_event_id(event_id)
+        if key is None:
+            ring.append((event_id, message_str))
+            return
+        # Desde otros procesos los eventos pueden llegar desordenados: el
+        # buffer se mantiene ordenado por id (normalmente va al final)
+        index = len(ring)
+        while index:
+            previous = parse_event_id(ring[index - 1][0])
+            if previous is None or previous < key:
+                break
+            if previous == key:
+                return
+            index -= 1
+        if len(ring) == ring.maxlen:
+            if index == 0:
+                # Más viejo que todo el buffer: ya no se reenviaría
+                return
+            ring.popleft()
+            index -= 1
+        ring.insert(index, (event_id, message_str))
+
+    def forget(self, org_id: Optional[int]):
+        """
+        Sin sockets de la organización este proceso deja de recibir sus
+        eventos: su copia en memoria tendría huecos. Sin Redis no hay otros
+        procesos y la copia se conserva.
+        """
+        if get_redis_client():
+            self._rings.pop(org_id, None)
+
+    def _since_memory(self, org_id: int, last_event_id: str) -> Optional[List[str]]:
+        ring = self._rings.get(org_id)
+        if not ring:
+            return None
+        missed = []
+        for event_id, message_str in reversed(ring):
+            if event_id == last_event_id:
+                missed.reverse()
+                return missed
+            missed.append(message_str)
+        return None
+
+    def _since_redis(self, org_id: int, last_event_id: str) -> Optional[List[str]]:
+        r = get_redis_client()
+        if not r:
+            return None
+        try:
+            entries = r.xrange(self._stream_key(org_id), min=last_event_id, max="+", count=self.size + 1)
+        except Exception as e:
+            logger.error(f"Error leyendo eventos WebSocket de Redis: {e}")
+            return None
+        # El último evento visto debe seguir en el stream; si no, hubo recorte
+        if not entries or entries[0][0] != last_event_id:
+            return None
+        missed = []
+        for event_id, fields in entries[1:]:
+            message = json.loads(fields["m"])
+            message["event_id"] = event_id
+            missed.append(json.dumps(message))
+        return missed
+
+    def since(self, org_id: int, last_event_id: Optional[str]) -> Optional[List[str]]:
+        """
+        Eventos posteriores a `last_event_id` (lista vacía si no se perdió
+        nada) o None si ya no están disponibles y el cliente debe resincronizar.
+        """
+        if parse_event_id(last_event_id) is None:
+            self.resyncs += 1
+            return None
+        missed = self._since_memory(org_id, last_event_id)
+        if missed is None:
+            missed = self._since_redis(org_id, last_event_id)
+        if missed is None:
+            self.resyncs += 1
+        else:
+            self.replayed += len(missed)
+        return missed
+
+    def stats(self) -> dict:
+        return {
+            "replay_buffer": self.size,
+            "replayed_events": self.replayed,
+            "replay_resyncs": self.resyncs,
+        }
+
+
+event_log = EventLog()
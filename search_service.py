@@ -0,0 +1,172 @@
+"""
+Búsqueda indexada de facturas.
+
+El texto buscable vive en ``Invoice.search_text`` (se recalcula en cada
+insert/update vía ORM, ver models.py) y se indexa según el motor:
+
+- PostgreSQL: índice GIN sobre ``to_tsvector('simple', search_text)`` para
+  texto completo con ranking, e índice GIN ``gin_trgm_ops`` (pg_trgm) para
+  coincidencias parciales y difusas (errores de tipeo en el proveedor).
+- SQLite: tabla virtual FTS5 ``invoices_fts`` con contenido externo,
+  sincronizada por triggers, con ranking bm25.
+
+Si el índice no está disponible se recurre a ILIKE sobre search_text.
+"""
+import logging
+import re
+from typing import Optional
+
+from sqlalchemy import func, or_, false, literal_column, text, table, column
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Query, Session
+
+from models import Invoice
+
+logger = logging.getLogger(__name__)
+
+# Configuración de texto de Postgres: 'simple' no aplica stemming, lo que
+# mantiene NCF y RNC intactos; la tolerancia a variaciones la da pg_trgm.
+SEARCH_TS_CONFIG = "simple"
+FTS_TABLE = "invoices_fts"
+fts_table = table(FTS_TABLE, column("rowid"))
+
+# Backend detectado por proceso: "postgres", "postgres_trgm", "fts5" o "like"
+_backend: Optional[str] = None
+
+
+def _tokens(term: str) -> list:
+    """Tokens alfanuméricos del término (evita inyectar sintaxis de FTS/tsquery)"""
+    return [t for t in re.findall(r"\w+", term.lower()) if t]
+
+
+def _ts_vector():
+    return func.to_tsvector(
+        literal_column(f"'{SEARCH_TS_CONFIG}'::regconfig"),
+        func.coalesce(Invoice.search_text, "")
+    )
+
+
+def detect_backend(engine: Engine) -> str:
+    """Detecta qué índice de búsqueda está disponible (se cachea por proceso)"""
+    global _backend
+    if _backend is not None:
+        return _backend
+
+    backend = "like"
+    try:
+        with engine.connect() as conn:
+            if engine.dialect.name == "postgresql":
+                has_trgm = conn.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).first()
+                backend = "postgres_trgm" if has_trgm else "postgres"
+            elif engine.dialect.name == "sqlite":
+                has_fts = conn.execute(
+                    text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                    {"name": FTS_TABLE}
+                ).first()
+                backend = "fts5" if has_fts else "like"
+    except Exception as e:
+        logger.warning(f"⚠️ No se pudo detectar backend de búsqueda: {e}")
+
+    _backend = backend
+    logger.info(f"🔎 Backend de búsqueda: {backend}")
+    return backend
+
+
+def reset_backend():
+    """Forzar nueva detección (tras migraciones)"""
+    global _backend
+    _backend = None
+
+
+def apply_search(query: Query, db: Session, term: str) -> Query:
+    """
+    Filtra `query` (sobre Invoice) por el término y la ordena por relevancia.
+    """
+    tokens = _tokens(term)
+    if not tokens:
+        return query.filter(false())
+
+    backend = detect_backend(db.get_bind())
+
+    if backend.startswith("postgres"):
+        ts_query = func.to_tsquery(
+            literal_column(f"'{SEARCH_TS_CONFIG}'::regconfig"),
+            " & ".join(f"{t}:*" for t in tokens)
+        )
+        pattern = f"%{term.strip()}%"
+        conditions = [_ts_vector().op("@@")(ts_query)]
+        rank = func.ts_rank(_ts_vector(), ts_query)
+        if backend == "postgres_trgm":
+            # Indexables con gin_trgm_ops: subcadena y similitud de palabra
+            conditions.append(Invoice.search_text.ilike(pattern))
+            conditions.append(Invoice.search_text.op("%>")(term.strip()))
+            rank = rank + func.word_similarity(term.strip(), Invoice.search_text)
+        return query.filter(or_(*conditions)).order_by(rank.desc(), Invoice.created_at.desc(), Invoice.id.desc())
+
+    if backend == "fts5":
+        match = " ".join(f'"{t}"*' for t in tokens)
+        fts = literal_column(FTS_TABLE)
+        return query.join(
+            fts_table,
+            fts_table.c.rowid == Invoice.id
+        ).filter(fts.match(match)).order_by(
+            func.bm25(fts).asc(), Invoice.created_at.desc(), Invoice.id.desc()
+        )
+
+    pattern = f"%{term.strip()}%"
+    return query.filter(or_(
+        Invoice.search_text.ilike(pattern),
+        Invoice.vendor_name.ilike(pattern),
+        Invoice.invoice_number.ilike(pattern),
+        Invoice.description.ilike(pattern)
+    )).order_by(Invoice.created_at.desc(), Invoice.id.desc())
+
+
+# ===========================================
+# CREACIÓN DE ÍNDICES (usado por migrations.py)
+# ===========================================
+
+def create_search_indexes(engine: Engine):
+    """Crea los índices de búsqueda según el motor"""
+    if engine.dialect.name == "postgresql":
+        from migrations import create_index
+        try:
+            with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudo habilitar pg_trgm (búsqueda difusa desactivada): {e}")
+
+        create_index(
+            engine, "ix_invoices_search_tsv", "invoices",
+            [f"to_tsvector('{SEARCH_TS_CONFIG}'::regconfig, coalesce(search_text, ''))"],
+            using="gin"
+        )
+        try:
+            create_index(engine, "ix_invoices_search_trgm", "invoices", ["search_text gin_trgm_ops"], using="gin")
+        except Exception as e:
+            logger.warning(f"⚠️ Índice trigram no creado: {e}")
+
+    elif engine.dialect.name == "sqlite":
+        with engine.begin() as conn:
+            conn.execute(text(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+                "search_text, content='invoices', content_rowid='id', "
+                "tokenize='unicode61 remove_diacritics 2')"
+            ))
+            conn.execute(text(
+                f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON invoices BEGIN "
+                f"INSERT INTO {FTS_TABLE}(rowid, search_text) VALUES (new.id, new.search_text); END"
+            ))
+            conn.execute(text(
+                f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON invoices BEGIN "
+                f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, search_text) VALUES ('delete', old.id, old.search_text); END"
+            ))
+            conn.execute(text(
+                f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF search_text ON invoices BEGIN "
+                f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, search_text) VALUES ('delete', old.id, old.search_text); "
+                f"INSERT INTO {FTS_TABLE}(rowid, search_text) VALUES (new.id, new.search_text); END"
+            ))
+            conn.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+        logger.info(f"✅ Tabla FTS5 '{FTS_TABLE}' lista")
+
+    reset_backend()
@@ -0,0 +1,211 @@
+"""
+Registro central de configuraciones.
+
+Las configuraciones se resuelven una sola vez por (organización, usuario):
+los valores por defecto de ``settings``, los de la organización en
+``organization_settings`` (por ejemplo su Evolution API) y las
+sobreescrituras del usuario en ``user_settings``, ya convertidos a su tipo. El resultado se guarda en el
+caché de dos niveles (memoria + Redis), así que las rutas calientes
+(extracción con OpenAI, webhooks de WhatsApp) leen de memoria.
+
+Invalidación: al confirmar cambios en Setting/OrganizationSetting/UserSetting (por ejemplo desde
+``POST /api/settings``) un evento de sesión llama a
+``notify_settings_changed``, que sube la generación "settings" de la
+organización y purga los tags correspondientes en todos los procesos.
+"""
+import json
+import logging
+from dataclasses import dataclass, asdict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy.orm import Session
+
+from models import Organization, OrganizationSetting, Setting, SessionLocal, UserSetting
+from redis_client import tiered_get, tiered_set, tag_keys, invalidate_tag, bump_generation, publish_invalidation, versioned_key, invalidate_on_commit
+
+logger = logging.getLogger(__name__)
+
+SETTINGS_CACHE_TTL = 3600
+DEFAULTS_TAG = "settings:defaults"
+
+
+@dataclass
+class SettingValue:
+    """Configuración resuelta (valor ya convertido a su tipo)"""
+    key: str
+    value: Any
+    type: Optional[str]
+    category: Optional[str]
+    description: Optional[str]
+    source: str  # "default", "organization" o "user"
+
+
+def parse_setting_value(raw: Optional[str], setting_type: Optional[str]) -> Any:
+    """Convierte el valor almacenado (texto) según su tipo"""
+    if setting_type == "boolean":
+        return str(raw).lower() == "true"
+    if setting_type == "int":
+        try:
+            return int(raw)
+        except (TypeError, ValueError):
+            return 0
+    if setting_type == "float":
+        try:
+            return float(raw)
+        except (TypeError, ValueError):
+            return 0.0
+    if setting_type == "json":
+        try:
+            return json.loads(raw) if raw else None
+        except ValueError:
+            return raw
+    return raw
+
+
+def _default_org_id(db: Session) -> Optional[int]:
+    org_id = tiered_get("org:default:id")
+    if org_id is None:
+        org = db.query(Organization).order_by(Organization.id).first()
+        org_id = org.id if org else None
+    return org_id
+
+
+def _registry_key(org_id: Optional[int], user_id: Optional[int]) -> str:
+    return versioned_key("settings", org_id, "registry", user_id or 0)
+
+
+def _load(db: Session, org_id: Optional[int], user_id: Optional[int]) -> Dict[str, dict]:
+    resolved = {}
+    for setting in db.query(Setting).all():
+        resolved[setting.key] = asdict(SettingValue(
+            key=setting.key,
+            value=parse_setting_value(setting.value, setting.type),
+            type=setting.type,
+            category=setting.category,
+            description=setting.description,
+            source="default"
+        ))
+
+    if org_id is not None:
+        for setting in db.query(OrganizationSetting).filter(OrganizationSetting.organization_id == org_id).all():
+            default = resolved.get(setting.key, {})
+            resolved[setting.key] = asdict(SettingValue(
+                key=setting.key,
+                value=parse_setting_value(setting.value, default.get("type")),
+                type=default.get("type"),
+                category=default.get("category") or "general",
+                description=default.get("description") or "Configuración de la organización",
+                source="organization"
+            ))
+
+    if user_id:
+        for setting in db.query(UserSetting).filter(UserSetting.user_id == user_id).all():
+            default = resolved.get(setting.key, {})
+            setting_type = default.get("type") or setting.type
+            resolved[setting.key] = asdict(SettingValue(
+                key=setting.key,
+                value=parse_setting_value(setting.value, setting_type),
+                type=setting_type,
+                category=default.get("category") or setting.category,
+                description=setting.description or default.get("description") or "Configuración personalizada",
+                source="user"
+            ))
+    return resolved
+
+
+def get_settings_map(org_id: Optional[int] = None, user_id: Optional[int] = None, db: Optional[Session] = None) -> Dict[str, dict]:
+    """
+    Configuraciones resueltas {key: SettingValue como dict} para la
+    organización y el usuario. Sin `db` se abre una sesión solo si no están
+    en caché. Si la BD falla retorna {} (sin cachear) para usar los defaults.
+    """
+    own_session = db is None
+    if own_session:
+        db = SessionLocal()
+    try:
+        if org_id is None:
+            org_id = _default_org_id(db)
+        cache_key = _registry_key(org_id, user_id)
+        cached = tiered_get(cache_key)
+        if isinstance(cached, dict):
+            return cached
+
+        resolved = _load(db, org_id, user_id)
+        tiered_set(cache_key, resolved, ttl=SETTINGS_CACHE_TTL)
+        tag_keys(f"settings:{org_id}", cache_key)
+        tag_keys(DEFAULTS_TAG, cache_key)
+        if user_id:
+            tag_keys(f"settings:user:{user_id}", cache_key)
+        return resolved
+    except Exception as e:
+        logger.error(f"⚠️ Error leyendo settings de BD: {e}")
+        return {}
+    finally:
+        if own_session:
+            db.close()
+
+
+def get_setting(key: str, default: Any = None, org_id: Optional[int] = None, user_id: Optional[int] = None, db: Optional[Session] = None) -> Any:
+    """Valor tipado de una configuración (o `default` si no existe o está vacía)"""
+    setting = get_settings_map(org_id, user_id, db).get(key)
+    if not setting or setting["value"] in (None, ""):
+        return default
+    return setting["value"]
+
+
+def grouped_settings(org_id: Optional[int], user_id: Optional[int], db: Optional[Session] = None) -> Dict[str, List[dict]]:
+    """Configuraciones agrupadas por categoría (formato de GET /api/settings)"""
+    result: Dict[str, List[dict]] = {}
+    for setting in get_settings_map(org_id, user_id, db).values():
+        result.setdefault(setting["category"], []).append(setting)
+    return result
+
+
+def notify_settings_changed(org_id: Optional[int] = None, user_id: Optional[int] = None):
+    """
+    Evento de cambio: invalida las configuraciones cacheadas afectadas en
+    todos los procesos. Sin argumentos invalida todo el registro (cambió un
+    valor por defecto).
+    """
+    if org_id is None and user_id is None:
+        invalidate_tag(DEFAULTS_TAG)
+        return
+    if org_id is not None:
+        # Memoria local aunque Redis no esté disponible
+        publish_invalidation(_registry_key(org_id, user_id))
+        bump_generation("settings", org_id)
+        invalidate_tag(f"settings:{org_id}")
+    if user_id is not None:
+        invalidate_tag(f"settings:user:{user_id}")
+    logger.info(f"🗑️ Configuraciones invalidadas (org {org_id}, usuario {user_id})")
+
+
+# ===========================================
+# EVENTOS DE SESIÓN
+# ===========================================
+
+def _settings_changes(obj) -> Set[Tuple[str, Optional[int]]]:
+    if isinstance(obj, UserSetting):
+        return {("user", obj.user_id)}
+    if isinstance(obj, OrganizationSetting):
+        return {("organization", obj.organization_id)}
+    if isinstance(obj, Setting):
+        return {("defaults", obj.organization_id)}
+    return set()
+
+
+def _publish_settings_changes(changes: Set[Tuple[str, Optional[int]]]):
+    defaults = {org_id for kind, org_id in changes if kind == "defaults"}
+    for org_id in defaults:
+        if org_id is not None:
+            bump_generation("settings", org_id)
+    if defaults:
+        notify_settings_changed()
+    for kind, owner_id in changes:
+        if kind == "organization":
+            notify_settings_changed(org_id=owner_id)
+        elif kind == "user":
+            notify_settings_changed(user_id=owner_id)
+
+
+invalidate_on_commit("_settings_changes", _settings_changes, _publish_settings_changes)
@@ -0,0 +1,434 @@
+"""
+Estadísticas del dashboard a partir de agregados diarios.
+
+Cada cambio de una factura (alta, procesamiento, edición, borrado) hecho vía
+ORM ajusta la tabla ``invoice_daily_stats`` dentro de la misma transacción:
+
+1. ``before_flush``: se lee de la BD el estado anterior de las facturas
+   modificadas o eliminadas.
+2. ``after_flush``: se lee el estado nuevo de las creadas o modificadas.
+3. Se resta la contribución anterior, se suma la nueva y se aplican los
+   deltas con ``INSERT ... ON CONFLICT DO UPDATE SET col = col + delta``.
+
+Así /statistics lee unas pocas filas agregadas sin importar el tamaño de la
+tabla de facturas. Al confirmar la transacción se incrementa la generación
+"stats" de las organizaciones afectadas, invalidando su caché.
+
+Los ``query.delete()``/``update()`` masivos no pasan por el ORM: quien los
+use debe ajustar los agregados (remove_invoice_contributions para borrados,
+o rebuild_rollups).
+
+Los deltas y las filas cambiadas quedan en
+``session.info[ROLLUP_CHANGES_KEY]`` para el feed incremental del dashboard
+(dashboard_service.py).
+"""
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta, date
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import event, func, select, and_
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import Session
+
+from models import Invoice, InvoiceAuditFlag, InvoiceDailyStats, InvoiceLineItem, categorize_audit_flag, parse_audit_flags, normalize_item_description
+from models import INVOICE_LIST_FIELDS, invoice_list_columns
+from redis_client import bump_generation
+
+logger = logging.getLogger(__name__)
+
+# Columnas de la factura que influyen en los agregados
+TRACKED_COLUMNS = (
+    Invoice.id,
+    Invoice.organization_id,
+    Invoice.created_at,
+    Invoice.updated_at,
+    Invoice.processed,
+    Invoice.confidence_score,
+    Invoice.openai_cost_usd,
+    Invoice.openai_tokens_used,
+    Invoice.openai_model_used,
+    Invoice.audit_flags,
+)
+
+# Categoría de alerta -> columna del agregado
+ALERT_CATEGORY_COLUMNS = {
+    "Datos Fiscales": "alerts_fiscal",
+    "Duplicados": "alerts_duplicate",
+    "Antigüedad": "alerts_age",
+    "Legibilidad": "alerts_legibility",
+    "Impuestos": "alerts_tax",
+    "Otros": "alerts_other",
+}
+
+# Columnas extra para las filas nuevas/modificadas: parche de la tabla del dashboard
+_ROW_COLUMNS = [
+    column for column in invoice_list_columns(INVOICE_LIST_FIELDS)
+    if column.key not in {tracked.key for tracked in TRACKED_COLUMNS}
+]
+
+SUM_FIELDS = (
+    "invoices", "cost_usd", "tokens", "cost_requests", "processed",
+    "confidence_sum", "confidence_count", "alerts",
+) + tuple(ALERT_CATEGORY_COLUMNS.values())
+
+RollupKey = Tuple[int, date, str]
+
+
+def invoice_contributions(row) -> Iterable[Tuple[RollupKey, Dict[str, Any]]]:
+    """Aporte de una factura (fila con TRACKED_COLUMNS) a los agregados"""
+    if row.organization_id is None or row.created_at is None:
+        return []
+
+    model = row.openai_model_used or ""
+    contributions = [((row.organization_id, row.created_at.date(), model), {
+        "invoices": 1,
+        "cost_usd": row.openai_cost_usd or 0.0,
+        "tokens": row.openai_tokens_used or 0,
+        "cost_requests": 1 if row.processed and row.openai_cost_usd is not None else 0,
+    })]
+
+    if row.processed:
+        processed_day = (row.updated_at or row.created_at).date()
+        values = {"processed": 1}
+        if row.confidence_score is not None:
+            values["confidence_sum"] = row.confidence_score
+            values["confidence_count"] = 1
+        flags = parse_audit_flags(row.audit_flags)
+        if flags:
+            values["alerts"] = 1
+            for flag in flags:
+                column = ALERT_CATEGORY_COLUMNS[categorize_audit_flag(flag)]
+                values[column] = values.get(column, 0) + 1
+        contributions.append(((row.organization_id, processed_day, model), values))
+
+    return contributions
+
+
+def _accumulate(deltas: Dict[RollupKey, Dict[str, Any]], rows, sign: int):
+    for row in rows:
+        for key, values in invoice_contributions(row):
+            bucket = deltas[key]
+            for field, value in values.items():
+                bucket[field] = bucket.get(field, 0) + sign * value
+
+
+def _load_rows(conn: Connection, ids: List[int], with_row_columns: bool = False) -> list:
+    if not ids:
+        return []
+    columns = list(TRACKED_COLUMNS) + (_ROW_COLUMNS if with_row_columns else [])
+    return conn.execute(select(*columns).where(Invoice.id.in_(ids))).fetchall()
+
+
+def apply_deltas(conn: Connection, deltas: Dict[RollupKey, Dict[str, Any]]):
+    """Suma los deltas a invoice_daily_stats (upsert atómico por fila)"""
+    table = InvoiceDailyStats.__table__
+    for (org_id, day, model), values in deltas.items():
+        values = {k: v for k, v in values.items() if v}
+        if not values:
+            continue
+
+        row = {field: values.get(field, 0) for field in SUM_FIELDS}
+        row.update(organization_id=org_id, day=day, model=model)
+
+        if conn.dialect.name in ("postgresql", "sqlite"):
+            if conn.dialect.name == "postgresql":
+                from sqlalchemy.dialects.postgresql import insert
+            else:
+                from sqlalchemy.dialects.sqlite import insert
+            stmt = insert(table).values(**row)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["organization_id", "day", "model"],
+                set_={field: table.c[field] + stmt.excluded[field] for field in values}
+            )
+            conn.execute(stmt)
+        else:
+            updated = conn.execute(
+                table.update().where(and_(
+                    table.c.organization_id == org_id, table.c.day == day, table.c.model == model
+                )).values({field: table.c[field] + value for field, value in values.items()})
+            )
+            if updated.rowcount == 0:
+                conn.execute(table.insert().values(**row))
+
+
+def remove_invoice_contributions(session: Session, rows):
+    """
+    Resta de los agregados las facturas borradas sin pasar por el ORM (filas
+    con TRACKED_COLUMNS leídas antes del DELETE). Su caché se invalida al confirmar.
+    """
+    deltas: Dict[RollupKey, Dict[str, Any]] = defaultdict(dict)
+    _accumulate(deltas, rows, -1)
+    apply_deltas(session.connection(), deltas)
+    session.info.setdefault(_TOUCHED_ORGS_KEY, set()).update(row.organization_id for row in rows)
+    _record_changes(session, deltas, [], rows)
+
+
+# ===========================================
+# MANTENIMIENTO TRANSACCIONAL (eventos de sesión)
+# ===========================================
+
+_PENDING_KEY = "_invoice_stats_before"
+_TOUCHED_ORGS_KEY = "_invoice_stats_orgs"
+# Estado de _TOUCHED_ORGS_KEY y ROLLUP_CHANGES_KEY al abrir cada SAVEPOINT
+_SAVEPOINTS_KEY = "_invoice_stats_savepoints"
+# Cambios de la transacción en curso: {"deltas": [...], "rows": {id: fila}, "deleted": {id: org_id}}
+ROLLUP_CHANGES_KEY = "_invoice_stats_changes"
+
+
+def _record_changes(session: Session, deltas, current_rows, deleted_rows):
+    changes = session.info.setdefault(ROLLUP_CHANGES_KEY, {"deltas": [], "rows": {}, "deleted": {}})
+    if deltas:
+        changes["deltas"].append(dict(deltas))
+    for row in current_rows:
+        changes["rows"][row.id] = row
+        changes["deleted"].pop(row.id, None)
+    for row in deleted_rows:
+        changes["rows"].pop(row.id, None)
+        changes["deleted"][row.id] = row.organization_id
+
+
+@event.listens_for(Session, "before_flush")
+def _capture_previous_state(session: Session, flush_context, instances):
+    """Estado en BD de las facturas que este flush va a modificar o borrar"""
+    dirty_ids, deleted_ids = [], []
+    for obj in session.dirty:
+        if isinstance(obj, Invoice) and obj.id is not None and session.is_modified(obj):
+            dirty_ids.append(obj.id)
+    for obj in session.deleted:
+        if isinstance(obj, Invoice) and obj.id is not None:
+            deleted_ids.append(obj.id)
+
+    ids = dirty_ids + deleted_ids
+    session.info[_PENDING_KEY] = {
+        "dirty_ids": dirty_ids,
+        "previous": _load_rows(session.connection(), ids) if ids else [],
+    }
+
+
+@event.listens_for(Session, "after_flush")
+def _apply_invoice_stats(session: Session, flush_context):
+    """Resta el estado anterior, suma el nuevo y actualiza los agregados"""
+    pending = session.info.pop(_PENDING_KEY, None) or {"dirty_ids": [], "previous": []}
+    current_ids = [obj.id for obj in session.new if isinstance(obj, Invoice)] + pending["dirty_ids"]
+    if not pending["previous"] and not current_ids:
+        return
+
+    conn = session.connection()
+    current = _load_rows(conn, current_ids, with_row_columns=True)
+    deltas: Dict[RollupKey, Dict[str, Any]] = defaultdict(dict)
+    _accumulate(deltas, pending["previous"], -1)
+    _accumulate(deltas, current, 1)
+    apply_deltas(conn, deltas)
+
+    dirty_ids = set(pending["dirty_ids"])
+    _record_changes(session, deltas, current, [row for row in pending["previous"] if row.id not in dirty_ids])
+
+    touched = session.info.setdefault(_TOUCHED_ORGS_KEY, set())
+    touched.update(row.organization_id for row in list(pending["previous"]) + list(current))
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_stats_cache(session: Session):
+    """Invalida (O(1), por organización) el caché de estadísticas tras confirmar"""
+    for org_id in session.info.pop(_TOUCHED_ORGS_KEY, set()):
+        if org_id is not None:
+            bump_generation("stats", org_id)
+
+
+@event.listens_for(Session, "after_transaction_create")
+def _snapshot_savepoint(session: Session, transaction):
+    """Copia de los cambios acumulados al abrir un SAVEPOINT (para deshacerlos)"""
+    if not transaction.nested:
+        return
+    changes = session.info.get(ROLLUP_CHANGES_KEY)
+    touched = session.info.get(_TOUCHED_ORGS_KEY)
+    session.info.setdefault(_SAVEPOINTS_KEY, {})[transaction] = (
+        None if changes is None else {
+            "deltas": list(changes["deltas"]),
+            "rows": dict(changes["rows"]),
+            "deleted": dict(changes["deleted"]),
+        },
+        None if touched is None else set(touched),
+    )
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _forget_savepoints(session: Session, transaction):
+    # SAVEPOINTs confirmados: sus copias ya no sirven al terminar la transacción externa
+    if transaction.parent is None:
+        session.info.pop(_SAVEPOINTS_KEY, None)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_touched_orgs(session: Session, previous_transaction):
+    if previous_transaction.nested:
+        # Rollback de un SAVEPOINT: la transacción externa sigue en curso, pero
+        # lo registrado dentro del SAVEPOINT no llegará a confirmarse
+        snapshot = session.info.get(_SAVEPOINTS_KEY, {}).pop(previous_transaction, None)
+        if snapshot is not None:
+            for key, value in zip((ROLLUP_CHANGES_KEY, _TOUCHED_ORGS_KEY), snapshot):
+                if value is None:
+                    session.info.pop(key, None)
+                else:
+                    session.info[key] = value
+        return
+    session.info.pop(_TOUCHED_ORGS_KEY, None)
+    session.info.pop(ROLLUP_CHANGES_KEY, None)
+
+
+def rebuild_rollups(engine: Engine, org_id: Optional[int] = None, batch_size: int = 1000):
+    """Recalcula los agregados desde la tabla de facturas (backfill/reparación)"""
+    table = InvoiceDailyStats.__table__
+    deltas: Dict[RollupKey, Dict[str, Any]] = defaultdict(dict)
+
+    with engine.begin() as conn:
+        last_id = 0
+        while True:
+            query = select(*TRACKED_COLUMNS).where(Invoice.id > last_id)
+            if org_id is not None:
+                query = query.where(Invoice.organization_id == org_id)
+            rows = conn.execute(query.order_by(Invoice.id).limit(batch_size)).fetchall()
+            if not rows:
+                break
+            _accumulate(deltas, rows, 1)
+            last_id = rows[-1].id
+
+        delete = table.delete()
+        if org_id is not None:
+            delete = delete.where(table.c.organization_id == org_id)
+        conn.execute(delete)
+        apply_deltas(conn, deltas)
+
+    if org_id is not None:
+        bump_generation("stats", org_id)
+    logger.info(f"📊 Agregados diarios recalculados ({len(deltas)} filas)")
+
+
+# ===========================================
+# LECTURA PARA EL DASHBOARD
+# ===========================================
+
+def get_rollup_statistics(db: Session, org_id: int, days: int = 7) -> Dict[str, Any]:
+    """Totales, historial reciente y desglose por modelo desde los agregados"""
+    stats = InvoiceDailyStats
+    sums = [func.coalesce(func.sum(getattr(stats, field)), 0).label(field) for field in SUM_FIELDS]
+
+    totals = db.query(*sums).filter(stats.organization_id == org_id).one()._asdict()
+
+    since = datetime.utcnow().date() - timedelta(days=days)
+    history = db.query(
+        stats.day,
+        func.sum(stats.processed).label("processed"),
+        func.sum(stats.cost_usd).label("cost_usd"),
+        func.sum(stats.cost_requests).label("cost_requests"),
+    ).filter(
+        stats.organization_id == org_id,
+        stats.day >= since
+    ).group_by(stats.day).order_by(stats.day).all()
+
+    models = db.query(
+        stats.model,
+        func.sum(stats.invoices).label("invoices"),
+        func.sum(stats.cost_usd).label("cost_usd"),
+        func.sum(stats.tokens).label("tokens"),
+    ).filter(
+        stats.organization_id == org_id,
+        stats.model != ""
+    ).group_by(stats.model).all()
+
+    return {
+        "totals": totals,
+        "history": [row._asdict() for row in history],
+        "models": [row._asdict() for row in models],
+    }
+
+
+# ===========================================
+# ALERTAS DE AUDITORÍA (tabla invoice_audit_flags)
+# ===========================================
+
+def recent_alert_invoice_ids(db: Session, org_id: int, limit: int = 10) -> List[int]:
+    """Facturas con alertas más recientes (índice org, created_at)"""
+    rows = db.query(InvoiceAuditFlag.invoice_id).filter(
+        InvoiceAuditFlag.organization_id == org_id
+    ).order_by(InvoiceAuditFlag.created_at.desc(), InvoiceAuditFlag.id.desc()).limit(limit * 10).all()
+    return list(dict.fromkeys(invoice_id for (invoice_id,) in rows))[:limit]
+
+
+def audit_flag_breakdown(db: Session, org_id: int, since: Optional[datetime] = None) -> Dict[str, int]:
+    """Conteo de alertas por categoría (índice org, category, created_at)"""
+    query = db.query(
+        InvoiceAuditFlag.category,
+        func.count(InvoiceAuditFlag.id)
+    ).filter(InvoiceAuditFlag.organization_id == org_id)
+    if since is not None:
+        query = query.filter(InvoiceAuditFlag.created_at >= since)
+    return {category: count for category, count in query.group_by(InvoiceAuditFlag.category).all()}
+
+
+# ===========================================
+# ANALÍTICA POR PRODUCTO (tabla invoice_line_items)
+# ===========================================
+
+def item_spend_summary(
+    db: Session,
+    org_id: int,
+    search: Optional[str] = None,
+    transaction_type: Optional[str] = None,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    limit: int = 50
+) -> List[Dict[str, Any]]:
+    """Gasto agregado por producto (descripción normalizada), de mayor a menor"""
+    item = InvoiceLineItem
+    total = func.sum(item.subtotal)
+    query = db.query(
+        item.normalized_description,
+        func.max(item.description).label("description"),
+        func.count(func.distinct(item.invoice_id)).label("invoices"),
+        func.sum(item.quantity).label("quantity"),
+        total.label("total"),
+        func.avg(item.unit_price).label("avg_unit_price")
+    ).filter(
+        item.organization_id == org_id,
+        item.normalized_description != ""
+    )
+
+    if search:
+        query = query.filter(item.normalized_description.like(f"{normalize_item_description(search)}%"))
+    if transaction_type or start_date or end_date:
+        query = query.join(Invoice, Invoice.id == item.invoice_id)
+        if transaction_type:
+            query = query.filter(Invoice.transaction_type == transaction_type)
+        if start_date:
+            query = query.filter(Invoice.invoice_date >= start_date)
+        if end_date:
+            query = query.filter(Invoice.invoice_date <= end_date)
+
+    rows = query.group_by(item.normalized_description).order_by(total.desc()).limit(limit).all()
+    return [
+        {
+            "item": row.normalized_description,
+            "description": row.description,
+            "invoices": row.invoices,
+            "quantity": float(row.quantity or 0),
+            "total": float(row.total or 0),
+            "avg_unit_price": float(row.avg_unit_price or 0)
+        }
+        for row in rows
+    ]
+
+
+def line_item_subtotals(db: Session, invoice_ids: List[int]) -> Dict[int, float]:
+    """Suma de subtotales de líneas por factura (solo las que tienen alguno)"""
+    if not invoice_ids:
+        return {}
+    rows = db.query(
+        InvoiceLineItem.invoice_id,
+        func.sum(InvoiceLineItem.subtotal)
+    ).filter(
+        InvoiceLineItem.invoice_id.in_(invoice_ids),
+        InvoiceLineItem.subtotal.isnot(None)
+    ).group_by(InvoiceLineItem.invoice_id).all()
+    return {invoice_id: float(total) for invoice_id, total in rows}
@@ -0,0 +1,67 @@
+"""
+Configuración común de las pruebas.
+
+Antes de importar la aplicación se apunta DATABASE_URL a un SQLite temporal
+(nunca a invoices.db ni a la BD de Heroku) y se desactiva Redis; las pruebas
+que necesitan Redis usan el fixture ``fake_redis`` (fakeredis).
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+_TMP_DIR = tempfile.mkdtemp(prefix="facturas-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_TMP_DIR, 'test.db')}"
+os.environ.pop("REDIS_URL", None)
+os.environ.pop("DATABASE_REPLICA_URL", None)
+os.environ.setdefault("SECRET_KEY", "clave-de-pruebas")
+os.environ.setdefault("ADMIN_EMAIL", "admin@example.com")
+os.environ.setdefault("ADMIN_PASSWORD", "admin-pruebas")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    """Redis en memoria detrás de get_redis_client()"""
+    fakeredis = pytest.importorskip("fakeredis")
+    import redis_client
+
+    client = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(redis_client, "redis_client", client)
+    redis_client.local_cache.clear()
+    yield client
+    redis_client.local_cache.clear()
+
+
+@pytest.fixture(scope="module")
+def client():
+    """App con su ciclo de vida (startup/shutdown) y sesión de administrador"""
+    from fastapi.testclient import TestClient
+
+    import main
+    from auth import create_access_token
+
+    with TestClient(main.app) as test_client:
+        test_client.cookies.set("access_token", create_access_token({"sub": os.environ["ADMIN_EMAIL"]}))
+        yield test_client
+
+
+@pytest.fixture
+def org_id(client):
+    """Organización nueva por prueba con el administrador dentro (aísla los datos)"""
+    from models import Organization, SessionLocal, User
+
+    db = SessionLocal()
+    try:
+        org = Organization(name="Org de pruebas")
+        db.add(org)
+        db.flush()
+        admin = db.query(User).filter(User.email == os.environ["ADMIN_EMAIL"]).one()
+        admin.organization_id = org.id
+        # Al confirmar se invalida el principal cacheado (ver auth.py)
+        db.commit()
+        return org.id
+    finally:
+        db.close()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Archivo por retención: una factura editada entre la escritura del segmento y
+la confirmación no se archiva con datos viejos, y el lock entre procesos solo
+se libera si sigue siendo nuestro.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import archive_service
+from models import ArchivedInvoice, Invoice, SessionLocal
+
+
+@pytest.fixture
+def archive_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(archive_service, "ARCHIVE_DIR", str(tmp_path / "archive"))
+    return tmp_path / "archive"
+
+
+def _old_invoices(org_id, count):
+    db = SessionLocal()
+    try:
+        invoices = [
+            Invoice(filename=f"f{i}.pdf", organization_id=org_id, vendor_name=f"Proveedor {i}",
+                    created_at=datetime.utcnow() - timedelta(days=400))
+            for i in range(count)
+        ]
+        # Una factura reciente queda activa con el id mayor: SQLite reutilizaría
+        # los ids archivados si se borrara la última fila
+        db.add_all(invoices + [Invoice(filename="reciente.pdf", organization_id=org_id)])
+        db.commit()
+        return [invoice.id for invoice in invoices]
+    finally:
+        db.close()
+
+
+def _edit(invoice_id, vendor_name):
+    db = SessionLocal()
+    try:
+        db.get(Invoice, invoice_id).vendor_name = vendor_name
+        db.commit()
+    finally:
+        db.close()
+
+
+def test_edit_during_archival_is_not_lost(client, org_id, archive_dir):
+    edited, untouched = _old_invoices(org_id, 2)
+    cutoff = datetime.utcnow() - timedelta(days=30)
+    batch = archive_service._prepare_batch(org_id, cutoff, 10)
+
+    # El usuario edita después de escribirse el segmento
+    _edit(edited, "Proveedor Corregido")
+
+    db = SessionLocal()
+    try:
+        count, _ = archive_service._commit_batch(db, org_id, batch)
+        db.commit()
+        assert count == 1
+        assert db.get(Invoice, edited).vendor_name == "Proveedor Corregido"
+        assert db.get(ArchivedInvoice, edited) is None
+        assert db.get(ArchivedInvoice, untouched) is not None
+    finally:
+        db.close()
+
+    # La siguiente pasada la archiva con sus datos nuevos
+    assert client.portal.call(archive_service.archive_organization, org_id, 30) == 1
+    db = SessionLocal()
+    try:
+        entry = db.get(ArchivedInvoice, edited)
+        assert entry.vendor_name == "Proveedor Corregido"
+        assert archive_service.read_segment_record(entry.segment, edited)["vendor_name"] == "Proveedor Corregido"
+    finally:
+        db.close()
+
+
+def test_archive_lock_release_keeps_foreign_lock(fake_redis):
+    pytest.importorskip("lupa")  # EVAL en fakeredis
+    token = archive_service._acquire_archive_lock()
+    assert token and archive_service._acquire_archive_lock() is None
+
+    # Nuestro lock expiró y otro proceso tomó uno nuevo
+    fake_redis.set(archive_service.ARCHIVE_LOCK_KEY, "otro-proceso")
+    archive_service._release_archive_lock(token)
+    assert fake_redis.get(archive_service.ARCHIVE_LOCK_KEY) == "otro-proceso"
+
+    fake_redis.set(archive_service.ARCHIVE_LOCK_KEY, token)
+    archive_service._release_archive_lock(token)
+    assert fake_redis.get(archive_service.ARCHIVE_LOCK_KEY) is None
+
+
+def test_restored_invoice_is_not_archived_again(client, org_id, archive_dir, monkeypatch):
+    target = org_id
+    monkeypatch.setattr(
+        archive_service, "get_setting",
+        lambda key, default=None, org_id=None, **kwargs: 30 if org_id == target else 0
+    )
+    (invoice_id,) = _old_invoices(org_id, 1)
+    assert client.portal.call(archive_service.run_archival)[org_id] == 1
+
+    response = client.post(f"/api/archive/invoices/{invoice_id}/restore")
+    assert response.status_code == 200, response.text
+
+    # La siguiente pasada respeta la restauración
+    assert client.portal.call(archive_service.run_archival)[org_id] == 0
+    db = SessionLocal()
+    try:
+        assert db.get(Invoice, invoice_id).restored_at is not None
+        assert db.get(ArchivedInvoice, invoice_id) is None
+
+        # Vencida también desde la restauración: vuelve al archivo
+        db.get(Invoice, invoice_id).restored_at = datetime.utcnow() - timedelta(days=31)
+        db.commit()
+    finally:
+        db.close()
+    assert client.portal.call(archive_service.run_archival)[org_id] == 1
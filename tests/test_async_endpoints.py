@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Los endpoints con AsyncSession resuelven el principal por la misma sesión
+asíncrona: no deben abrir una sesión síncrona (get_db) ni siquiera cuando el
+principal no está en caché.
+"""
+import pytest
+
+import main
+from models import Invoice, SessionLocal, get_db
+from redis_client import local_cache
+
+
+@pytest.fixture
+def no_sync_sessions(client):
+    def forbidden():
+        raise AssertionError("endpoint asíncrono abrió una sesión síncrona")
+        yield
+
+    main.app.dependency_overrides[get_db] = forbidden
+    # Principal fuera de caché: se resuelve desde la BD
+    local_cache.clear()
+    yield
+    main.app.dependency_overrides.pop(get_db, None)
+
+
+@pytest.mark.parametrize("path", ["/invoices", "/categories", "/api/notifications", "/statistics"])
+def test_async_endpoints_do_not_use_sync_session(client, org_id, no_sync_sessions, path):
+    response = client.get(path)
+    assert response.status_code == 200, response.text
+
+
+def test_async_invoice_detail(client, org_id, no_sync_sessions):
+    db = SessionLocal()
+    invoice = Invoice(filename="a.pdf", organization_id=org_id, vendor_name="Proveedor")
+    db.add(invoice)
+    db.commit()
+    invoice_id = invoice.id
+    db.close()
+
+    assert client.get(f"/invoices/{invoice_id}").json()["vendor_name"] == "Proveedor"
+    assert client.get(f"/invoices/{invoice_id + 1000}").status_code == 404
+
+
+def test_async_endpoints_reject_invalid_token(client):
+    response = client.get("/invoices", headers={"Cookie": "access_token=no-es-un-jwt"})
+    assert response.status_code == 401
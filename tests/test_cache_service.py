@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Recálculo único (single-flight), stale-while-revalidate y lock entre
+procesos de cache_service.get_or_compute.
+"""
+import asyncio
+
+import pytest
+
+import cache_service
+from redis_client import cache_get, cache_set, release_lock
+
+
+def test_release_lock_only_deletes_own_token(fake_redis):
+    pytest.importorskip("lupa")  # EVAL en fakeredis
+    fake_redis.set("lock:stats", "token-de-otro")
+    assert not release_lock("lock:stats", "token-viejo")
+    assert fake_redis.get("lock:stats") == "token-de-otro"
+
+    assert release_lock("lock:stats", "token-de-otro")
+    assert fake_redis.get("lock:stats") is None
+
+
+class _Counter:
+    """Corrutina de cálculo que cuenta sus ejecuciones"""
+
+    def __init__(self, value, delay=0.05):
+        self.value = value
+        self.delay = delay
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        return {"value": self.value, "call": self.calls}
+
+
+def test_concurrent_misses_compute_once():
+    compute = _Counter("fresco")
+
+    async def scenario():
+        return await asyncio.gather(*(cache_service.get_or_compute("stats:single", compute) for _ in range(20)))
+
+    results = asyncio.run(scenario())
+    assert compute.calls == 1
+    assert all(result == {"value": "fresco", "call": 1} for result in results)
+
+
+def test_stale_value_served_while_refreshing(fake_redis):
+    compute = _Counter("nuevo")
+    cache_set("swr:stats:swr", {"value": "viejo"}, ttl=3600)
+
+    async def scenario():
+        stale = await cache_service.get_or_compute("stats:swr", compute)
+        # El refresco corre en segundo plano sin bloquear la respuesta
+        refresh = cache_service._inflight["stats:swr"]
+        assert not refresh.done()
+        # Mientras tanto no se lanza un segundo recálculo
+        assert await cache_service.get_or_compute("stats:swr", compute) == {"value": "viejo"}
+        await refresh
+        assert compute.calls == 1
+        return stale
+
+    assert asyncio.run(scenario()) == {"value": "viejo"}
+    assert cache_get("stats:swr") == {"value": "nuevo", "call": 1}
+    assert cache_get("swr:stats:swr") == {"value": "nuevo", "call": 1}
+
+
+def test_waits_for_peer_process_holding_the_lock(fake_redis, monkeypatch):
+    monkeypatch.setattr(cache_service, "LOCK_POLL_INTERVAL", 0.01)
+    compute = _Counter("local")
+    fake_redis.set("lock:stats:peer", "otro-proceso", ex=30)
+
+    async def scenario():
+        async def peer():
+            await asyncio.sleep(0.05)
+            cache_set("stats:peer", {"value": "del otro proceso"}, ttl=300)
+
+        result, _ = await asyncio.gather(cache_service.get_or_compute("stats:peer", compute), peer())
+        return result
+
+    assert asyncio.run(scenario()) == {"value": "del otro proceso"}
+    assert compute.calls == 0
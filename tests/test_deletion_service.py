@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Borrado por conjuntos de facturas (deletion_service.delete_invoices) y purga
+de archivos con reintentos (FilePurger), más el contrato de los endpoints de
+borrado individual y masivo.
+"""
+import asyncio
+import json
+from datetime import datetime
+
+from sqlalchemy import func, text
+
+import deletion_service
+from deletion_service import FilePurger, delete_invoices
+from models import Invoice, InvoiceAuditFlag, InvoiceDailyStats, InvoiceLineItem, Notification, SessionLocal
+from search_service import FTS_TABLE
+
+
+def _create_invoice(org_id, **data):
+    db = SessionLocal()
+    try:
+        invoice = Invoice(
+            filename="f.pdf", organization_id=org_id, vendor_name="Proveedor Borrable",
+            processed=True, confidence_score=0.9,
+            audit_flags=json.dumps(["Dato fiscal faltante"]),
+            line_items_data=json.dumps([{"description": "Papel bond", "quantity": 2, "unit_price": 5}]),
+            **data
+        )
+        db.add(invoice)
+        db.flush()
+        db.add(Notification(type="info", title="t", message="m", organization_id=org_id,
+                            invoice_id=invoice.id, data="{}", created_at=datetime.utcnow()))
+        db.commit()
+        return invoice.id
+    finally:
+        db.close()
+
+
+def _dependents(db, invoice_id):
+    return {
+        "audit_flags": db.query(InvoiceAuditFlag).filter(InvoiceAuditFlag.invoice_id == invoice_id).count(),
+        "line_items": db.query(InvoiceLineItem).filter(InvoiceLineItem.invoice_id == invoice_id).count(),
+        "notifications": db.query(Notification).filter(Notification.invoice_id == invoice_id).count(),
+        "fts": db.execute(
+            text(f"SELECT count(*) FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH 'borrable' AND rowid = :id"),
+            {"id": invoice_id}
+        ).scalar(),
+    }
+
+
+def _rollup_invoices(db, org_id):
+    return db.query(func.coalesce(func.sum(InvoiceDailyStats.invoices), 0)).filter(
+        InvoiceDailyStats.organization_id == org_id
+    ).scalar()
+
+
+def test_delete_cascades_to_dependent_data(client, org_id):
+    invoice_id = _create_invoice(org_id)
+    db = SessionLocal()
+    try:
+        assert _dependents(db, invoice_id) == {"audit_flags": 1, "line_items": 1, "notifications": 1, "fts": 1}
+        assert _rollup_invoices(db, org_id) == 1
+
+        count, paths = delete_invoices(db, org_id, [invoice_id])
+        db.commit()
+
+        assert count == 1 and paths == []
+        assert db.get(Invoice, invoice_id) is None
+        assert _dependents(db, invoice_id) == {"audit_flags": 0, "line_items": 0, "notifications": 0, "fts": 0}
+        assert _rollup_invoices(db, org_id) == 0
+    finally:
+        db.close()
+
+
+def test_delete_ignores_other_organizations(client, org_id):
+    invoice_id = _create_invoice(org_id)
+    db = SessionLocal()
+    try:
+        assert delete_invoices(db, org_id + 10_000, [invoice_id]) == (0, [])
+        db.commit()
+        assert db.get(Invoice, invoice_id) is not None
+    finally:
+        db.close()
+
+
+def test_delete_returns_file_paths_across_chunks(client, org_id, monkeypatch, tmp_path):
+    monkeypatch.setattr(deletion_service, "DELETE_CHUNK_SIZE", 2)
+    ids = [_create_invoice(org_id, file_path=str(tmp_path / f"{i}.pdf")) for i in range(5)]
+    db = SessionLocal()
+    try:
+        count, paths = delete_invoices(db, org_id, ids + [ids[0], 999_999])
+        db.commit()
+    finally:
+        db.close()
+    assert count == 5
+    assert sorted(paths) == sorted(str(tmp_path / f"{i}.pdf") for i in range(5))
+
+
+class _RecordingPurger(FilePurger):
+    """Registra las esperas de reintento sin dormir de verdad"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.delays = []
+
+    async def _retry_later(self, path, attempt, delay):
+        self.delays.append(delay)
+        await super()._retry_later(path, attempt, 0)
+
+
+def test_purger_retries_with_backoff(tmp_path, monkeypatch):
+    target = tmp_path / "factura.pdf"
+    target.write_bytes(b"%PDF")
+    failures = {"left": 2}
+    real_remove = deletion_service.os.remove
+
+    def flaky_remove(path):
+        if path == str(target) and failures["left"]:
+            failures["left"] -= 1
+            raise OSError("dispositivo ocupado")
+        real_remove(path)
+
+    monkeypatch.setattr(deletion_service.os, "remove", flaky_remove)
+    purger = _RecordingPurger(max_attempts=5, retry_delay=2.0)
+
+    async def scenario():
+        purger.enqueue([str(target), str(tmp_path / "ya-no-existe.pdf")])
+        await purger.join()
+
+    asyncio.run(scenario())
+    assert not target.exists()
+    assert purger.delays == [2.0, 4.0]
+    assert (purger.purged, purger.failed) == (1, 0)
+
+
+def test_purger_gives_up_after_max_attempts(tmp_path, monkeypatch):
+    def broken_remove(path):
+        raise OSError("disco de solo lectura")
+
+    monkeypatch.setattr(deletion_service.os, "remove", broken_remove)
+    purger = _RecordingPurger(max_attempts=3, retry_delay=1.0)
+
+    async def scenario():
+        purger.enqueue([str(tmp_path / "x.pdf")])
+        await purger.join()
+
+    asyncio.run(scenario())
+    assert purger.delays == [1.0, 2.0]
+    assert (purger.purged, purger.failed) == (0, 1)
+
+
+def test_delete_endpoints_keep_status_and_count(client, org_id):
+    first, second, third = (_create_invoice(org_id) for _ in range(3))
+    foreign = _create_invoice(org_id + 10_000)
+
+    assert client.delete(f"/invoices/{foreign}").status_code == 404
+    assert client.delete("/invoices/999999").status_code == 404
+    assert client.delete(f"/invoices/{first}").status_code == 200
+    assert client.delete(f"/invoices/{first}").status_code == 404
+
+    response = client.post("/api/invoices/bulk-delete", json={"invoice_ids": [second, third, first, foreign, 999999]})
+    assert response.status_code == 200
+    assert response.json()["count"] == 2
+    assert client.post("/api/invoices/bulk-delete", json={"invoice_ids": []}).json()["count"] == 0
+
+    db = SessionLocal()
+    try:
+        assert db.get(Invoice, foreign) is not None
+    finally:
+        db.close()
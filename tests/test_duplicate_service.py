@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Filtro de Bloom de duplicados: se construye en segundo plano (el chequeo no
+espera) y las facturas confirmadas durante la construcción no se pierden.
+"""
+import threading
+
+import duplicate_service
+from duplicate_service import BLOOM_READY_BIT, _bloom_filter, _bloom_key, _building_key, remember_invoices
+from models import Invoice, SessionLocal
+
+
+def _processed_invoice(org_id, content_hash):
+    db = SessionLocal()
+    try:
+        db.add(Invoice(filename="f.pdf", organization_id=org_id, processed=True, content_hash=content_hash))
+        db.commit()
+    finally:
+        db.close()
+
+
+def _wait_for_builds():
+    # Un solo hilo: cuando corre este trabajo, las construcciones previas terminaron
+    duplicate_service._build_executor.submit(lambda: None).result(timeout=10)
+
+
+def test_build_runs_in_background_and_keeps_concurrent_inserts(client, org_id, fake_redis, monkeypatch):
+    _processed_invoice(org_id, "hash-antiguo")
+    build_started, release_build = threading.Event(), threading.Event()
+    real_add = duplicate_service._bloom_add
+
+    def slow_add(r, org, values):
+        build_started.set()
+        assert release_build.wait(timeout=10)
+        real_add(r, org, values)
+
+    monkeypatch.setattr(duplicate_service, "_bloom_add", slow_add)
+    db = SessionLocal()
+    try:
+        # Sin filtro: el chequeo no espera la construcción y consulta el índice
+        assert _bloom_filter(db, org_id, ["hash-antiguo", "otra"]) == ["hash-antiguo", "otra"]
+        assert build_started.wait(timeout=10)
+        assert fake_redis.exists(_building_key(org_id))
+
+        # Una factura confirmada mientras el recorrido ya pasó por su id
+        monkeypatch.setattr(duplicate_service, "_bloom_add", real_add)
+        remember_invoices([(org_id, "huella-nueva", None)])
+        release_build.set()
+        _wait_for_builds()
+
+        assert fake_redis.getbit(_bloom_key(org_id), BLOOM_READY_BIT)
+        assert not fake_redis.exists(_building_key(org_id))
+        assert _bloom_filter(db, org_id, ["hash-antiguo", "huella-nueva", "nunca-vista"]) == [
+            "hash-antiguo", "huella-nueva"
+        ]
+    finally:
+        release_build.set()
+        db.close()
+
+
+def test_remember_without_filter_is_skipped(client, org_id, fake_redis):
+    remember_invoices([(org_id, "huella", "hash")])
+    assert not fake_redis.exists(_bloom_key(org_id))
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Procesamiento y edición de facturas a través del escritor serializado: con
+varias peticiones en paralelo no aparece "database is locked", el costo de
+OpenAI se guarda y un doble clic procesa la factura una sola vez.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import main
+from models import Invoice, SessionLocal
+
+
+@pytest.fixture
+def fake_openai(monkeypatch):
+    def process_invoice(file_path, file_type, invoice=None, db=None, user_id=None):
+        time.sleep(0.05)
+        # Igual que cost_control.record_openai_usage: solo marca la factura
+        invoice.openai_tokens_used = 100
+        invoice.openai_cost_usd = 0.01
+        return {
+            "vendor_name": f"Proveedor {invoice.id}",
+            "invoice_number": f"B01{invoice.id:08d}",
+            "total_amount": 100.0,
+            "confidence": 0.9,
+            "audit_warnings": [],
+        }
+
+    monkeypatch.setattr(main.openai_processor, "process_invoice", process_invoice)
+
+
+def _pending_invoices(org_id, count):
+    db = SessionLocal()
+    try:
+        invoices = [Invoice(filename=f"{i}.jpg", file_type="image", organization_id=org_id) for i in range(count)]
+        db.add_all(invoices)
+        db.commit()
+        return [invoice.id for invoice in invoices]
+    finally:
+        db.close()
+
+
+def test_concurrent_processing_and_edits(client, org_id, fake_openai):
+    single = _pending_invoices(org_id, 6)
+    bulk = _pending_invoices(org_id, 4)
+
+    calls = [lambda i=i: client.post(f"/process/{i}") for i in single]
+    calls += [lambda: client.post("/api/invoices/bulk-process", json={"invoice_ids": bulk})]
+    calls += [lambda i=i: client.put(f"/invoices/{i}", json={"category": "Oficina"}) for i in single]
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        responses = list(pool.map(lambda call: call(), calls))
+
+    for response in responses:
+        assert response.status_code == 200, response.text
+        body = response.json()
+        assert "error" not in body and "locked" not in response.text, body
+    assert responses[len(single)].json()["success_count"] == 4
+
+    db = SessionLocal()
+    try:
+        for invoice in db.query(Invoice).filter(Invoice.id.in_(single + bulk)):
+            assert invoice.processed and invoice.vendor_name == f"Proveedor {invoice.id}"
+            assert invoice.openai_cost_usd == 0.01
+        assert {invoice.category for invoice in db.query(Invoice).filter(Invoice.id.in_(single))} == {"Oficina"}
+    finally:
+        db.close()
+
+
+def test_double_click_processes_once(client, org_id, fake_openai):
+    (invoice_id,) = _pending_invoices(org_id, 1)
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        responses = list(pool.map(lambda _: client.post(f"/process/{invoice_id}"), range(2)))
+
+    messages = sorted(response.json()["message"] for response in responses)
+    assert messages == ["Factura procesada exitosamente", "Factura ya procesada"]
+
+
+def test_update_unknown_invoice(client, org_id):
+    assert client.put("/invoices/999999", json={"category": "Oficina"}).status_code == 404
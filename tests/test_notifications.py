@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Notificaciones de punta a punta: escritura por lotes (notification_writer) y
+contador de no leídas en Redis tras insertar, marcar una y marcar todas.
+"""
+from models import Notification, SessionLocal
+from notification_service import _unread_key, notification_writer
+
+
+def _notify(client, org_id, count):
+    async def enqueue_and_flush():
+        for i in range(count):
+            notification_writer.enqueue({"type": "invoice_uploaded", "message": f"Archivo {i}", "data": {}}, org_id)
+        # stop() espera a que el lote quede escrito; el próximo enqueue la reinicia
+        await notification_writer.stop()
+
+    client.portal.call(enqueue_and_flush)
+
+
+def _unread(client):
+    response = client.get("/api/notifications", params={"with_count": "true", "limit": 100})
+    assert response.status_code == 200
+    return response.json()
+
+
+def _db_unread(org_id):
+    db = SessionLocal()
+    try:
+        return db.query(Notification).filter(Notification.organization_id == org_id, Notification.read == False).count()
+    finally:
+        db.close()
+
+
+def test_unread_counter_follows_insert_read_and_read_all(client, org_id, fake_redis):
+    _notify(client, org_id, 3)
+    body = _unread(client)
+    assert body["unread_count"] == 3 and len(body["items"]) == 3
+    # El contador queda en Redis y los siguientes inserts lo incrementan
+    assert fake_redis.get(_unread_key(org_id)) == "3"
+
+    _notify(client, org_id, 2)
+    assert fake_redis.get(_unread_key(org_id)) == "5"
+    assert _unread(client)["unread_count"] == _db_unread(org_id) == 5
+
+    notification_id = _unread(client)["items"][0]["id"]
+    assert client.post(f"/api/notifications/{notification_id}/read").status_code == 200
+    # Marcar dos veces la misma no descuenta dos veces
+    assert client.post(f"/api/notifications/{notification_id}/read").status_code == 200
+    assert _unread(client)["unread_count"] == _db_unread(org_id) == 4
+
+    assert client.post("/api/notifications/read-all").status_code == 200
+    assert _unread(client)["unread_count"] == _db_unread(org_id) == 0
+
+    _notify(client, org_id, 1)
+    assert _unread(client)["unread_count"] == _db_unread(org_id) == 1
+
+
+def test_unread_count_without_redis_uses_count(client, org_id):
+    _notify(client, org_id, 2)
+    assert _unread(client)["unread_count"] == 2
+    assert client.post("/api/notifications/read-all").status_code == 200
+    assert _unread(client)["unread_count"] == 0
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Caché del principal autenticado (auth.load_principal): se invalida al
+confirmar cambios del usuario o de su organización, no tras un rollback.
+"""
+import uuid
+
+import pytest
+
+from auth import _principal_key, create_access_token, load_principal, principal_from_token
+from models import Organization, SessionLocal, User
+from redis_client import tiered_get
+
+
+@pytest.fixture(params=["redis", "memoria"])
+def cache_tier(request):
+    """Con Redis (fakeredis) y solo con la memoria local"""
+    if request.param == "redis":
+        request.getfixturevalue("fake_redis")
+    else:
+        from redis_client import local_cache
+        local_cache.clear()
+
+
+@pytest.fixture
+def email(client, org_id):
+    email = f"{uuid.uuid4().hex[:8]}@example.com"
+    db = SessionLocal()
+    try:
+        db.add(User(email=email, full_name="Contadora", organization_id=org_id, is_superuser=False))
+        db.commit()
+    finally:
+        db.close()
+    return email
+
+
+def _principal(email):
+    db = SessionLocal()
+    try:
+        return load_principal(db, email)
+    finally:
+        db.close()
+
+
+def _update_user(current, commit=True, **values):
+    db = SessionLocal()
+    try:
+        user = db.query(User).filter(User.email == current).one()
+        for key, value in values.items():
+            setattr(user, key, value)
+        db.flush()
+        db.commit() if commit else db.rollback()
+    finally:
+        db.close()
+
+
+def test_role_change_invalidates_after_commit(cache_tier, email):
+    assert _principal(email).is_superuser is False
+    assert tiered_get(_principal_key(email)) is not None
+
+    _update_user(email, commit=False, is_superuser=True)
+    # Rollback: el principal cacheado sigue siendo válido y no se descarta
+    assert tiered_get(_principal_key(email)) is not None
+    assert _principal(email).is_superuser is False
+
+    _update_user(email, is_superuser=True)
+    assert tiered_get(_principal_key(email)) is None
+    assert _principal(email).is_superuser is True
+
+
+def test_deactivated_user_is_rejected(cache_tier, email):
+    token = create_access_token({"sub": email})
+    db = SessionLocal()
+    try:
+        assert principal_from_token(token, db).email == email
+        _update_user(email, is_active=False)
+        assert principal_from_token(token, db) is None
+    finally:
+        db.close()
+
+
+def test_email_change_drops_old_key(cache_tier, email):
+    _principal(email)
+    new_email = f"nuevo-{email}"
+    _update_user(email, email=new_email)
+    assert tiered_get(_principal_key(email)) is None
+    assert _principal(email) is None
+    assert _principal(new_email).email == new_email
+
+
+def test_organization_change_invalidates_company(cache_tier, email, org_id):
+    assert _principal(email).company["company_name"] == "Org de pruebas"
+    db = SessionLocal()
+    try:
+        db.get(Organization, org_id).name = "Org Renombrada"
+        db.commit()
+    finally:
+        db.close()
+    assert _principal(email).company["company_name"] == "Org Renombrada"
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Verifica el enrutamiento de lecturas a la réplica (models.get_read_session)
+con dos bases SQLite locales: una hace de primario y otra de réplica.
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import models  # noqa: E402
+from models import Base, Organization  # noqa: E402
+from redis_client import local_cache  # noqa: E402
+
+
+@pytest.fixture
+def replica(tmp_path, monkeypatch):
+    primary_engine = create_engine(f"sqlite:///{tmp_path / 'primary.db'}")
+    replica_engine = create_engine(f"sqlite:///{tmp_path / 'replica.db'}")
+    for engine, name in ((primary_engine, "Primario"), (replica_engine, "Réplica")):
+        Base.metadata.create_all(bind=engine)
+        with sessionmaker(bind=engine)() as db:
+            db.add(Organization(name=name))
+            db.commit()
+
+    monkeypatch.setattr(models, "SessionLocal", sessionmaker(bind=primary_engine))
+    monkeypatch.setattr(models, "replica_engine", replica_engine)
+    monkeypatch.setattr(models, "ReplicaSessionLocal", sessionmaker(bind=replica_engine))
+    monkeypatch.setattr(models, "_replica_lag", {"checked_at": 0.0, "lag": None})
+    local_cache.clear()
+    # Lo que haría ReplicaLagMonitor en segundo plano
+    models.refresh_replica_lag()
+    yield
+    local_cache.clear()
+
+
+def _served_by(db) -> str:
+    try:
+        return db.query(Organization.name).order_by(Organization.id).first()[0]
+    finally:
+        db.close()
+
+
+def test_reads_go_to_replica(replica):
+    assert _served_by(models.get_read_session(user_id=1)) == "Réplica"
+
+
+def test_read_your_writes_pins_user_to_primary(replica):
+    models.mark_user_write(1)
+    assert _served_by(models.get_read_session(user_id=1)) == "Primario"
+    assert _served_by(models.get_read_session(user_id=2)) == "Réplica"
+
+
+def test_lagging_replica_falls_back_to_primary(replica, monkeypatch):
+    monkeypatch.setattr(models, "_measure_replica_lag", lambda: models.REPLICA_MAX_LAG_SECONDS + 1)
+    models.refresh_replica_lag()
+    assert _served_by(models.get_read_session(user_id=1)) == "Primario"
+
+
+def test_request_path_never_measures_lag(replica, monkeypatch):
+    def blocking_measure():
+        raise AssertionError("medición de retraso en la ruta de la petición")
+
+    monkeypatch.setattr(models, "_measure_replica_lag", blocking_measure)
+    assert _served_by(models.get_read_session(user_id=1)) == "Réplica"
+    # Sin mediciones recientes (monitor detenido o réplica colgada) se lee del primario
+    models._replica_lag["checked_at"] -= models.REPLICA_LAG_CHECK_INTERVAL * 4
+    assert _served_by(models.get_read_session(user_id=1)) == "Primario"
+
+
+def test_monitor_measures_in_background(replica, monkeypatch):
+    monkeypatch.setattr(models, "_replica_lag", {"checked_at": 0.0, "lag": None})
+    monitor = models.ReplicaLagMonitor(interval=0.01)
+
+    async def scenario():
+        monitor.start()
+        await asyncio.sleep(0.1)
+        await monitor.stop()
+
+    asyncio.run(scenario())
+    assert models.replica_lag_seconds() == 0.0
+
+
+def test_commit_marks_current_user_write(replica):
+    token = models.current_user_id.set(3)
+    try:
+        db = models.SessionLocal()
+        db.add(Organization(name="Otra"))
+        db.commit()
+        db.close()
+    finally:
+        models.current_user_id.reset(token)
+    assert models.has_recent_write(3)
+    assert _served_by(models.get_read_session(user_id=3)) == "Primario"
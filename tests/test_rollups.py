@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Los agregados diarios (invoice_daily_stats) deben coincidir siempre con el
+agregado en vivo sobre invoices, tras altas, procesamiento, ediciones y
+borrados (ORM y endpoints).
+"""
+import json
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+import dashboard_service
+from models import Invoice, InvoiceDailyStats, SessionLocal, engine, parse_audit_flags
+from statistics_service import get_rollup_statistics, rebuild_rollups
+
+
+def _live_totals(db, org_id):
+    invoices = db.query(Invoice).filter(Invoice.organization_id == org_id).all()
+    processed = [inv for inv in invoices if inv.processed]
+    return {
+        "invoices": len(invoices),
+        "processed": len(processed),
+        "cost_usd": round(sum(inv.openai_cost_usd or 0 for inv in invoices), 6),
+        "tokens": sum(inv.openai_tokens_used or 0 for inv in invoices),
+        "confidence_count": sum(1 for inv in processed if inv.confidence_score is not None),
+        "confidence_sum": round(sum(inv.confidence_score or 0 for inv in processed), 6),
+        "alerts": sum(1 for inv in processed if parse_audit_flags(inv.audit_flags)),
+    }
+
+
+def _rollup_totals(db, org_id):
+    totals = get_rollup_statistics(db, org_id)["totals"]
+    return {
+        "invoices": totals["invoices"],
+        "processed": totals["processed"],
+        "cost_usd": round(totals["cost_usd"], 6),
+        "tokens": totals["tokens"],
+        "confidence_count": totals["confidence_count"],
+        "confidence_sum": round(totals["confidence_sum"], 6),
+        "alerts": totals["alerts"],
+    }
+
+
+def _snapshot(db, org_id):
+    return sorted(
+        (str(row.day), row.model, row.invoices, row.processed, row.tokens, round(row.cost_usd, 6), row.alerts)
+        for row in db.query(InvoiceDailyStats).filter(InvoiceDailyStats.organization_id == org_id)
+        if row.invoices or row.processed
+    )
+
+
+def _assert_consistent(org_id):
+    db = SessionLocal()
+    try:
+        assert _rollup_totals(db, org_id) == _live_totals(db, org_id)
+    finally:
+        db.close()
+
+
+def test_rollups_match_live_aggregate(client, org_id):
+    now = datetime.utcnow()
+    db = SessionLocal()
+    for i in range(12):
+        db.add(Invoice(
+            filename=f"f{i}.pdf", organization_id=org_id, created_at=now - timedelta(days=i % 4),
+            openai_model_used="gpt-4o" if i % 2 else None,
+            openai_cost_usd=0.01 * i, openai_tokens_used=100 * i,
+        ))
+    db.commit()
+    _assert_consistent(org_id)
+
+    # Procesar: confianza y alertas
+    invoices = db.query(Invoice).filter(Invoice.organization_id == org_id).order_by(Invoice.id).all()
+    for i, invoice in enumerate(invoices[:8]):
+        invoice.processed = True
+        invoice.confidence_score = 0.5 + i / 20
+        invoice.audit_flags = json.dumps(["Dato fiscal faltante"] if i % 3 == 0 else [])
+    db.commit()
+    _assert_consistent(org_id)
+
+    # Editar una procesada (cambia sus alertas y costo)
+    invoices[0].audit_flags = json.dumps([])
+    invoices[0].openai_cost_usd = 1.5
+    db.commit()
+    _assert_consistent(org_id)
+
+    # Un cambio deshecho no debe tocar los agregados
+    invoices[1].processed = False
+    db.flush()
+    db.rollback()
+    _assert_consistent(org_id)
+    ids = [invoice.id for invoice in invoices]
+    db.close()
+
+    # Edición y borrados por los endpoints (borrado por conjuntos, sin ORM)
+    assert client.put(f"/invoices/{ids[2]}", json={"vendor_name": "Otro"}).status_code == 200
+    assert client.delete(f"/invoices/{ids[3]}").status_code == 200
+    assert client.post("/api/invoices/bulk-delete", json={"invoice_ids": ids[9:]}).json()["count"] == 3
+    _assert_consistent(org_id)
+
+    # La reconstrucción desde cero da exactamente los mismos agregados
+    db = SessionLocal()
+    try:
+        before = _snapshot(db, org_id)
+        rebuild_rollups(engine, org_id)
+        assert _snapshot(db, org_id) == before
+        assert db.query(func.count(Invoice.id)).filter(Invoice.organization_id == org_id).scalar() == 8
+    finally:
+        db.close()
+
+
+def test_rolled_back_savepoint_is_not_published(client, org_id, monkeypatch):
+    published = []
+    monkeypatch.setattr(dashboard_service.dashboard_feed, "record", published.append)
+    db = SessionLocal()
+    try:
+        kept = Invoice(filename="a.pdf", organization_id=org_id, openai_tokens_used=10)
+        db.add(kept)
+        db.flush()
+
+        savepoint = db.begin_nested()
+        db.add(Invoice(filename="b.pdf", organization_id=org_id, openai_tokens_used=1000))
+        db.flush()
+        savepoint.rollback()
+
+        # Un SAVEPOINT confirmado sí llega al feed
+        with db.begin_nested():
+            confirmed = Invoice(filename="c.pdf", organization_id=org_id, openai_tokens_used=5)
+            db.add(confirmed)
+        db.commit()
+
+        assert len(published) == 1
+        changes = published[0]
+        assert sorted(changes["rows"]) == sorted([kept.id, confirmed.id])
+        tokens = sum(
+            values.get("tokens", 0)
+            for deltas in changes["deltas"] for (org, _, _), values in deltas.items() if org == org_id
+        )
+        assert tokens == 15
+    finally:
+        db.close()
+    _assert_consistent(org_id)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Búsqueda de facturas de punta a punta: GET /invoices?search= contra el
+índice real del motor (FTS5 en SQLite), siguiendo altas, ediciones y borrados.
+"""
+import json
+
+from models import Invoice, SessionLocal
+from search_service import detect_backend
+
+
+def _add_invoices(org_id, *invoices):
+    db = SessionLocal()
+    try:
+        rows = [Invoice(filename=f"f{i}.pdf", organization_id=org_id, **data) for i, data in enumerate(invoices)]
+        db.add_all(rows)
+        db.commit()
+        return [row.id for row in rows]
+    finally:
+        db.close()
+
+
+def _search(client, term, **params):
+    response = client.get("/invoices", params={"search": term, "count": "exact", **params})
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_search_backend_is_indexed(client):
+    assert detect_backend(SessionLocal().get_bind()) == "fts5"
+
+
+def test_search_finds_vendor_number_and_items(client, org_id):
+    ochoa, nacional = _add_invoices(
+        org_id,
+        {"vendor_name": "Ferretería Ochoa", "invoice_number": "B0100000123",
+         "line_items_data": json.dumps([{"description": "Tornillos galvanizados"}])},
+        {"vendor_name": "Supermercado Nacional", "invoice_number": "B0200000999"},
+    )
+    # Sin acentos, por prefijo y por descripción de línea
+    assert [row["id"] for row in _search(client, "ferreteria")["invoices"]] == [ochoa]
+    assert [row["id"] for row in _search(client, "B01000001")["invoices"]] == [ochoa]
+    assert [row["id"] for row in _search(client, "tornillo")["invoices"]] == [ochoa]
+    assert [row["id"] for row in _search(client, "nacional")["invoices"]] == [nacional]
+    assert _search(client, "!!!")["total"] == 0
+
+
+def test_search_follows_edits_and_deletes(client, org_id):
+    (invoice_id,) = _add_invoices(org_id, {"vendor_name": "Ferretería Ochoa"})
+
+    assert client.put(f"/invoices/{invoice_id}", json={"vendor_name": "Distribuidora Zeta"}).status_code == 200
+    assert _search(client, "zeta")["total"] == 1
+    assert _search(client, "ochoa")["total"] == 0
+
+    assert client.delete(f"/invoices/{invoice_id}").status_code == 200
+    assert _search(client, "zeta")["total"] == 0
+
+
+def test_search_pages_by_relevance_cursor(client, org_id):
+    _add_invoices(org_id, *({"vendor_name": f"Nacional Sucursal {i}"} for i in range(15)))
+
+    first = _search(client, "nacional", limit=10)
+    assert first["total"] == 15 and first["has_more"]
+    second = _search(client, "nacional", limit=10, cursor=first["next_cursor"])
+    assert len(second["invoices"]) == 5 and not second["has_more"]
+    assert not {row["id"] for row in first["invoices"]} & {row["id"] for row in second["invoices"]}
+
+
+def test_search_is_scoped_to_organization(client, org_id):
+    other_org = org_id + 10_000
+    _add_invoices(other_org, {"vendor_name": "Proveedor Ajeno"})
+    assert _search(client, "ajeno")["total"] == 0
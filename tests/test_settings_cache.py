@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Registro de configuraciones cacheado (settings_service): un cambio
+confirmado en Setting, OrganizationSetting o UserSetting se ve en la
+siguiente lectura.
+"""
+import uuid
+
+import pytest
+
+from models import SessionLocal, Setting, User, UserSetting
+from settings_service import get_setting, grouped_settings
+
+
+@pytest.fixture(params=["redis", "memoria"])
+def cache_tier(request):
+    """Con Redis (fakeredis) y solo con la memoria local"""
+    if request.param == "redis":
+        request.getfixturevalue("fake_redis")
+    else:
+        from redis_client import local_cache
+        local_cache.clear()
+
+
+@pytest.fixture
+def setting_key(client):
+    key = f"prueba_{uuid.uuid4().hex[:8]}"
+    db = SessionLocal()
+    try:
+        db.add(Setting(key=key, value="10", type="int", category="pruebas", description="Valor de prueba"))
+        db.commit()
+    finally:
+        db.close()
+    return key
+
+
+def _set_default(key, value, commit=True):
+    db = SessionLocal()
+    try:
+        db.get(Setting, key).value = value
+        db.flush()
+        db.commit() if commit else db.rollback()
+    finally:
+        db.close()
+
+
+def _admin_id():
+    db = SessionLocal()
+    try:
+        return db.query(User.id).order_by(User.id).first()[0]
+    finally:
+        db.close()
+
+
+def test_default_update_is_seen_on_next_read(cache_tier, org_id, setting_key):
+    assert get_setting(setting_key, org_id=org_id) == 10
+    _set_default(setting_key, "20", commit=False)
+    assert get_setting(setting_key, org_id=org_id) == 10
+
+    _set_default(setting_key, "20")
+    assert get_setting(setting_key, org_id=org_id) == 20
+    grouped = grouped_settings(org_id, None)["pruebas"]
+    assert [(s["key"], s["value"], s["source"]) for s in grouped if s["key"] == setting_key] == [(setting_key, 20, "default")]
+
+
+def test_user_override_is_seen_on_next_read(cache_tier, org_id, setting_key):
+    user_id = _admin_id()
+    assert get_setting(setting_key, org_id=org_id, user_id=user_id) == 10
+
+    db = SessionLocal()
+    try:
+        db.add(UserSetting(user_id=user_id, key=setting_key, value="30"))
+        db.commit()
+    finally:
+        db.close()
+    assert get_setting(setting_key, org_id=org_id, user_id=user_id) == 30
+    # Los demás usuarios siguen con el valor por defecto
+    assert get_setting(setting_key, org_id=org_id) == 10
+
+
+def test_settings_endpoint_round_trip(cache_tier, client, org_id, setting_key):
+    assert client.get("/api/settings").status_code == 200
+    response = client.post("/api/settings", json=[{"key": setting_key, "value": "40"}])
+    assert response.status_code == 200, response.text
+    body = client.get("/api/settings").json()
+    values = {s["key"]: s["value"] for group in body.values() if isinstance(group, list) for s in group}
+    assert values[setting_key] == 40
+
+
+def test_organization_setting_applies_only_to_its_org(cache_tier, client, org_id, setting_key):
+    assert get_setting(setting_key, org_id=org_id) == 10
+    response = client.post("/api/settings", json=[{"key": setting_key, "value": "50", "scope": "organization"}])
+    assert response.status_code == 200, response.text
+    assert get_setting(setting_key, org_id=org_id) == 50
+    assert get_setting(setting_key, org_id=None) == 10
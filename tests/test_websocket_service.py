@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Gestor WebSocket sin servidor: colas de envío por conexión con su política
+de cliente lento (resync / drop) y difusión entre procesos simulados con
+varios InMemoryBroker de un mismo grupo, incluido el reenvío de eventos que
+llegan desordenados o se guardan en el stream de Redis.
+"""
+import asyncio
+import json
+import threading
+
+import websocket_service
+from broker_service import InMemoryBroker
+from replay_service import EventLog
+from websocket_service import WS_CLOSE_SLOW_CONSUMER, WebSocketManager
+
+
+class FakeSocket:
+    """WebSocket en memoria; `gate` permite simular un cliente que no lee"""
+
+    def __init__(self):
+        self.sent = []
+        self.close_code = None
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, message_str):
+        await self.gate.wait()
+        self.sent.append(json.loads(message_str))
+
+    async def close(self, code=1000):
+        self.close_code = code
+
+    def types(self):
+        return [message["type"] for message in self.sent]
+
+
+async def _settle():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def _message(n):
+    return json.dumps({"type": "invoice_uploaded", "n": n})
+
+
+def test_slow_client_gets_resync_and_does_not_block_others(monkeypatch):
+    monkeypatch.setattr(websocket_service, "WS_SEND_QUEUE_MAX", 3)
+
+    async def scenario():
+        manager = WebSocketManager(broker=InMemoryBroker())
+        slow, fast = FakeSocket(), FakeSocket()
+        await manager.connect(slow, 1)
+        await manager.connect(fast, 1)
+        await _settle()
+        slow.gate.clear()
+
+        # Uno queda en send_text, tres llenan la cola y el quinto la desborda
+        for n in range(5):
+            manager.deliver_local(_message(n), 1)
+            await _settle()
+
+        # El rápido recibió todo aunque el lento esté detenido
+        assert [m.get("n") for m in fast.sent[1:]] == list(range(5))
+        connection = manager._by_socket[slow]
+        assert connection.dropped > 0
+
+        slow.gate.set()
+        await _settle()
+        return manager, slow, connection
+
+    manager, slow, connection = asyncio.run(scenario())
+    # Los atrasados se descartan: solo el que estaba en curso y el aviso
+    assert slow.types() == ["connection_established", "invoice_uploaded", "resync_required"]
+    assert slow.close_code is None and manager.connection_count == 2
+    assert connection._resync_message is None
+
+
+def test_resync_not_consumed_closes_slow_client(monkeypatch):
+    monkeypatch.setattr(websocket_service, "WS_SEND_QUEUE_MAX", 3)
+
+    async def scenario():
+        manager = WebSocketManager(broker=InMemoryBroker())
+        slow = FakeSocket()
+        await manager.connect(slow, 1)
+        await _settle()
+        slow.gate.clear()
+        # El aviso de resync tampoco se entrega y la cola vuelve a llenarse
+        for n in range(10):
+            manager.deliver_local(_message(n), 1)
+            await _settle()
+        return manager, slow
+
+    manager, slow = asyncio.run(scenario())
+    assert slow.close_code == WS_CLOSE_SLOW_CONSUMER
+    assert manager.connection_count == 0
+
+
+def test_drop_policy_closes_slow_client(monkeypatch):
+    monkeypatch.setattr(websocket_service, "WS_SEND_QUEUE_MAX", 2)
+    monkeypatch.setattr(websocket_service, "WS_SLOW_CONSUMER_POLICY", "drop")
+
+    async def scenario():
+        manager = WebSocketManager(broker=InMemoryBroker())
+        slow = FakeSocket()
+        await manager.connect(slow, 1)
+        await _settle()
+        slow.gate.clear()
+        for n in range(5):
+            manager.deliver_local(_message(n), 1)
+        await _settle()
+        return manager, slow
+
+    manager, slow = asyncio.run(scenario())
+    assert slow.close_code == WS_CLOSE_SLOW_CONSUMER
+    assert manager.connection_count == 0
+    assert manager.connections == {}
+
+
+def test_failed_send_disconnects(monkeypatch):
+    async def scenario():
+        manager = WebSocketManager(broker=InMemoryBroker())
+        socket = FakeSocket()
+
+        async def broken_send(message_str):
+            raise ConnectionResetError("cliente desconectado")
+
+        socket.send_text = broken_send
+        await manager.connect(socket, 1)
+        await _settle()
+        return manager
+
+    manager = asyncio.run(scenario())
+    assert manager.connection_count == 0 and manager.connections == {}
+
+
+def _processes(count):
+    group = set()
+    return [WebSocketManager(broker=InMemoryBroker(group)) for _ in range(count)]
+
+
+def test_broadcast_reaches_sockets_in_other_processes():
+    async def scenario():
+        first, second = _processes(2)
+        for manager in (first, second):
+            await manager.start_broker()
+        here, there, other_org = FakeSocket(), FakeSocket(), FakeSocket()
+        await first.connect(here, 7)
+        await second.connect(there, 7)
+        await second.connect(other_org, 8)
+
+        await first.broadcast({"type": "dashboard_delta", "n": 1}, org_id=7)
+        await second.broadcast({"type": "dashboard_delta", "n": 2}, org_id=7)
+        await first.broadcast({"type": "dashboard_delta", "n": 3}, org_id=None)
+        await _settle()
+        return here, there, other_org
+
+    here, there, other_org = asyncio.run(scenario())
+    # Cada socket lo recibe una sola vez, venga del proceso que venga
+    assert [m.get("n") for m in here.sent[1:]] == [1, 2, 3]
+    assert [m.get("n") for m in there.sent[1:]] == [1, 2, 3]
+    assert [m.get("n") for m in other_org.sent[1:]] == [3]
+
+
+def test_process_subscribes_only_while_it_has_sockets():
+    async def scenario():
+        first, second = _processes(2)
+        for manager in (first, second):
+            await manager.start_broker()
+        socket, late = FakeSocket(), FakeSocket()
+        assert not second.broker.is_subscribed(7)
+
+        await second.connect(socket, 7)
+        assert second.broker.is_subscribed(7)
+        second.disconnect(socket)
+        assert not second.broker.is_subscribed(7)
+
+        # Ya sin suscripción no recibe los eventos de la organización
+        delivered = []
+        await second.broker.start(lambda *args: delivered.append(args))
+        await first.broadcast({"type": "dashboard_delta"}, org_id=7)
+        assert delivered == []
+
+        await second.stop_broker()
+        await first.connect(late, 7)
+        await first.broadcast({"type": "dashboard_delta"}, org_id=7)
+        await _settle()
+        return late
+
+    late = asyncio.run(scenario())
+    assert late.types() == ["connection_established", "dashboard_delta"]
+
+
+def test_out_of_order_events_are_replayed(monkeypatch):
+    log = EventLog(size=3)
+    monkeypatch.setattr(websocket_service, "event_log", log)
+
+    def event(n):
+        return json.dumps({"type": "invoice_uploaded", "event_id": f"100-{n}", "n": n})
+
+    async def scenario():
+        first, second = _processes(2)
+        for manager in (first, second):
+            await manager.start_broker()
+        live = FakeSocket()
+        await second.connect(live, 7)
+
+        # El evento 2 (publicado en otro proceso) llega antes que el 1
+        for n in (2, 1, 3):
+            await first.broker.publish(event(n), 7, f"100-{n}")
+        await _settle()
+
+        # Reconexión tras recibir el 1: se reenvían el 2 y el 3, no se pierde el 2
+        second.disconnect(live)
+        late = FakeSocket()
+        await second.connect(late, 7, last_event_id="100-1")
+        await _settle()
+        return live, late
+
+    live, late = asyncio.run(scenario())
+    assert [m["n"] for m in live.sent[1:]] == [2, 1, 3]
+    assert [m["n"] for m in late.sent[1:]] == [2, 3]
+    # Ambos procesos comparten el registro en la prueba: sin duplicados
+    assert [event_id for event_id, _ in log._rings[7]] == ["100-1", "100-2", "100-3"]
+
+    # Buffer lleno: uno más viejo que todo se descarta, uno intermedio desplaza al primero
+    log.record(7, "100-0", event(0))
+    log.record(7, "100-5", event(5))
+    log.record(7, "100-4", event(4))
+    assert [event_id for event_id, _ in log._rings[7]] == ["100-3", "100-4", "100-5"]
+    assert log.since(7, "100-3") == [event(4), event(5)]
+
+
+def test_redis_event_log_is_written_off_the_loop(fake_redis, monkeypatch):
+    log = EventLog()
+    monkeypatch.setattr(websocket_service, "event_log", log)
+    threads = []
+    xadd = log._xadd
+
+    def tracked_xadd(*args):
+        threads.append(threading.current_thread())
+        return xadd(*args)
+
+    monkeypatch.setattr(log, "_xadd", tracked_xadd)
+
+    async def scenario():
+        manager = _processes(1)[0]
+        await manager.start_broker()
+        live = FakeSocket()
+        await manager.connect(live, 7)
+        for n in (1, 2, 3):
+            await manager.broadcast({"type": "dashboard_delta", "n": n}, org_id=7)
+        await _settle()
+
+        # Sin sockets se olvida la copia en memoria: se reenvía desde el stream
+        manager.disconnect(live)
+        late = FakeSocket()
+        await manager.connect(late, 7, last_event_id=live.sent[1]["event_id"])
+        await _settle()
+        return live, late
+
+    live, late = asyncio.run(scenario())
+    assert len(threads) == 3 and threading.main_thread() not in threads
+    event_ids = [m["event_id"] for m in live.sent[1:]]
+    assert [event_id for event_id, _ in fake_redis.xrange("ws:events:7")] == event_ids
+    assert [m["n"] for m in late.sent[1:]] == [2, 3]
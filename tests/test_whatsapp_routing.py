@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Enrutamiento de WhatsApp (whatsapp_routing_service): número -> organización
+cacheado, respaldo del número legado y Evolution API propia de cada
+organización.
+"""
+import asyncio
+import random
+
+import pytest
+
+from models import Organization, OrganizationSetting, SessionLocal, Setting, WhatsAppSender
+from whatsapp_routing_service import evolution_config, resolve_sender
+
+
+@pytest.fixture(params=["redis", "memoria"])
+def cache_tier(request):
+    """Con Redis (fakeredis) y solo con la memoria local"""
+    if request.param == "redis":
+        request.getfixturevalue("fake_redis")
+    else:
+        from redis_client import local_cache
+        local_cache.clear()
+
+
+@pytest.fixture
+def phone():
+    return f"1809{random.randint(1000000, 9999999)}"
+
+
+def _add(*objects):
+    db = SessionLocal()
+    try:
+        db.add_all(objects)
+        db.commit()
+    finally:
+        db.close()
+
+
+def _set_sender_active(phone, active):
+    db = SessionLocal()
+    try:
+        db.query(WhatsAppSender).filter(WhatsAppSender.phone == phone).one().is_active = active
+        db.commit()
+    finally:
+        db.close()
+
+
+def _org_evolution(org_id, instance):
+    _add(
+        OrganizationSetting(organization_id=org_id, key="evolution_url", value=f"https://{instance}.example.com"),
+        OrganizationSetting(organization_id=org_id, key="evolution_instance", value=instance),
+    )
+
+
+def test_resolve_sender_uses_registered_number(cache_tier, org_id, phone):
+    # Número desconocido: el fallo también se cachea...
+    assert resolve_sender(f"{phone}@s.whatsapp.net") is None
+
+    # ...pero registrarlo lo invalida al confirmar
+    _add(WhatsAppSender(organization_id=org_id, phone=phone))
+    route = resolve_sender(f"{phone}@s.whatsapp.net:12")
+    assert (route.phone, route.organization_id) == (phone, org_id)
+
+    _set_sender_active(phone, False)
+    assert resolve_sender(phone) is None
+
+
+def test_legacy_authorized_number_routes_to_first_org(cache_tier, client, phone):
+    db = SessionLocal()
+    try:
+        first_org = db.query(Organization.id).order_by(Organization.id).limit(1).scalar()
+        legacy = db.get(Setting, "authorized_whatsapp_number")
+        previous, legacy.value = legacy.value, f"+{phone}"
+        db.commit()
+    finally:
+        db.close()
+    try:
+        assert resolve_sender(phone).organization_id == first_org
+    finally:
+        db = SessionLocal()
+        try:
+            db.get(Setting, "authorized_whatsapp_number").value = previous
+            db.commit()
+        finally:
+            db.close()
+    # Al cambiar el número legado deja de enrutarse
+    assert resolve_sender(phone) is None
+
+
+def test_evolution_config_is_per_organization(cache_tier, org_id):
+    db = SessionLocal()
+    try:
+        other = Organization(name="Otra org de pruebas")
+        db.add(other)
+        db.commit()
+        other_id = other.id
+    finally:
+        db.close()
+    _org_evolution(org_id, "instancia-a")
+    _org_evolution(other_id, "instancia-b")
+
+    config_a, config_b = evolution_config(org_id), evolution_config(other_id)
+    assert (config_a.url, config_a.instance_name) == ("https://instancia-a.example.com", "instancia-a")
+    assert (config_b.url, config_b.instance_name) == ("https://instancia-b.example.com", "instancia-b")
+    # Lo que la organización no define sale del valor global
+    assert config_a.api_key == config_b.api_key == evolution_config().api_key
+
+
+def test_webhook_replies_through_sender_org(cache_tier, org_id, phone, monkeypatch):
+    import whatsapp_service
+    from main import whatsapp_service as service
+
+    _add(WhatsAppSender(organization_id=org_id, phone=phone))
+    _org_evolution(org_id, "instancia-org")
+
+    processed, sent = [], []
+
+    async def fake_process_image_message(**kwargs):
+        processed.append(kwargs["route"].organization_id)
+        return {"status": "success", "invoice_id": 1}
+
+    class FakeResponse:
+        status_code = 200
+
+        def json(self):
+            return {}
+
+    def fake_post(url, **kwargs):
+        sent.append(url)
+        return FakeResponse()
+
+    monkeypatch.setattr(service, "_process_image_message", fake_process_image_message)
+    monkeypatch.setattr(whatsapp_service.requests, "post", fake_post)
+
+    def webhook(sender, message_id):
+        payload = {
+            "event": "messages.upsert",
+            "sender": f"{sender}@s.whatsapp.net",
+            "data": {"key": {"id": message_id}, "pushName": "Cliente", "message": {"imageMessage": {}}},
+        }
+        db = SessionLocal()
+        try:
+            return asyncio.run(service.process_webhook(payload, db))
+        finally:
+            db.close()
+
+    assert webhook(phone, f"msg-{phone}")["status"] == "success"
+    assert processed == [org_id]
+    assert sent == ["https://instancia-org.example.com/message/sendText/instancia-org"]
+
+    unknown = f"1829{phone[4:]}"
+    assert webhook(unknown, f"msg-{unknown}")["status"] == "unauthorized"
+    assert processed == [org_id]
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Escritor serializado (writer_service.SerializedWriter) sobre un SQLite
+temporal propio: lotes con un solo COMMIT, aislamiento por SAVEPOINT de cada
+trabajo, fallo del COMMIT externo y stop() vaciando la cola.
+"""
+import asyncio
+
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+from models import Base, Organization
+from writer_service import SerializedWriter, _create_writer_engine
+
+
+@pytest.fixture
+def writer_db(tmp_path):
+    engine = _create_writer_engine(f"sqlite:///{tmp_path / 'writer.db'}")
+    Base.metadata.create_all(bind=engine, tables=[Organization.__table__])
+    yield sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+    engine.dispose()
+
+
+def _names(session_factory):
+    with session_factory() as db:
+        return sorted(name for (name,) in db.query(Organization.name))
+
+
+def _add(name):
+    def job(db):
+        db.add(Organization(name=name))
+        db.flush()
+        return name
+    return job
+
+
+def _fail(db):
+    db.add(Organization(name="deshecha"))
+    db.flush()
+    raise ValueError("trabajo inválido")
+
+
+def test_jobs_are_committed_in_batches(writer_db):
+    writer = SerializedWriter(writer_db, batch_size=50, batch_window=0.02)
+
+    async def scenario():
+        results = await asyncio.gather(*(writer.submit(_add(f"org-{i}")) for i in range(30)))
+        await writer.stop()
+        return results
+
+    assert asyncio.run(scenario()) == [f"org-{i}" for i in range(30)]
+    assert writer.jobs == 30
+    # Llegaron dentro de la misma ventana: un COMMIT para todos
+    assert writer.batches == 1
+    assert len(_names(writer_db)) == 30
+
+
+def test_failed_job_only_rolls_back_its_savepoint(writer_db):
+    writer = SerializedWriter(writer_db, batch_window=0.02)
+
+    async def scenario():
+        outcomes = await asyncio.gather(
+            writer.submit(_add("antes")), writer.submit(_fail), writer.submit(_add("después")),
+            return_exceptions=True
+        )
+        await writer.stop()
+        return outcomes
+
+    before, failed, after = asyncio.run(scenario())
+    assert (before, after) == ("antes", "después")
+    assert isinstance(failed, ValueError)
+    assert writer.batches == 1
+    assert _names(writer_db) == ["antes", "después"]
+
+
+def test_failed_outer_commit_fails_every_job(writer_db, monkeypatch):
+    writer = SerializedWriter(writer_db, batch_window=0.02)
+
+    def broken_commit(self):
+        raise RuntimeError("disk I/O error")
+
+    async def scenario():
+        monkeypatch.setattr("sqlalchemy.orm.Session.commit", broken_commit)
+        outcomes = await asyncio.gather(writer.submit(_add("a")), writer.submit(_add("b")), return_exceptions=True)
+        monkeypatch.undo()
+        await writer.stop()
+        return outcomes
+
+    outcomes = asyncio.run(scenario())
+    assert all(isinstance(outcome, RuntimeError) for outcome in outcomes)
+    assert _names(writer_db) == []
+
+
+def test_stop_drains_queue(writer_db):
+    writer = SerializedWriter(writer_db, batch_size=5, batch_window=0.01)
+
+    async def scenario():
+        futures = [asyncio.ensure_future(writer.submit(_add(f"org-{i}"))) for i in range(12)]
+        await asyncio.sleep(0)
+        await writer.stop()
+        # Todo lo encolado antes de stop() quedó confirmado
+        assert all(future.done() and not future.exception() for future in futures)
+
+    asyncio.run(scenario())
+    assert len(_names(writer_db)) == 12
+    assert writer.batches == 3
+
+
+def test_writer_restarts_on_a_new_loop(writer_db):
+    writer = SerializedWriter(writer_db, batch_window=0.0)
+
+    async def scenario(name):
+        result = await writer.submit(_add(name))
+        await writer.stop()
+        return result
+
+    # Un reinicio de la app (nuevo event loop) vuelve a levantar la tarea
+    assert asyncio.run(scenario("primero")) == "primero"
+    assert asyncio.run(scenario("segundo")) == "segundo"
+    assert _names(writer_db) == ["primero", "segundo"]
@@ -1,118 +1,223 @@
 import json
 import asyncio
-from typing import List, Dict, Any
+import os
+from typing import Dict, Any, Optional, Set
 from fastapi import WebSocket, WebSocketDisconnect
 from datetime import datetime
 
-from models import SessionLocal, Notification, Invoice
+from broker_service import create_broker
+from notification_service import notification_writer
+from replay_service import event_log
+
+# Mensajes en espera por conexión antes de aplicar la política de cliente lento
+WS_SEND_QUEUE_MAX = int(os.getenv("WS_SEND_QUEUE_MAX", "100"))
+# Segundos máximos para un send_text antes de dar la conexión por muerta
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))
+# "resync": se vacía la cola y se pide al cliente recargar; "drop": se cierra la conexión
+WS_SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "resync")
+
+# Código de cierre "Try Again Later": el cliente puede reconectar
+WS_CLOSE_SLOW_CONSUMER = 1013
+
+
+class WebSocketConnection:
+    """
+    Conexión WebSocket con cola de envío acotada y tarea escritora propia:
+    un cliente lento solo retrasa sus propios mensajes.
+    """
+
+    def __init__(self, manager: "WebSocketManager", websocket: WebSocket, org_id: Optional[int]):
+        self.manager = manager
+        self.socket = websocket
+        self.org_id = org_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=WS_SEND_QUEUE_MAX)
+        self.task: Optional[asyncio.Task] = None
+        self.closed = False
+        # Aviso de resincronización en la cola aún sin entregar
+        self._resync_message: Optional[str] = None
+        self.dropped = 0
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self._writer())
+
+    def send(self, message_str: str):
+        """Encola un mensaje ya serializado (no bloquea)"""
+        if self.closed:
+            return
+        try:
+            self.queue.put_nowait(message_str)
+        except asyncio.QueueFull:
+            self._on_slow_consumer()
+
+    def _on_slow_consumer(self):
+        self.dropped += 1
+        if WS_SLOW_CONSUMER_POLICY == "resync" and self._resync_message is None:
+            # Los mensajes atrasados ya no sirven: el cliente recarga el estado completo
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self._resync_message = json.dumps({
+                "type": "resync_required",
+                "message": "Demasiados eventos pendientes, recargando datos",
+                "timestamp": datetime.now().isoformat()
+            })
+            self.queue.put_nowait(self._resync_message)
+            print(f"🐢 Cliente WebSocket lento (org {self.org_id}): cola vaciada, se solicita resincronizar")
+        else:
+            # Tampoco consume el aviso: se cierra y que reconecte
+            print(f"🐢 Cliente WebSocket lento (org {self.org_id}): conexión cerrada")
+            self.manager.disconnect(self.socket, code=WS_CLOSE_SLOW_CONSUMER)
+
+    async def _writer(self):
+        while True:
+            message_str = await self.queue.get()
+            try:
+                async with asyncio.timeout(WS_SEND_TIMEOUT):
+                    await self.socket.send_text(message_str)
+            except Exception as e:
+                print(f"❌ Error enviando a conexión: {e}")
+                self.manager.disconnect(self.socket)
+                return
+            if message_str is self._resync_message:
+                self._resync_message = None
+
+    async def _close_socket(self, code: int):
+        try:
+            await asyncio.wait_for(self.socket.close(code=code), timeout=WS_SEND_TIMEOUT)
+        except Exception:
+            pass
+
+    def close(self, code: Optional[int] = None):
+        """Detiene la tarea escritora (y cierra el socket si se indica código)"""
+        if self.closed:
+            return
+        self.closed = True
+        current = asyncio.current_task()
+        if self.task is not None and self.task is not current:
+            self.task.cancel()
+        if code is not None:
+            asyncio.get_running_loop().create_task(self._close_socket(code))
+
 
 class WebSocketManager:
     """
-    Gestor de conexiones WebSocket para notificaciones en tiempo real
+    Gestor de conexiones WebSocket para notificaciones en tiempo real.
+
+    Las conexiones se indexan por organización (dict de sets): un broadcast
+    solo recorre las de su organización y desconectar es O(1). El envío es
+    concurrente: broadcast serializa el mensaje una vez y lo encola en cada
+    conexión, cuya tarea escritora lo entrega (ver WebSocketConnection).
+
+    Con varios procesos, broadcast pasa por el broker (broker_service.py),
+    que entrega el mensaje en los sockets de todos los procesos. Los eventos
+    de cada organización se numeran y guardan (replay_service.py) para
+    reenviarlos a quien se reconecta con `last_event_id`.
     """
     
-    def __init__(self):
-        # Lista de conexiones activas con org asociada
-        self.active_connections: List[Dict[str, Any]] = []
+    def __init__(self, broker=None):
+        # Conexiones activas por organización
+        self.connections: Dict[Optional[int], Set[WebSocketConnection]] = {}
+        self._by_socket: Dict[WebSocket, WebSocketConnection] = {}
+        self.broker = broker or create_broker()
         # Estadísticas de notificaciones
         self.notification_count = 0
+
+    async def start_broker(self):
+        """Empieza a recibir los broadcasts de otros procesos"""
+        await self.broker.start(self.deliver_local)
+
+    async def stop_broker(self):
+        await self.broker.stop()
+
+    @property
+    def connection_count(self) -> int:
+        return len(self._by_socket)
         
-    async def connect(self, websocket: WebSocket, org_id: int):
-        """Conectar un nuevo cliente WebSocket"""
+    async def connect(self, websocket: WebSocket, org_id: int, last_event_id: Optional[str] = None):
+        """Conectar un nuevo cliente WebSocket (reenviando lo posterior a `last_event_id`)"""
         await websocket.accept()
-        self.active_connections.append({"socket": websocket, "org_id": org_id})
-        print(f"📡 Nueva conexión WebSocket. Total: {len(self.active_connections)}")
-        
+        connection = WebSocketConnection(self, websocket, org_id)
+
         # Enviar mensaje de bienvenida
-        await self.send_personal_message({
+        connection.send(json.dumps({
             "type": "connection_established",
             "message": "Conectado al sistema de notificaciones",
             "timestamp": datetime.now().isoformat()
-        }, websocket)
+        }))
+        if last_event_id:
+            # Sin await hasta registrar la conexión: ningún evento queda entre
+            # lo reenviado y lo que llegue en vivo (el cliente descarta repetidos)
+            missed = event_log.since(org_id, last_event_id)
+            if missed is None:
+                connection.send(json.dumps({
+                    "type": "resync_required",
+                    "message": "Se perdieron demasiados eventos, recargando datos",
+                    "timestamp": datetime.now().isoformat()
+                }))
+            else:
+                for message_str in missed:
+                    connection.send(message_str)
+
+        if org_id not in self.connections:
+            # Primer socket de la organización en este proceso
+            self.broker.subscribe(org_id)
+        self.connections.setdefault(org_id, set()).add(connection)
+        self._by_socket[websocket] = connection
+        connection.start()
+        print(f"📡 Nueva conexión WebSocket. Total: {self.connection_count}")
     
-    def disconnect(self, websocket: WebSocket):
+    def disconnect(self, websocket: WebSocket, code: Optional[int] = None):
         """Desconectar cliente WebSocket"""
-        self.active_connections = [
-            conn for conn in self.active_connections if conn["socket"] is not websocket
-        ]
-        print(f"📡 Conexión WebSocket cerrada. Total: {len(self.active_connections)}")
+        connection = self._by_socket.pop(websocket, None)
+        if connection is None:
+            return
+        org_connections = self.connections.get(connection.org_id)
+        if org_connections is not None:
+            org_connections.discard(connection)
+            if not org_connections:
+                del self.connections[connection.org_id]
+                self.broker.unsubscribe(connection.org_id)
+                event_log.forget(connection.org_id)
+        connection.close(code)
+        print(f"📡 Conexión WebSocket cerrada. Total: {self.connection_count}")
     
     async def send_personal_message(self, message: Dict[str, Any], websocket: WebSocket):
         """Enviar mensaje a un cliente específico"""
+        connection = self._by_socket.get(websocket)
+        if connection is not None:
+            connection.send(json.dumps(message))
+            return
         try:
             await websocket.send_text(json.dumps(message))
         except Exception as e:
             print(f"❌ Error enviando mensaje personal: {e}")
-            self.disconnect(websocket)
     
     async def broadcast(self, message: Dict[str, Any], org_id: int = None):
         """Enviar mensaje a todos los clientes conectados y guardar en BD"""
         
-        # 1. Guardar en Base de Datos (Persistencia)
-        if message.get("type") not in ["heartbeat", "connection_established", "statistics_update"]:
-            try:
-                db = SessionLocal()
-                resolved_org_id = org_id
-                try:
-                    invoice_id = message.get("data", {}).get("invoice_id")
-                    if invoice_id:
-                        inv = db.query(Invoice).filter(Invoice.id == invoice_id).first()
-                        resolved_org_id = inv.organization_id if inv else None
-                except Exception:
-                    resolved_org_id = org_id
-
-                notification = Notification(
-                    type=message.get("severity", "info") if message.get("type") == "cost_alert" else "info", # Simplificado
-                    title=message.get("type", "Notificación"),
-                    message=message.get("message", ""),
-                    data=json.dumps(message.get("data", {})),
-                    read=False,
-                    organization_id=resolved_org_id
-                )
-                
-                # Mapeo específico de tipos
-                if message.get("type") == "processing_complete":
-                    notification.type = "success" if message.get("data", {}).get("success") else "error"
-                    notification.title = "Procesamiento Completado"
-                elif message.get("type") == "whatsapp_image_received":
-                    notification.type = "info"
-                    notification.title = "Nuevo Mensaje WhatsApp"
-                elif message.get("type") == "invoice_uploaded":
-                    notification.type = "success"
-                    notification.title = "Archivo Subido"
-                elif message.get("type") == "cost_alert":
-                    notification.type = message.get("severity", "warning")
-                    notification.title = "Alerta de Costos"
-                
-                db.add(notification)
-                db.commit()
-                db.close()
-            except Exception as e:
-                print(f"❌ Error guardando notificación en BD: {e}")
+        # 1. Guardar en Base de Datos por lotes (ver notification_service.py)
+        if message.get("type") not in ["heartbeat", "connection_established", "dashboard_delta"]:
+            notification_writer.enqueue(message, org_id)
 
-        # 2. Enviar por WebSocket (Tiempo Real)
-        if not self.active_connections:
-            # print("📡 No hay conexiones WebSocket activas")
-            return
-        
+        # 2. Enviar por WebSocket (Tiempo Real) en este y los demás procesos
         message["timestamp"] = datetime.now().isoformat()
-        message_str = json.dumps(message)
-        
-        print(f"📡 Broadcasting a {len(self.active_connections)} clientes: {message.get('type', 'unknown')}")
-        
-        # Enviar a todas las conexiones activas
-        disconnected = []
-        for connection in self.active_connections:
-            try:
-                if org_id is None or connection["org_id"] == org_id:
-                    await connection["socket"].send_text(message_str)
-            except Exception as e:
-                print(f"❌ Error enviando a conexión: {e}")
-                disconnected.append(connection["socket"])
-        
-        # Remover conexiones fallidas
-        for connection in disconnected:
-            self.disconnect(connection)
+        print(f"📡 Broadcasting: {message.get('type', 'unknown')} (org {org_id})")
+        if event_log.sequenced(message, org_id):
+            message_str, event_id = await event_log.append(message, org_id)
+        else:
+            message_str, event_id = json.dumps(message), None
+        await self.broker.publish(message_str, org_id, event_id)
+
+    def deliver_local(self, message_str: str, org_id: Optional[int] = None, event_id: Optional[str] = None):
+        """Encola un mensaje serializado en los sockets de este proceso"""
+        if event_id is not None:
+            event_log.record(org_id, event_id, message_str, subscribed=self.broker.is_subscribed(org_id))
+        if org_id is None:
+            targets = list(self._by_socket.values())
+        else:
+            targets = list(self.connections.get(org_id, ()))
+        # Cada conexión lo entrega desde su propia tarea
+        for connection in targets:
+            connection.send(message_str)
     
     async def notify_new_whatsapp_image(self, sender_info: Dict[str, Any], invoice_id: int, org_id: int = None):
         """
@@ -195,35 +300,31 @@ class WebSocketManager:
             }
         }, org_id=org_id)
     
-    async def notify_statistics_update(self, stats: Dict[str, Any], org_id: int = None):
-        """
-        Notificar actualización de estadísticas
-        """
-        await self.broadcast({
-            "type": "statistics_update",
-            "message": "Estadísticas actualizadas",
-            "data": stats
-        }, org_id=org_id)
-    
     async def send_heartbeat(self):
         """
         Enviar heartbeat para mantener conexiones vivas
         """
-        if self.active_connections:
-            await self.broadcast({
+        # Solo a los sockets de este proceso (cada proceso envía el suyo)
+        if self._by_socket:
+            self.deliver_local(json.dumps({
                 "type": "heartbeat",
-                "connections": len(self.active_connections),
-                "notifications_sent": self.notification_count
-            })
+                "connections": self.connection_count,
+                "notifications_sent": self.notification_count,
+                "timestamp": datetime.now().isoformat()
+            }))
     
     def get_status(self) -> Dict[str, Any]:
         """
         Obtener estado del WebSocket manager
         """
         return {
-            "active_connections": len(self.active_connections),
+            "active_connections": self.connection_count,
+            "organizations": len(self.connections),
+            "slow_consumer_drops": sum(conn.dropped for conn in self._by_socket.values()),
+            **self.broker.stats(),
+            **event_log.stats(),
             "notifications_sent": self.notification_count,
-            "status": "active" if self.active_connections else "idle"
+            "status": "active" if self._by_socket else "idle"
         }
 
 # Instancia global del manager
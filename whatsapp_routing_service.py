@@ -0,0 +1,149 @@
+"""
+Enrutamiento de mensajes de WhatsApp a su organización.
+
+Cada número autorizado vive en ``whatsapp_senders`` (varios por
+organización). El webhook resuelve número -> organización con
+``resolve_sender``, que lee del caché de dos niveles (memoria + Redis): en
+régimen normal no toca la BD. Los números desconocidos también se cachean
+(TTL corto) para que el spam no genere consultas.
+
+La configuración de Evolution API (URL, API key, instancia) es propia de
+cada organización: se guarda en ``organization_settings`` y se lee del
+registro de settings de la organización (settings_service.py, en memoria),
+con los valores globales y las variables de entorno como respaldo.
+
+Compatibilidad: si el número no está en la tabla pero coincide con el
+setting ``authorized_whatsapp_number`` se enruta a la organización por
+defecto, como antes de existir la tabla.
+"""
+import logging
+import os
+import re
+from dataclasses import dataclass
+from typing import Optional, Set
+
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.orm import Session
+
+from models import Organization, SessionLocal, WhatsAppSender
+from redis_client import cache_delete, invalidate_on_commit, tag_keys, tiered_get, tiered_set
+from settings_service import DEFAULTS_TAG, get_settings_map
+
+logger = logging.getLogger(__name__)
+
+ROUTE_CACHE_TTL = 3600
+# Números desconocidos: se vuelve a consultar pronto por si se registran
+ROUTE_MISS_TTL = 60
+
+
+@dataclass
+class EvolutionConfig:
+    """Conexión a Evolution API de una organización"""
+    url: str
+    api_key: str
+    instance_name: str
+
+    def headers(self) -> dict:
+        return {"apikey": self.api_key, "Content-Type": "application/json"}
+
+
+@dataclass
+class SenderRoute:
+    """Organización (y su Evolution API) que atiende a un número"""
+    phone: str
+    organization_id: int
+    evolution: EvolutionConfig
+
+
+def normalize_phone(raw: Optional[str]) -> str:
+    """JID o número de WhatsApp -> solo dígitos ("1809...@s.whatsapp.net:12" -> "1809...")"""
+    if not raw:
+        return ""
+    phone = str(raw).split("@")[0].split(":")[0]
+    return re.sub(r"\D", "", phone)
+
+
+def evolution_config(org_id: Optional[int] = None) -> EvolutionConfig:
+    """Configuración de Evolution API de la organización (organization_settings, settings o variables de entorno)"""
+    settings = get_settings_map(org_id)
+
+    def get_val(key, default):
+        setting = settings.get(key)
+        return setting["value"] if setting and setting["value"] else default
+
+    return EvolutionConfig(
+        url=get_val("evolution_url", os.getenv("EVOLUTION_API_URL", "")),
+        api_key=get_val("evolution_apikey", os.getenv("EVOLUTION_API_KEY", "")),
+        instance_name=get_val("evolution_instance", os.getenv("EVOLUTION_INSTANCE_NAME", ""))
+    )
+
+
+def _route_key(phone: str) -> str:
+    return f"whatsapp:route:{phone}"
+
+
+def _load_route(db: Session, phone: str) -> Optional[int]:
+    org_id = db.query(WhatsAppSender.organization_id).filter(
+        WhatsAppSender.phone == phone,
+        WhatsAppSender.is_active == True
+    ).scalar()
+    if org_id is not None:
+        return org_id
+
+    # Número único configurado antes de la tabla de remitentes
+    legacy = get_settings_map().get("authorized_whatsapp_number") or {}
+    legacy_number = normalize_phone(legacy.get("value") or os.getenv("AUTHORIZED_WHATSAPP_NUMBER", ""))
+    if legacy_number and legacy_number == phone:
+        return db.query(Organization.id).order_by(Organization.id).limit(1).scalar()
+    return None
+
+
+def resolve_sender(raw_phone: Optional[str], db: Optional[Session] = None) -> Optional[SenderRoute]:
+    """Ruta del número o None si no está autorizado"""
+    phone = normalize_phone(raw_phone)
+    if not phone:
+        return None
+
+    key = _route_key(phone)
+    cached = tiered_get(key)
+    if isinstance(cached, dict):
+        org_id = cached.get("org_id")
+    else:
+        own_session = db is None
+        if own_session:
+            db = SessionLocal()
+        try:
+            org_id = _load_route(db, phone)
+        finally:
+            if own_session:
+                db.close()
+        tiered_set(key, {"org_id": org_id}, ttl=ROUTE_CACHE_TTL if org_id is not None else ROUTE_MISS_TTL)
+        # El número legado cambia con los settings por defecto
+        tag_keys(DEFAULTS_TAG, key)
+
+    if org_id is None:
+        return None
+    return SenderRoute(phone=phone, organization_id=org_id, evolution=evolution_config(org_id))
+
+
+def invalidate_route(phone: str):
+    cache_delete(_route_key(phone))
+
+
+# ===========================================
+# EVENTOS DE SESIÓN
+# ===========================================
+
+def _route_changes(obj) -> Set[str]:
+    if not isinstance(obj, WhatsAppSender):
+        return set()
+    # También el número anterior si se editó
+    return {phone for phone in [obj.phone, *sa_inspect(obj).attrs.phone.history.deleted] if phone}
+
+
+def _invalidate_routes(phones: Set[str]):
+    for phone in phones:
+        invalidate_route(phone)
+
+
+invalidate_on_commit("_whatsapp_route_changes", _route_changes, _invalidate_routes)
@@ -7,9 +7,11 @@ from datetime import datetime
 from PIL import Image, ImageFile
 from typing import Optional, Dict, Any
 from sqlalchemy.orm import Session
-from models import Invoice, Setting, SessionLocal, Organization
+from models import Invoice
 from openai_service import OpenAIInvoiceProcessor
-from redis_client import cache_get, cache_set, rate_limit, is_duplicate_message, invalidate_cache_pattern
+from redis_client import rate_limit, is_duplicate_message
+from whatsapp_routing_service import EvolutionConfig, SenderRoute, evolution_config, normalize_phone, resolve_sender
+from writer_service import run_write
 
 # Permitir cargar imágenes truncadas
 ImageFile.LOAD_TRUNCATED_IMAGES = True
@@ -20,62 +22,15 @@ class WhatsAppService:
         self.openai_processor = OpenAIInvoiceProcessor()
         
     def _refresh_config(self):
-        """Carga la configuración desde la base de datos o variables de entorno con caché Redis"""
-        # Intentar cargar desde caché Redis primero
-        cache_key = "settings:whatsapp:default"
-        cached_config = cache_get(cache_key)
-        if cached_config:
-            self.evolution_url = cached_config.get("evolution_url", "")
-            self.api_key = cached_config.get("evolution_apikey", "")
-            self.instance_name = cached_config.get("evolution_instance", "")
-            self.authorized_number = cached_config.get("authorized_whatsapp_number", "")
-            print(f"⚡ WhatsApp Config desde caché: URL={self.evolution_url}, Instance={self.instance_name}, Auth={self.authorized_number}")
-            return
+        """Carga la configuración por defecto desde el registro de settings (en memoria) o variables de entorno"""
+        self.config = evolution_config()
+        self.evolution_url = self.config.url
+        self.api_key = self.config.api_key
+        self.instance_name = self.config.instance_name
 
-        # Si no está en caché, cargar desde DB
-        db = SessionLocal()
-        try:
-            org = db.query(Organization).first()
-            org_id = org.id if org else None
-
-            def get_val(key, default):
-                query = db.query(Setting).filter(Setting.key == key)
-                if org_id:
-                    query = query.filter(Setting.organization_id == org_id)
-                s = query.first()
-                return s.value if s and s.value else default
-
-            self.evolution_url = get_val("evolution_url", os.getenv("EVOLUTION_API_URL", ""))
-            self.api_key = get_val("evolution_apikey", os.getenv("EVOLUTION_API_KEY", ""))
-            self.instance_name = get_val("evolution_instance", os.getenv("EVOLUTION_INSTANCE_NAME", ""))
-            self.authorized_number = get_val("authorized_whatsapp_number", os.getenv("AUTHORIZED_WHATSAPP_NUMBER", ""))
-
-            # Guardar en caché por 1 hora
-            config_data = {
-                "evolution_url": self.evolution_url,
-                "evolution_apikey": self.api_key,
-                "evolution_instance": self.instance_name,
-                "authorized_whatsapp_number": self.authorized_number
-            }
-            cache_set(cache_key, config_data, ttl=3600)
-
-            print(f"⚙️ WhatsApp Config Cargada desde DB: URL={self.evolution_url}, Instance={self.instance_name}, Auth={self.authorized_number}")
-        except Exception as e:
-            print(f"⚠️ Error cargando config de WhatsApp: {e}")
-            # Fallback a env vars si falla DB
-            self.evolution_url = os.getenv("EVOLUTION_API_URL", "")
-            self.api_key = os.getenv("EVOLUTION_API_KEY", "")
-            self.instance_name = os.getenv("EVOLUTION_INSTANCE_NAME", "")
-            self.authorized_number = os.getenv("AUTHORIZED_WHATSAPP_NUMBER", "")
-        finally:
-            db.close()
-        
-    def get_headers(self) -> Dict[str, str]:
+    def get_headers(self, config: Optional[EvolutionConfig] = None) -> Dict[str, str]:
         """Headers para Evolution API"""
-        return {
-            "apikey": self.api_key,
-            "Content-Type": "application/json"
-        }
+        return (config or self.config).headers()
     
     async def process_webhook(self, payload: Dict[str, Any], db: Session) -> Dict[str, Any]:
         """
@@ -107,18 +62,21 @@ class WhatsAppService:
 
             # Rate Limiting: Limitar mensajes por remitente (10 mensajes por minuto)
             if sender:
-                clean_sender = sender.replace("@s.whatsapp.net", "").replace("@c.us", "").split(":")[0]
+                clean_sender = normalize_phone(sender)
                 if not rate_limit(f"webhook:{clean_sender}", limit=10, window=60):
                     print(f"🚫 Rate limit excedido para {clean_sender}")
                     return {"status": "rate_limited", "message": "Demasiados mensajes, intenta más tarde"}
 
+            # Organización del remitente (índice en caché, None si no está autorizado)
+            route = resolve_sender(sender, db)
+
             # Procesar formato nativo de Evolution API
             if payload.get("event") == "messages.upsert" and "data" in payload:
-                return await self._process_native_format(payload, db)
+                return await self._process_native_format(payload, db, route)
 
             # Procesar formato estándar WhatsApp Business API
             elif "object" in payload and "entry" in payload:
-                return await self._process_standard_format(payload, db)
+                return await self._process_standard_format(payload, db, route)
 
             print(f"⚠️ Formato de webhook no reconocido o evento ignorado: {payload.get('event')}")
             return {"status": "ignored", "message": "Formato no reconocido"}
@@ -129,18 +87,18 @@ class WhatsAppService:
             traceback.print_exc()
             return {"status": "error", "error": str(e)}
     
-    async def _process_native_format(self, payload: Dict[str, Any], db: Session) -> Dict[str, Any]:
+    async def _process_native_format(self, payload: Dict[str, Any], db: Session, route: Optional[SenderRoute]) -> Dict[str, Any]:
         """Procesa formato nativo de Evolution API"""
         data = payload["data"]
         sender_phone = payload.get("sender", "")
         sender_name = data.get("pushName", "Usuario WhatsApp")
         message_id = data.get("key", {}).get("id", "unknown")
         
-        # 🔒 VALIDACIÓN DE SEGURIDAD: Solo permitir mensajes del número autorizado
-        clean_sender = sender_phone.replace("@s.whatsapp.net", "").replace("@c.us", "").replace("+", "").split(":")[0]
+        # 🔒 VALIDACIÓN DE SEGURIDAD: Solo permitir mensajes de números registrados
+        clean_sender = normalize_phone(sender_phone)
         
-        if clean_sender != self.authorized_number:
-            print(f"🚫 Acceso denegado: {clean_sender} intentó enviar una factura (Autorizado: {self.authorized_number})")
+        if route is None:
+            print(f"🚫 Acceso denegado: {clean_sender} intentó enviar una factura (número no registrado)")
             return {
                 "status": "unauthorized", 
                 "message": f"Número no autorizado: {clean_sender}"
@@ -155,10 +113,11 @@ class WhatsAppService:
                 message_id=message_id,
                 sender_phone=sender_phone,
                 sender_name=sender_name,
-                db=db
+                db=db,
+                route=route
             )
             
-            await self._send_auto_response(sender_phone, result)
+            await self._send_auto_response(sender_phone, result, route.evolution)
             return {"status": "success", "result": result}
         
         print(f"ℹ️ Mensaje de {clean_sender} no contenía imagen (imageMessage).")
@@ -168,12 +127,12 @@ class WhatsAppService:
         if "message" in data and "conversation" in data["message"]:
             text = data["message"]["conversation"].lower().strip()
             if text in ["estado", "status", "help", "ayuda"]:
-                await self._send_help_message(sender_phone)
+                await self._send_help_message(sender_phone, route.evolution)
                 return {"status": "help_sent"}
         
         return {"status": "ignored", "message": "Mensaje no procesable"}
     
-    async def _process_standard_format(self, payload: Dict[str, Any], db: Session) -> Dict[str, Any]:
+    async def _process_standard_format(self, payload: Dict[str, Any], db: Session, route: Optional[SenderRoute]) -> Dict[str, Any]:
         """Procesa formato estándar WhatsApp Business API"""
         try:
             # Extraer información del remitente del formato estándar
@@ -197,19 +156,17 @@ class WhatsAppService:
                     sender_name = contact.get("profile", {}).get("name", "Usuario WhatsApp")
                     break
             
-            # 🔒 VALIDACIÓN DE SEGURIDAD: Solo permitir mensajes del número autorizado
-            # Limpiar el número del remitente para comparación
-            clean_sender = sender_phone.replace("@s.whatsapp.net", "").replace("@c.us", "").replace("+", "")
+            # 🔒 VALIDACIÓN DE SEGURIDAD: Solo permitir mensajes de números registrados
+            clean_sender = normalize_phone(sender_phone)
             
-            if clean_sender != self.authorized_number:
-                print(f"🚫 Mensaje rechazado (formato estándar) - Número no autorizado: {clean_sender} (autorizado: {self.authorized_number})")
+            if route is None:
+                print(f"🚫 Mensaje rechazado (formato estándar) - Número no autorizado: {clean_sender}")
                 return {
                     "status": "unauthorized", 
-                    "message": f"Número no autorizado: {clean_sender}",
-                    "authorized_number": self.authorized_number
+                    "message": f"Número no autorizado: {clean_sender}"
                 }
             
-            print(f"✅ Número autorizado procesando mensaje estándar: {clean_sender}")
+            print(f"✅ Número autorizado procesando mensaje estándar: {clean_sender} (org {route.organization_id})")
             
             # Procesar imagen si existe
             if message.get("type") == "image" and message.get("image"):
@@ -219,11 +176,12 @@ class WhatsAppService:
                     message_id=message.get("id", "unknown"),
                     sender_phone=sender_phone,
                     sender_name=sender_name,
-                    db=db
+                    db=db,
+                    route=route
                 )
                 
                 # Enviar respuesta automática
-                await self._send_auto_response(sender_phone, result)
+                await self._send_auto_response(sender_phone, result, route.evolution)
                 
                 return {
                     "status": "success",
@@ -235,7 +193,7 @@ class WhatsAppService:
             elif message.get("type") == "text" and message.get("text"):
                 text_content = message["text"].get("body", "").lower().strip()
                 if text_content in ["estado", "status", "help", "ayuda"]:
-                    await self._send_help_message(sender_phone)
+                    await self._send_help_message(sender_phone, route.evolution)
                     return {"status": "help_sent"}
             
             return {"status": "standard_format_processed"}
@@ -249,7 +207,8 @@ class WhatsAppService:
         message_id: str, 
         sender_phone: str, 
         sender_name: str, 
-        db: Session
+        db: Session,
+        route: SenderRoute
     ) -> Dict[str, Any]:
         """
         Procesa mensaje de imagen de forma robusta
@@ -257,8 +216,8 @@ class WhatsAppService:
         try:
             print(f"🔄 Procesando imagen: {message_id}")
             
-            # Obtener imagen original desde Evolution API
-            image_base64 = await self._get_image_from_evolution(message_id)
+            # Obtener imagen original desde la Evolution API de la organización
+            image_base64 = await self._get_image_from_evolution(message_id, route.evolution)
             
             if not image_base64:
                 return {
@@ -280,20 +239,24 @@ class WhatsAppService:
                     "error": processed_image["error"]
                 }
             
-            # Crear registro en base de datos
-            org = db.query(Organization).first()
-            org_id = org.id if org else None
-            invoice = Invoice(
-                filename=processed_image["filename"],
-                file_path=processed_image["file_path"],
-                file_type="image",
-                processed=False,
-                description=f"WhatsApp de {sender_name} ({sender_phone})",
-                organization_id=org_id
-            )
-            db.add(invoice)
-            db.commit()
-            db.refresh(invoice)
+            # Crear registro en base de datos (escritor serializado en SQLite)
+            org_id = route.organization_id
+
+            def create_invoice(write_db: Session) -> Invoice:
+                invoice = Invoice(
+                    filename=processed_image["filename"],
+                    file_path=processed_image["file_path"],
+                    file_type="image",
+                    processed=False,
+                    description=f"WhatsApp de {sender_name} ({sender_phone})",
+                    organization_id=org_id
+                )
+                write_db.add(invoice)
+                write_db.flush()
+                return invoice
+
+            # Se vuelve a cargar en la sesión del webhook, que actualiza la factura tras la extracción
+            invoice = db.get(Invoice, (await run_write(create_invoice)).id)
             
             print(f"💾 Imagen guardada: {invoice.id}")
 
@@ -317,6 +280,7 @@ class WhatsAppService:
             return {
                 "status": "success",
                 "invoice_id": invoice.id,
+                "organization_id": org_id,
                 "openai_result": openai_result,
                 "sender_info": {
                     "phone": sender_phone,
@@ -329,10 +293,11 @@ class WhatsAppService:
             print(f"❌ Error procesando imagen: {e}")
             return {"status": "error", "error": str(e)}
     
-    async def _get_image_from_evolution(self, message_id: str) -> Optional[str]:
+    async def _get_image_from_evolution(self, message_id: str, config: Optional[EvolutionConfig] = None) -> Optional[str]:
         """
         Obtiene imagen original desde Evolution API
         """
+        config = config or self.config
         try:
             payload = {
                 "message": {
@@ -341,15 +306,15 @@ class WhatsAppService:
                 "convertToMp4": False
             }
             
-            endpoint = f"/chat/getBase64FromMediaMessage/{self.instance_name}"
-            url = f"{self.evolution_url}{endpoint}"
+            endpoint = f"/chat/getBase64FromMediaMessage/{config.instance_name}"
+            url = f"{config.url}{endpoint}"
             
             print(f"📡 Solicitando Base64 a Evolution API: {url} (ID: {message_id})")
             
             response = requests.post(
                 url,
                 json=payload,
-                headers=self.get_headers(),
+                headers=self.get_headers(config),
                 timeout=30
             )
             
@@ -431,7 +396,7 @@ class WhatsAppService:
             
             # Generar nombre de archivo
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            phone_clean = sender_phone.replace("@s.whatsapp.net", "").replace("@c.us", "")
+            phone_clean = normalize_phone(sender_phone)
             filename = f"whatsapp_{phone_clean}_{timestamp}.jpg"
             file_path = os.path.join("uploads", filename)
             
@@ -529,16 +494,14 @@ class WhatsAppService:
                 db.commit()
                 db.refresh(invoice)
                 
-                # Invalidar caché de estadísticas para reflejar cambios en tiempo real
-                try:
-                    invalidate_cache_pattern("stats:*")
-                    print("🔄 Caché de estadísticas invalidado tras procesamiento WhatsApp")
-                except Exception as e:
-                    print(f"⚠️ Error invalidando caché: {e}")
+                # El caché de estadísticas de la organización se invalida al
+                # confirmar la transacción (statistics_service.py)
 
                 print(f"✅ OpenAI procesado exitosamente")
                 return {"success": True, "data": extracted_data}
             else:
+                # Guardar igual el costo de OpenAI de la llamada fallida
+                db.commit()
                 error_msg = extracted_data.get('error', 'Error desconocido') if extracted_data else 'Sin datos'
                 print(f"⚠️ Error OpenAI: {error_msg}")
                 return {"success": False, "error": error_msg}
@@ -547,7 +510,7 @@ class WhatsAppService:
             print(f"❌ Error OpenAI: {e}")
             return {"success": False, "error": str(e)}
     
-    async def _send_auto_response(self, phone: str, result: Dict[str, Any]):
+    async def _send_auto_response(self, phone: str, result: Dict[str, Any], config: Optional[EvolutionConfig] = None):
         """
         Envía respuesta automática
         """
@@ -573,12 +536,12 @@ El sistema no pudo acceder a tu imagen. Esto puede deberse a:
                 else:
                     message = "❌ Hubo un problema procesando tu factura. Por favor, intenta nuevamente."
             
-            await self.send_message(phone, message)
+            await self.send_message(phone, message, config)
             
         except Exception as e:
             print(f"❌ Error enviando respuesta: {e}")
     
-    async def _send_help_message(self, phone: str):
+    async def _send_help_message(self, phone: str, config: Optional[EvolutionConfig] = None):
         """Envía mensaje de ayuda"""
         help_text = """🤖 *Sistema de Facturas - WhatsApp Bot*
 
@@ -600,12 +563,13 @@ El sistema no pudo acceder a tu imagen. Esto puede deberse a:
 
 ¡Envía tu factura cuando quieras! 📄"""
         
-        await self.send_message(phone, help_text)
+        await self.send_message(phone, help_text, config)
     
-    async def send_message(self, phone: str, message: str) -> Dict[str, Any]:
+    async def send_message(self, phone: str, message: str, config: Optional[EvolutionConfig] = None) -> Dict[str, Any]:
         """
-        Envía mensaje por WhatsApp
+        Envía mensaje por WhatsApp (con la Evolution API de `config` o la por defecto)
         """
+        config = config or self.config
         try:
             send_data = {
                 "number": phone,
@@ -613,9 +577,9 @@ El sistema no pudo acceder a tu imagen. Esto puede deberse a:
             }
             
             response = requests.post(
-                f"{self.evolution_url}/message/sendText/{self.instance_name}",
+                f"{config.url}/message/sendText/{config.instance_name}",
                 json=send_data,
-                headers=self.get_headers(),
+                headers=self.get_headers(config),
                 timeout=10
             )
             
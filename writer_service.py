@@ -0,0 +1,180 @@
+"""
+Escritor serializado para SQLite.
+
+SQLite admite un solo escritor a la vez: con varios handlers confirmando en
+paralelo (subidas, webhooks de WhatsApp, notificaciones) aparece
+"database is locked". En modo SQLite todas esas escrituras se encolan y una
+única tarea las ejecuta por lotes: cada trabajo corre en su propio SAVEPOINT
+y el lote se confirma con un solo COMMIT (un fsync para N escrituras).
+Los lectores siguen en paralelo gracias a WAL (ver models.py).
+
+El escritor usa un engine propio que abre las transacciones con
+``BEGIN IMMEDIATE``: toma el lock de escritura al empezar en vez de fallar a
+mitad de la transacción. El resto de la app no cambia de semántica.
+
+En PostgreSQL (o SQLite en memoria) ``run_write`` ejecuta el trabajo en un
+hilo con sesión propia, sin cola.
+"""
+import asyncio
+import logging
+from typing import Any, Callable, List, Optional, Tuple, TypeVar
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session, sessionmaker
+
+from models import DATABASE_URL, SQLITE_PERFORMANCE_MODE, SessionLocal, configure_sqlite_engine
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Trabajos máximos por COMMIT
+WRITE_BATCH_SIZE = 50
+# Segundos que se espera a que lleguen más trabajos antes de confirmar
+WRITE_BATCH_WINDOW = 0.005
+
+
+def _create_writer_engine(url: str):
+    writer_engine = create_engine(url, connect_args={"check_same_thread": False}, pool_size=1, max_overflow=0)
+    configure_sqlite_engine(writer_engine)
+
+    @event.listens_for(writer_engine, "connect")
+    def _disable_pysqlite_transactions(dbapi_connection, connection_record):
+        # pysqlite emite su propio BEGIN (diferido) y rompe los SAVEPOINT
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(writer_engine, "begin")
+    def _begin_immediate(conn):
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+    return writer_engine
+
+
+class SerializedWriter:
+    """Cola de escrituras confirmadas por lotes desde una única tarea"""
+
+    def __init__(self, session_factory: Callable[[], Session], batch_size: int = WRITE_BATCH_SIZE, batch_window: float = WRITE_BATCH_WINDOW):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.batches = 0
+        self.jobs = 0
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        if self._task is not None and not self._task.done() and self._loop is loop:
+            return
+        self._loop = loop
+        self._queue = asyncio.Queue()
+        self._task = loop.create_task(self._run())
+        logger.info("✍️ Escritor serializado de SQLite iniciado")
+
+    async def stop(self):
+        """Confirma lo pendiente y detiene la tarea"""
+        if self._task is None or self._loop is not asyncio.get_running_loop():
+            return
+        await self._queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def submit(self, fn: Callable[[Session], T]) -> T:
+        """
+        Encola `fn(session)` y espera su resultado. `fn` no debe hacer commit;
+        si lanza una excepción solo se deshace su SAVEPOINT y se propaga aquí.
+        """
+        self.start()
+        future = self._loop.create_future()
+        await self._queue.put((fn, future))
+        return await future
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            try:
+                await asyncio.sleep(self.batch_window)
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except asyncio.QueueEmpty:
+                        break
+
+                outcomes = await run_in_threadpool(self._commit_batch, [fn for fn, _ in batch])
+                for (_, future), (ok, value) in zip(batch, outcomes):
+                    if future.done():
+                        continue
+                    if ok:
+                        future.set_result(value)
+                    else:
+                        future.set_exception(value)
+            except Exception as e:
+                logger.error(f"❌ Error en el escritor serializado: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _commit_batch(self, jobs: List[Callable[[Session], Any]]) -> List[Tuple[bool, Any]]:
+        db = self.session_factory()
+        outcomes: List[Tuple[bool, Any]] = []
+        try:
+            for fn in jobs:
+                try:
+                    with db.begin_nested():
+                        outcomes.append((True, fn(db)))
+                except Exception as e:
+                    outcomes.append((False, e))
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.error(f"❌ Error confirmando lote de {len(jobs)} escrituras: {e}")
+            outcomes = [(False, e)] * len(jobs)
+        finally:
+            db.close()
+        self.batches += 1
+        self.jobs += len(jobs)
+        return outcomes
+
+
+def _run_direct(fn: Callable[[Session], T]) -> T:
+    db = SessionLocal(expire_on_commit=False)
+    try:
+        result = fn(db)
+        db.commit()
+        return result
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def _writer_enabled(url: str) -> bool:
+    parsed = make_url(url)
+    return SQLITE_PERFORMANCE_MODE and parsed.drivername.startswith("sqlite") and parsed.database not in (None, "", ":memory:")
+
+
+writer: Optional[SerializedWriter] = None
+if _writer_enabled(DATABASE_URL):
+    writer = SerializedWriter(sessionmaker(bind=_create_writer_engine(DATABASE_URL), autoflush=False, expire_on_commit=False))
+
+
+async def run_write(fn: Callable[[Session], T]) -> T:
+    """
+    Ejecuta `fn(session)` y confirma: por el escritor serializado en SQLite o
+    en un hilo con sesión propia en otros motores. Los objetos retornados
+    quedan desasociados de la sesión pero con sus atributos cargados.
+    """
+    if writer is not None:
+        return await writer.submit(fn)
+    return await run_in_threadpool(_run_direct, fn)